@@ -1,7 +1,6 @@
 import sys
-import numpy as np
 
-from nmigen import Elaboratable, Module, Memory, Signal, ClockSignal, signed, Instance
+from nmigen import Elaboratable, Module, Memory, Signal, ClockSignal, Array, Mux, signed, Instance
 from nmigen.build import Resource, Pins, Attrs
 
 from alldigitalradio.io.generic_serdes import get_serdes_implementation
@@ -11,66 +10,227 @@ from alldigitalradio.mixer import SummingMixer
 from alldigitalradio.filter import RunningBoxcarFilter
 from alldigitalradio.trig import MagnitudeApproximator
 from alldigitalradio.sync import CorrelativeSynchronizer
-from alldigitalradio.symboltable import SymbolTable
-from alldigitalradio.util import pack_mem
 
 from onebitbt.parser import PacketParser
 from onebitbt.clocking import Reference120MhzClock
+from onebitbt.framing import FrameReceiver
+from onebitbt.tables import CompactSymbolTable, load as load_table
+from onebitbt.deltasigma import design_ntf, read_filter
+from onebitbt import buildcache
+from onebitbt.symbols import advertisement, compile_packet, MAX_SYMBOLS, FRAME_SYMBOLS, FRAME_LENGTH, FRAME_QUEUE
 
 from serialcommander.uart import UART
 from serialcommander.commander import Commander
 from serialcommander.printer import TextMemoryPrinter, BinarySignalPrinter, BinaryMemoryPrinter
 from serialcommander.toggler import Toggler
 
-# See research/Transmitter.ipynb to see how this is generated.
-# This could easily be generated in software or gateware, but the feasability seems obvious so I
-# instead precompute it
-PACKET =[22, 21, 20, 21, 20, 21, 20, 21, 20, 23, 10, 12, 13, 12, 15, 2, 4, 7, 24, 16, 8, 2, 4, 7, 26, 27, 6, 5, 3, 9, 22, 21, 20, 23, 8, 2, 3, 9, 22, 23, 8, 0, 24, 18, 19, 25, 6, 7, 26, 28, 29, 27, 1, 14, 15, 2, 4, 7, 24, 18, 19, 30, 31, 16, 8, 2, 3, 14, 15, 2, 3, 9, 17, 30, 31, 18, 19, 25, 6, 5, 3, 14, 15, 2, 3, 14, 13, 12, 13, 11, 17, 30, 31, 18, 20, 21, 19, 25, 1, 9, 22, 21, 19, 30, 31, 16, 10, 12, 15, 0, 26, 27, 1, 9, 17, 30, 31, 18, 19, 25, 1, 14, 13, 12, 13, 11, 17, 30, 29, 28, 29, 27, 1, 14, 13, 11, 22, 23, 8, 0, 26, 27, 6, 5, 4, 7, 24, 16, 8, 2, 3, 9, 17, 25, 6, 7, 26, 28, 31, 16, 8, 0, 24, 18, 20, 21, 20, 23, 10, 11, 22, 21, 19, 25, 1, 14, 15, 0, 24, 16, 8, 2, 4, 5, 4, 7, 24, 18, 20, 23, 8, 2, 3, 9, 17, 30, 31, 16, 8, 0, 24, 18, 19, 30, 29, 28, 31, 18, 20, 21, 20, 23, 10, 11, 17, 30, 29, 28, 31, 16, 8, 0, 26, 27, 1, 14, 15, 0, 26, 27, 6, 7, 24, 18, 19, 25, 6, 7, 24, 16, 8, 0, 26, 28, 29, 27, 1, 9, 17, 25, 1, 9, 17, 30, 29, 28, 29, 27, 6, 5, 3, 14, 15, 0]
+# The packet sent until the host loads something else (see onebitbt.symbols)
+DEFAULT_PDU = advertisement("I LOVE MINDY", '90:d7:eb:b1:92:99')
 
-# If you want to test a sine wave, this will give you that
-#PACKET = [0, 24, 16, 8]*100
+class PacketLoader(Elaboratable):
+    # Handles the frames from onebitbt.symbols: copies symbols into the store and sets the
+    # length of each region and how many slots to cycle through
+    def __init__(self, advertiser):
+        self.advertiser = advertiser
+        self.receiver = FrameReceiver()
 
-TABLE = np.load('data/gmsk_2402e6_5e9.npy').flatten()
+    def elaborate(self, platform):
+        m = Module()
+        adv = self.advertiser
+        m.submodules.receiver = receiver = self.receiver
+        m.submodules.rport = rport = receiver.mem.read_port()
+        m.submodules.wport = wport = adv.store.write_port()
+
+        region = receiver.header[0:8]
+        argument = receiver.header[8:24]
+
+        base = Signal(range(len(adv.lengths)*MAX_SYMBOLS)) # start of the region
+        offset = Signal(16) # where in the region the first symbol of the frame goes
+        idx = Signal(8)
+        m.d.comb += rport.addr.eq(idx)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(receiver.valid & (region < len(adv.lengths))):
+                    with m.If((receiver.frame_type == FRAME_SYMBOLS) & (receiver.length > 3)):
+                        # The symbols start after region and offset
+                        m.d.sync += [
+                            base.eq(region*MAX_SYMBOLS),
+                            offset.eq(argument),
+                            idx.eq(3),
+                        ]
+                        m.next = "COPY"
+                    with m.Elif(receiver.frame_type == FRAME_LENGTH):
+                        m.d.sync += adv.lengths[region].eq(Mux(argument > MAX_SYMBOLS, MAX_SYMBOLS, argument))
+                with m.If(receiver.valid & (receiver.frame_type == FRAME_QUEUE)):
+                    m.d.sync += adv.active.eq(Mux(region > adv.slots, adv.slots, Mux(region == 0, 1, region)))
+
+            with m.State("COPY"):
+                # rport.data is the payload byte at idx - 1, which belongs at offset + idx - 4
+                m.d.sync += idx.eq(idx + 1)
+                with m.If((idx > 3) & (offset + idx - 4 < MAX_SYMBOLS)):
+                    m.d.comb += [
+                        wport.addr.eq(base + offset + idx - 4),
+                        wport.data.eq(rport.data),
+                        wport.en.eq(1),
+                    ]
+                with m.If(idx == receiver.length):
+                    m.next = "IDLE"
+
+        return m
 
 class BLEAdvertiser(Elaboratable):
-    def __init__(self):
+    # Sends the packets in the first `active` of `slots` slots in turn, one per advertising
+    # event, on every one of `channels` (in order) within each event. Every slot has its own
+    # compiled symbol stream per channel (a region), stored in one big memory and copied into
+    # the symbol table's packet memory right before it goes out. The host can replace regions
+    # while it runs (see onebitbt.symbols).
+    def __init__(self, channels=[37], slots=4, baud=115200, pause=int(1e4), line_rate=5e9, quantizer=None, table_options={}):
+        self.channels = channels
+        self.slots = slots
+        self.pause = pause
         self.refclk = Signal()
-        self.serdes = get_serdes_implementation()(line_rate=5.0e9, refclk_freq=125e6) #, internal_refclk=self.refclk)
+        self.serdes = get_serdes_implementation()(line_rate=line_rate, refclk_freq=125e6) #, internal_refclk=self.refclk)
+        self.uart = UART(round(25e6/baud))
+
+        # Every channel's table (generated if need be, see onebitbt.tables) back to back in one
+        # memory, so region streams can point into any of them
+        self.tables = [load_table(channel, line_rate, quantizer, **table_options) for channel in channels]
+
+        # Slot 0 starts out with DEFAULT_PDU on every channel
+        regions = slots*len(channels)
+        init = []
+        lengths = []
+        for channel in channels:
+            packet = compile_packet(DEFAULT_PDU, channel)
+            init += packet + [0]*(MAX_SYMBOLS - len(packet))
+            lengths.append(len(packet))
+        self.store = Memory(width=8, depth=regions*MAX_SYMBOLS, init=init)
+        lengths += [0]*(regions - len(lengths))
+        self.lengths = Array(Signal(range(MAX_SYMBOLS + 1), reset=length, name="length{}".format(i)) for i, length in enumerate(lengths))
+        self.active = Signal(range(slots + 1), reset=1)
+
+        self.loader = PacketLoader(self)
 
     def elaborate(self, platform):
         m = Module()
         m.submodules.serdes = serdes = self.serdes
 
-        # The symbol table reads the corresponding symbols for each
-        # symbol in PACKET and outputs them on tx_data
-        m.submodules.symboltable = symboltable = SymbolTable(
-            table=pack_mem(TABLE, width=20), 
-            packet=Memory(width=16, depth=len(PACKET), init=[int(i) for i in np.array(PACKET) * 5000/20]), 
-            samples_per_symbol=int(5e9/1e6), 
-            tx_domain="tx")
+        m.submodules.uart = uart = self.uart
+        m.submodules.loader = loader = self.loader
         m.d.comb += [
-            symboltable.packet_length.eq(len(PACKET)),
-            serdes.tx_data.eq(symboltable.tx_data)
+            loader.receiver.data.eq(uart.rx_data),
+            loader.receiver.strobe.eq(uart.rx_rdy),
+            uart.rx_ack.eq(uart.rx_rdy),
         ]
+        if platform:
+            m.d.comb += [
+                platform.request('uart_tx').eq(uart.tx_o),
+                uart.rx_i.eq(platform.request('uart_rx')),
+            ]
+
+        # The symbol table reads the corresponding symbols for each
+        # symbol in packet and outputs them on tx_data
+        m.submodules.symboltable = symboltable = CompactSymbolTable(self.tables, depth=MAX_SYMBOLS, tx_domain="tx")
+        m.d.comb += serdes.tx_data.eq(symboltable.tx_data)
 
-        # Quick state machine to transmit and then wait a bit before
-        # transmitting again
+        m.submodules.store = store = self.store.read_port()
+        m.submodules.packet = staging = symboltable.packet.write_port()
+
+        slot = Signal(range(self.slots))
+        channel = Signal(range(len(self.channels)))
+        region = Signal(range(self.slots*len(self.channels)))
+        length = Signal(range(MAX_SYMBOLS + 1))
+        idx = Signal(range(MAX_SYMBOLS + 1))
         counter = Signal(32)
+
+        m.d.comb += [
+            region.eq(slot*len(self.channels) + channel),
+            store.addr.eq(region*MAX_SYMBOLS + idx),
+            symboltable.packet_length.eq(length),
+            # Where the symbol lives in the table of the channel we're on
+            staging.addr.eq(idx - 1),
+            staging.data.eq(symboltable.entry(channel, store.data[:5])),
+        ]
+
+        # Quick state machine to copy each packet of the event over and transmit it, and then
+        # wait a bit before the next event
         with m.FSM():
+            with m.State("START_EVENT"):
+                m.d.sync += channel.eq(0)
+                m.next = "LOAD"
+
+            with m.State("LOAD"):
+                m.d.sync += [
+                    length.eq(self.lengths[region]),
+                    idx.eq(0),
+                ]
+                with m.If(self.lengths[region] == 0):
+                    m.next = "NEXT_CHANNEL"
+                with m.Else():
+                    m.next = "COPY"
+
+            with m.State("COPY"):
+                # store.data is the symbol at idx - 1
+                m.d.sync += idx.eq(idx + 1)
+                m.d.comb += staging.en.eq(idx != 0)
+                with m.If(idx == length):
+                    m.next = "START"
+
             with m.State("START"):
                 m.d.sync += symboltable.tx_reset.eq(1)
                 m.next = "WAIT_DONE"
+
             with m.State("WAIT_DONE"):
                 m.d.sync += symboltable.tx_reset.eq(0)
                 with m.If(symboltable.tx_done):
-                    m.d.sync += counter.eq(0)
+                    m.next = "NEXT_CHANNEL"
+
+            with m.State("NEXT_CHANNEL"):
+                with m.If(channel == len(self.channels) - 1):
+                    m.d.sync += [
+                        slot.eq(Mux(slot + 1 >= self.active, 0, slot + 1)),
+                        counter.eq(0),
+                    ]
                     m.next = "PAUSE"
+                with m.Else():
+                    m.d.sync += channel.eq(channel + 1)
+                    m.next = "LOAD"
+
             with m.State("PAUSE"):
                 m.d.sync += counter.eq(counter + 1)
-                with m.If(counter >= int(1e4)):
-                    m.next = "START"
+                with m.If(counter >= self.pause):
+                    m.next = "START_EVENT"
         return m
 
+def parse_options(args):
+    # `[channels] [--baud N] [--rate LINE_RATE] [--filter FILE] [--program-only | --rebuild]`
+    options = {'channels': [37], 'baud': 115200, 'rate': 5e9, 'filter': None, 'program_only': False, 'rebuild': False}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--baud':
+            options['baud'] = int(args.pop(0))
+        elif arg == '--rate':
+            options['rate'] = float(args.pop(0))
+        elif arg == '--filter':
+            # Noise shape the tables for this output filter (see onebitbt.deltasigma)
+            options['filter'] = args.pop(0)
+        elif arg == '--program-only':
+            options['program_only'] = True
+        elif arg == '--rebuild':
+            options['rebuild'] = True
+        else:
+            options['channels'] = [int(channel) for channel in arg.split(',')]
+    return options
+
 if __name__ == '__main__':
     with hardware.use(sys.argv[1]) as platform:
-        platform().build(BLEAdvertiser(), do_program=True)
\ No newline at end of file
+        options = parse_options(sys.argv[2:])
+        quantizer, table_options = None, {}
+        if options['filter']:
+            ntf = design_ntf(read_filter(options['filter']), options['rate'])
+            quantizer, table_options = 'dsm', {'ntf': [float(c) for c in ntf]}
+        advertiser = BLEAdvertiser(options['channels'], baud=options['baud'], line_rate=options['rate'],
+            quantizer=quantizer, table_options=table_options)
+        buildcache.build(platform(), advertiser, program_only=options['program_only'], rebuild=options['rebuild'])
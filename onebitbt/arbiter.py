@@ -0,0 +1,42 @@
+from nmigen import Elaboratable, Module, Signal
+
+class PrinterArbiter(Elaboratable):
+    # Shares one UART between several printers. A printer owns the UART from the moment it's
+    # started until it says it's done, so messages never get interleaved, and whenever the owner
+    # goes idle we walk round robin to the next printer that has something to say. waiting[i]
+    # is high while printer i has been started but another one has the UART.
+    def __init__(self, printers):
+        self.printers = printers
+        self.tx_data = Signal(8)
+        self.tx_rdy = Signal()
+        self.tx_ack = Signal()
+        self.waiting = Signal(len(printers))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n = len(self.printers)
+        busy = Signal(n)
+        grant = Signal(range(n))
+
+        for i, printer in enumerate(self.printers):
+            with m.If(printer.start):
+                m.d.sync += busy[i].eq(1)
+            with m.Elif(printer.done):
+                m.d.sync += busy[i].eq(0)
+            m.d.comb += self.waiting[i].eq(busy[i] & (grant != i))
+
+            with m.If(grant == i):
+                m.d.comb += [
+                    self.tx_data.eq(printer.tx_data),
+                    self.tx_rdy.eq(printer.tx_rdy),
+                    printer.tx_ack.eq(self.tx_ack),
+                ]
+
+        with m.If(~busy.bit_select(grant, 1)):
+            with m.If(grant == n - 1):
+                m.d.sync += grant.eq(0)
+            with m.Else():
+                m.d.sync += grant.eq(grant + 1)
+
+        return m
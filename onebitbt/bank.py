@@ -0,0 +1,184 @@
+import sys
+import argparse
+
+import numpy as np
+
+from nmigen import Elaboratable, Module, Signal, Array, Const, Cat, Mux, signed
+
+from onebitbt import ble, gmsk, model
+from onebitbt.synchronizer import FractionalSynchronizer
+from onebitbt.framing import RECORD_OFFSET_STEP
+
+# Carrier frequency offset tolerance. Cheap transmitters are often 100-150kHz off, which next to
+# a 250kHz deviation is enough to push the FSK demodulator's tones off balance (and to tilt the
+# phase demodulator's phase) so packets come out with bad CRCs. A lane with `offsets` gets a
+# demodulator and synchronizer for each offset from the channel frequency, and every packet is
+# parsed from whichever one synced best: the longest run of cycles the preamble and access
+# address matched for (see onebitbt.synchronizer). The offset of that one is a rough estimate of
+# the transmitter's, which goes out in the packet records.
+#
+# `python -m onebitbt.bank` measures the packets recovered against offset with the numpy model:
+#
+#   python -m onebitbt.bank --offsets -150,-75,0,75,150 [--phase] [--2m] [--snr 10]
+
+OFFSETS = [-150e3, -75e3, 0, 75e3, 150e3]
+
+def offset_units(offset):
+    # The estimate goes in 7 bits of the record flags
+    units = int(round(offset/RECORD_OFFSET_STEP))
+    if not -64 <= units < 64:
+        raise ValueError("Offsets only go up to +-{:.0f}kHz".format(63*RECORD_OFFSET_STEP/1e3))
+    return units
+
+def parse_offsets(text):
+    # kHz, e.g. `-150,-75,0,75,150`
+    return [float(offset)*1e3 for offset in text.split(',')]
+
+def offset_args(args):
+    # argparse takes the `-150,...` in `--offsets -150,-75,0,75,150` for another option, so glue
+    # it onto --offsets with an = before parsing
+    args = list(args)
+    for i in range(len(args) - 1):
+        if args[i] == '--offsets':
+            args[i:i + 2] = ['--offsets=' + args[i + 1], None]
+    return [arg for arg in args if arg is not None]
+
+def priority(offsets):
+    # Ties go to the offset closest to the channel frequency
+    return sorted(range(len(offsets)), key=lambda i: abs(offsets[i]))
+
+class OffsetBank(Elaboratable):
+    # Takes the baseband and strength of a demodulator per offset and stands in for the
+    # synchronizer (reset, sample_strobe) plus the baseband (bitstream) and strength the parser
+    # should look at. The choice is made on the first sample strobe from any of them, out of the
+    # ones that are locked by then, and holds until reset.
+    def __init__(self, pattern, samples_per_symbol, offsets):
+        self.offsets = offsets
+        self.synchronizers = [FractionalSynchronizer(pattern, samples_per_symbol) for _ in offsets]
+
+        self.inputs = [Signal(name="input{}".format(i)) for i in range(len(offsets))]
+        self.strengths = [Signal(16, name="strength{}".format(i)) for i in range(len(offsets))]
+        self.reset = Signal()
+
+        self.sample_strobe = Signal()
+        self.bitstream = Signal()
+        self.strength = Signal(16)
+        self.offset = Signal(signed(7)) # in RECORD_OFFSET_STEPs
+
+    def elaborate(self, platform):
+        m = Module()
+        for i, (synchronizer, baseband) in enumerate(zip(self.synchronizers, self.inputs)):
+            m.submodules["synchronizer{}".format(i)] = synchronizer
+            m.d.comb += [
+                synchronizer.input.eq(baseband),
+                synchronizer.reset.eq(self.reset),
+            ]
+
+        # The best of the locked ones
+        best = Const(0, range(len(self.offsets)))
+        best_score = Const(0)
+        found = Const(0)
+        for i in priority(self.offsets):
+            synchronizer = self.synchronizers[i]
+            better = synchronizer.locked & (~found | (synchronizer.score > best_score))
+            best = Mux(better, i, best)
+            best_score = Mux(better, synchronizer.score, best_score)
+            found = found | synchronizer.locked
+
+        chosen = Signal()
+        selected = Signal(range(len(self.offsets)))
+        current = Signal(range(len(self.offsets)))
+        m.d.comb += current.eq(Mux(chosen, selected, best))
+
+        strobes = Cat(synchronizer.sample_strobe for synchronizer in self.synchronizers)
+        with m.If(self.reset):
+            m.d.sync += chosen.eq(0)
+        with m.Elif(~chosen & strobes.any()):
+            m.d.sync += [
+                chosen.eq(1),
+                selected.eq(best),
+            ]
+
+        m.d.comb += [
+            self.sample_strobe.eq(strobes.bit_select(current, 1)),
+            self.bitstream.eq(Array(self.inputs)[current]),
+            self.strength.eq(Array(self.strengths)[current]),
+            self.offset.eq(Array(Const(offset_units(offset), signed(7)) for offset in self.offsets)[current]),
+        ]
+
+        return m
+
+def decode(words, channel=37, offsets=(0,), demodulator='fsk', phy='1m'):
+    # The numpy version of a lane with an OffsetBank, see decode_basebands
+    options = ble.demodulator_options(phy, demodulator)
+    basebands = [model.demodulate(words, demodulator=demodulator, frequency=ble.channel_frequency(channel) + offset, **options)
+        for offset in offsets]
+    return decode_basebands(basebands, channel, offsets, phy)
+
+def decode_basebands(basebands, channel=37, offsets=(0,), phy='1m'):
+    # Every packet in the baseband of each offset's demodulator as (packet, offset, timestamp),
+    # packet being None if it didn't parse. Like the records, the timestamp is the sync cycle
+    # of the first bit after the access address.
+    samples_per_symbol = 25e6/ble.PHYS[phy].symbol_rate
+    synchronizer = model.SynchronizerModel(ble.advertising_pattern(phy), samples_per_symbol)
+    matches = [synchronizer.matches(baseband) for baseband in basebands]
+    order = priority(offsets)
+
+    packets = []
+    start = 0
+    while True:
+        locks = [synchronizer.lock(match, start) for match in matches]
+        firsts = [synchronizer.strobes(*lock, 1)[0] if lock else None for lock in locks]
+        if not any(lock for lock in locks):
+            break
+        first = min(f for f in firsts if f is not None)
+        # Locked (the cycle after the run ended) by the first strobe, best score, ties by priority
+        candidates = [i for i in order if locks[i] and locks[i][0] < first]
+        best = max(candidates, key=lambda i: (locks[i][1], -order.index(i)))
+
+        strobes = synchronizer.strobes(*locks[best], 8*(ble.MAX_PDU + 3))
+        strobes = strobes[strobes < len(basebands[best])]
+        bits = list(basebands[best][strobes])
+        packet = ble.decode_bits(bits, channel)
+        length = 8*(2 + packet.length + 3) if packet is not None else len(bits)
+        if length > len(bits):
+            break
+        packets.append((packet, offsets[best], int(strobes[0])))
+        # The parser's done resets everything after the last bit
+        start = strobes[length - 1] + 2
+    return packets
+
+def recovered(offsets, frequency_offset, packets=20, demodulator='fsk', phy='1m', snr_db=10, channel=None, seed=0):
+    # How many of `packets` random advertisements transmitted frequency_offset away from the
+    # channel come out with a good CRC, and the offsets they were picked up on
+    rng = np.random.default_rng(seed)
+    channel = channel if channel is not None else (37 if phy == '1m' else 5)
+    preamble = bytes([ble.PREAMBLE])*(ble.PHYS[phy].preamble_bytes - 1)
+    bits = []
+    for k in range(packets):
+        pdu = ble.build_pdu(2, int(rng.integers(0, 1 << 48)), [(9, bytes(rng.integers(0x41, 0x5B, 12, dtype=np.uint8)))])
+        bits += list(rng.integers(0, 2, 40)) + ble.to_bits(preamble + ble.build_packet(pdu, channel))
+    bits += [0]*40
+    sig = gmsk.modulate(np.array(bits), frequency=ble.channel_frequency(channel) + frequency_offset, one_bit=True,
+        snr_db=snr_db, rng=rng, symbol_rate=ble.PHYS[phy].symbol_rate)
+    words = model.pack_words((sig > 0).astype(np.uint8))
+    good = [(packet, offset) for packet, offset, _ in decode(words, channel, offsets, demodulator, phy)
+        if packet is not None and packet.crc_ok]
+    return len(good), sorted(set(offset for _, offset in good))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Packets recovered against carrier frequency offset, with and without a bank")
+    parser.add_argument('--offsets', default=','.join('{:.0f}'.format(offset/1e3) for offset in OFFSETS), help='kHz')
+    parser.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk')
+    parser.add_argument('--2m', dest='phy', action='store_const', const='2m', default='1m')
+    parser.add_argument('--snr', type=float, default=10)
+    parser.add_argument('--packets', type=int, default=20)
+    args = parser.parse_args(offset_args(sys.argv[1:]))
+
+    offsets = parse_offsets(args.offsets)
+    print("{:>10} {:>10} {:>10}  picked up at".format('offset', 'nominal', 'bank'))
+    for frequency_offset in np.arange(-200e3, 201e3, 50e3):
+        nominal, _ = recovered([0], frequency_offset, args.packets, args.demodulator, args.phy, args.snr)
+        bank, found = recovered(offsets, frequency_offset, args.packets, args.demodulator, args.phy, args.snr)
+        print("{:>9.0f}k {:>10} {:>10}  {}".format(frequency_offset/1e3, "{}/{}".format(nominal, args.packets),
+            "{}/{}".format(bank, args.packets), ', '.join('{:+.0f}k'.format(offset/1e3) for offset in found)))
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from onebitbt import ble, gmsk, model
+
+# Bit and packet error rate benchmarks for the demodulators. Every point on a curve is one
+# (demodulator, SNR) pair and is made up of several independent seeds, each of which is a job
+# for the process pool. A job keeps pushing freshly built advertising packets (with AWGN) through
+# the demodulator until it has seen enough errors, so points with a high error rate finish fast
+# and points with a low one run long enough to actually measure it. Results are written as JSON
+# with sorted keys and nothing that depends on timing, so rerunning gives an identical file and
+# two runs can be diffed:
+#
+#   python -m onebitbt.ber run --output before.json
+#   ... change the demodulator ...
+#   python -m onebitbt.ber run --output after.json
+#   python -m onebitbt.ber compare before.json after.json
+#
+# The noise for a given (SNR, seed, packet) is the same whatever the demodulator, so demodulators
+# are compared on exactly the same packets.
+#
+# SNR is signal power over noise power across the *whole* sampled bandwidth (2.5GHz at 5GSPS),
+# same as research/Detection.ipynb, so the interesting region is well below 0dB.
+
+SAMPLE_RATE = 5e9
+SYMBOL_RATE = 1e6
+SAMPLES_PER_SYMBOL = int(SAMPLE_RATE/SYMBOL_RATE)
+
+# The baseband bit is looked at in the 25MHz sync domain, i.e. 25 times per symbol, and the
+# reference demodulators get decimated down to the same rate
+OVERSAMPLE = 25
+DECIMATION = SAMPLES_PER_SYMBOL//OVERSAMPLE
+
+# Idle (noise only) symbols either side of every packet
+GUARD = 16
+
+# What the synchronizer in BLERadio looks for: the preamble and advertising access address
+SYNC_PATTERN = ble.advertising_pattern('1m')
+
+# Demodulators. Each takes the noisy real signal and returns the baseband bit at OVERSAMPLE
+# samples per symbol.
+
+def demodulate_reference(sig, one_bit=False, frequency=2.402e9):
+    # The "traditional" demodulator from the notebook: mix down to complex baseband, low pass,
+    # and the sign of the derivative of the phase
+    from scipy import signal
+    n = np.arange(len(sig))
+    lo = np.exp(1j*2*np.pi*((frequency/SAMPLE_RATE) % 1)*n)
+    if one_bit:
+        sig = np.sign(sig)
+        lo = np.sign(lo.real) + 1j*np.sign(lo.imag)
+    sos = signal.butter(5, SYMBOL_RATE, 'low', fs=SAMPLE_RATE, output='sos')
+    angle = np.unwrap(np.angle(signal.sosfilt(sos, sig*lo)))
+
+    # Mixing with e^jwt flips the sign of the phase, so a one (phase going forwards) shows
+    # up as the phase going backwards here
+    return (np.diff(angle[::DECIMATION]) < 0).astype(np.uint8)
+
+def demodulate_model(sig, name, **params):
+    # The numpy model of the gateware demodulators (one bit sampling and all)
+    words = model.pack_words(sig)
+    return model.demodulate(words, demodulator=name, **params)
+
+DEMODULATORS = {
+    'ideal': lambda sig, **params: demodulate_reference(sig, one_bit=False, **params),
+    'onebit': lambda sig, **params: demodulate_reference(sig, one_bit=True, **params),
+    'fsk': lambda sig, **params: demodulate_model(sig, 'fsk', **params),
+    'phase': lambda sig, **params: demodulate_model(sig, 'phase', **params),
+}
+
+def demodulate(demodulator, sig, channel, params):
+    return DEMODULATORS[demodulator](sig, frequency=ble.channel_frequency(channel), **dict(params))
+
+# Packets
+
+def random_packet(rng, channel=37, payload=24):
+    # An ADV_IND with a random address and one manufacturer specific AD structure of random data
+    address = int(rng.integers(0, 1 << 48))
+    data = rng.integers(0, 256, size=max(payload - 8, 0), dtype=np.uint8).tobytes()
+    pdu = ble.build_pdu(0x0, address, ad=[(0xFF, data)])
+    return ble.to_bits(ble.build_packet(pdu, channel))
+
+def synchronize(baseband, pattern, max_errors=0):
+    # Rough equivalent of the CorrelativeSynchronizer: the first run of offsets where sampling
+    # every OVERSAMPLE'th bit matches the pattern (to within max_errors), returning the middle
+    # of the run as the sampling point of the first pattern bit. None if there is no match.
+    span = OVERSAMPLE*(len(pattern) - 1)
+    if len(baseband) <= span:
+        return None
+    offsets = np.arange(len(baseband) - span)
+    errors = np.zeros(len(offsets), dtype=np.int32)
+    for k, bit in enumerate(pattern):
+        errors += baseband[offsets + OVERSAMPLE*k] != bit
+    matches = np.flatnonzero(errors <= max_errors)
+    if not len(matches):
+        return None
+    start = matches[0]
+    gaps = np.flatnonzero(np.diff(matches) != 1)
+    end = matches[gaps[0]] if len(gaps) else matches[-1]
+    return int(start + end)//2
+
+def sample_bits(baseband, start, count):
+    idx = start + OVERSAMPLE*np.arange(count)
+    idx = idx[idx < len(baseband)]
+    return baseband[idx]
+
+def transmit(bits, rng, snr_db, channel):
+    # Packet with GUARD idle symbols either side, a random carrier phase and AWGN
+    sig = gmsk.modulate(bits, channel=channel, sample_rate=SAMPLE_RATE, phase=rng.uniform(0, 2*np.pi))
+    guard = np.zeros(GUARD*SAMPLES_PER_SYMBOL)
+    sig = np.concatenate((guard, sig, guard))
+    if snr_db is not None:
+        sig = gmsk.add_noise(sig, snr_db, rng)
+    return sig
+
+@functools.lru_cache()
+def calibrate(demodulator, params, channel, sync_bits, sync_errors):
+    # Where the first bit of a noiseless packet gets sampled, which is where we sample the bits
+    # for the bit error rate (so bit errors aren't conflated with sync failures)
+    rng = np.random.default_rng(0)
+    bits = random_packet(rng, channel)
+    baseband = demodulate(demodulator, transmit(bits, rng, None, channel), channel, params)
+    pattern = SYNC_PATTERN[len(SYNC_PATTERN) - sync_bits:]
+    start = synchronize(baseband, pattern, sync_errors)
+    if start is None:
+        raise RuntimeError("{} can't even demodulate a noiseless packet".format(demodulator))
+    return start - OVERSAMPLE*(len(SYNC_PATTERN) - sync_bits)
+
+def run_job(job):
+    # One (demodulator, SNR, seed). Stops after min_errors bit errors or max_packets packets.
+    demodulator, snr_db, seed = job['demodulator'], job['snr_db'], job['seed']
+    params = tuple(sorted(job['params'].items()))
+    channel = job['channel']
+    pattern = SYNC_PATTERN[len(SYNC_PATTERN) - job['sync_bits']:]
+    start = calibrate(demodulator, params, channel, job['sync_bits'], job['sync_errors'])
+
+    # Same stream of packets and noise for every demodulator
+    rng = np.random.default_rng([seed, int(round(snr_db*1000)) & 0xFFFFFFFF])
+    result = {'bits': 0, 'bit_errors': 0, 'packets': 0, 'packet_errors': 0, 'sync_failures': 0}
+    began = time.time()
+    while result['bit_errors'] < job['min_errors'] and result['packets'] < job['max_packets']:
+        bits = np.array(random_packet(rng, channel, job['payload']), dtype=np.uint8)
+        baseband = demodulate(demodulator, transmit(bits, rng, snr_db, channel), channel, params)
+
+        # Bit errors over the whole packet, sampled where a noiseless packet is
+        received = sample_bits(baseband, start, len(bits))
+        result['bits'] += len(bits)
+        result['bit_errors'] += int(np.sum(received != bits[:len(received)])) + len(bits) - len(received)
+
+        # The packet only counts if the synchronizer finds it and every bit after the access
+        # address comes out right (i.e. it would pass the CRC)
+        result['packets'] += 1
+        synced = synchronize(baseband, pattern, job['sync_errors'])
+        if synced is None:
+            result['sync_failures'] += 1
+            result['packet_errors'] += 1
+            continue
+        body = bits[len(SYNC_PATTERN):]
+        received = sample_bits(baseband, synced + OVERSAMPLE*len(pattern), len(body))
+        if len(received) != len(body) or np.any(received != body):
+            result['packet_errors'] += 1
+
+    result['seconds'] = time.time() - began
+    return result
+
+# Statistics
+
+def wilson(errors, trials, z=1.96):
+    # Wilson score interval for a binomial proportion. Bits within a packet aren't really
+    # independent, so treat the bit error interval as optimistic.
+    if trials == 0:
+        return [0.0, 1.0]
+    p = errors/trials
+    denominator = 1 + z*z/trials
+    centre = (p + z*z/(2*trials))/denominator
+    spread = z*math.sqrt(p*(1 - p)/trials + z*z/(4*trials*trials))/denominator
+    return [max(0.0, centre - spread), min(1.0, centre + spread)]
+
+def summarize(demodulator, snr_db, results, z=1.96):
+    point = {'demodulator': demodulator, 'snr_db': snr_db}
+    for key in ('bits', 'bit_errors', 'packets', 'packet_errors', 'sync_failures'):
+        point[key] = sum(r[key] for r in results)
+    point['seeds'] = len(results)
+    point['ber'] = point['bit_errors']/point['bits'] if point['bits'] else 0.0
+    point['ber_ci'] = wilson(point['bit_errors'], point['bits'], z)
+    point['per'] = point['packet_errors']/point['packets'] if point['packets'] else 0.0
+    point['per_ci'] = wilson(point['packet_errors'], point['packets'], z)
+    return point
+
+# Running
+
+def parse_range(text):
+    # '-40:0:5' (start:stop:step, inclusive) or a comma separated list
+    if ':' in text:
+        start, stop, step = [float(x) for x in text.split(':')]
+        return [round(start + i*step, 6) for i in range(int(math.floor((stop - start)/step + 1e-9)) + 1)]
+    return [float(x) for x in text.split(',')]
+
+def parse_params(items):
+    # key=value pairs passed to the model demodulators, e.g. width=32 or deviation=300e3
+    params = {}
+    for item in items:
+        key, value = item.split('=', 1)
+        params[key] = int(value) if value.lstrip('-').isdigit() else float(value)
+    return params
+
+def benchmark(demodulators, snrs, seeds=4, min_errors=200, max_packets=1000, payload=24, channel=37,
+        params={}, sync_bits=len(SYNC_PATTERN), sync_errors=0, processes=None, z=1.96, progress=None):
+    # Returns a list of points (see summarize). The error and packet budgets are split evenly
+    # across the seeds.
+    jobs = []
+    for demodulator in demodulators:
+        for snr_db in snrs:
+            for seed in range(seeds):
+                jobs.append({
+                    'demodulator': demodulator,
+                    'snr_db': snr_db,
+                    'seed': seed,
+                    # The references don't take the gateware parameters
+                    'params': params if demodulator in model.DEMODULATORS else {},
+                    'channel': channel,
+                    'payload': payload,
+                    'sync_bits': sync_bits,
+                    'sync_errors': sync_errors,
+                    'min_errors': int(math.ceil(min_errors/seeds)),
+                    'max_packets': int(math.ceil(max_packets/seeds)),
+                })
+
+    with ProcessPoolExecutor(processes) as pool:
+        results = []
+        for i, result in enumerate(pool.map(run_job, jobs)):
+            results.append(result)
+            if progress:
+                progress(i + 1, len(jobs))
+
+    points = []
+    for i in range(0, len(jobs), seeds):
+        points.append(summarize(jobs[i]['demodulator'], jobs[i]['snr_db'], results[i:i + seeds], z))
+    return points
+
+def save(path, config, points):
+    with open(path, 'w') as f:
+        json.dump({'config': config, 'points': points}, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+def format_points(points):
+    lines = ["{:<8} {:>7} {:>10} {:>23} {:>8} {:>23}".format('demod', 'snr_db', 'ber', '95% ci', 'per', '95% ci')]
+    for p in points:
+        lines.append("{:<8} {:>7.1f} {:>10.2e} [{:>9.2e}, {:>9.2e}] {:>8.3f} [{:>9.3f}, {:>9.3f}]".format(
+            p['demodulator'], p['snr_db'], p['ber'], p['ber_ci'][0], p['ber_ci'][1], p['per'], p['per_ci'][0], p['per_ci'][1]))
+    return '\n'.join(lines)
+
+def compare(before, after):
+    # Lines up points by (demodulator, snr) and flags the ones whose confidence intervals don't
+    # overlap, i.e. that got significantly better or worse
+    key = lambda p: (p['demodulator'], p['snr_db'])
+    old = {key(p): p for p in before['points']}
+    lines = []
+    for p in after['points']:
+        q = old.get(key(p))
+        if q is None:
+            continue
+        verdicts = []
+        for metric in ('ber', 'per'):
+            lo, hi = p[metric + '_ci']
+            old_lo, old_hi = q[metric + '_ci']
+            if hi < old_lo:
+                verdicts.append(metric + ' better')
+            elif lo > old_hi:
+                verdicts.append(metric + ' WORSE')
+        lines.append("{:<8} {:>7.1f}  ber {:.2e} -> {:.2e}  per {:.3f} -> {:.3f}  {}".format(
+            p['demodulator'], p['snr_db'], q['ber'], p['ber'], q['per'], p['per'], ', '.join(verdicts)))
+    return '\n'.join(lines)
+
+def main(args):
+    parser = argparse.ArgumentParser(prog='python -m onebitbt.ber')
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='measure bit and packet error rates')
+    run.add_argument('--demodulators', default=','.join(DEMODULATORS), help='comma separated, from ' + ', '.join(DEMODULATORS))
+    run.add_argument('--snr', default='-26:-12:2', help='SNRs in dB, start:stop:step or a comma separated list (use --snr=-20:-10:2 for negative ones)')
+    run.add_argument('--seeds', type=int, default=4)
+    run.add_argument('--min-errors', type=int, default=200, help='bit errors to collect per point before stopping')
+    run.add_argument('--max-packets', type=int, default=1000, help='give up on a point after this many packets')
+    run.add_argument('--payload', type=int, default=24, help='advertising payload length in bytes')
+    run.add_argument('--channel', type=int, default=37)
+    run.add_argument('--set', dest='params', action='append', default=[],
+        help='demodulator parameter for the gateware models, e.g. --set width=32 --set deviation=300e3')
+    run.add_argument('--sync-bits', type=int, default=len(SYNC_PATTERN), help='only sync on the last N bits of the pattern')
+    run.add_argument('--sync-errors', type=int, default=0, help='bit errors allowed in the sync pattern')
+    run.add_argument('--jobs', type=int, default=None, help='worker processes (default: one per CPU)')
+    run.add_argument('--output', default='ber.json')
+
+    diff = commands.add_parser('compare', help='compare two result files')
+    diff.add_argument('before')
+    diff.add_argument('after')
+
+    args = parser.parse_args(args)
+    if args.command == 'compare':
+        print(compare(json.load(open(args.before)), json.load(open(args.after))))
+        return
+    if args.command != 'run':
+        parser.print_help()
+        return
+
+    demodulators = args.demodulators.split(',')
+    for demodulator in demodulators:
+        if demodulator not in DEMODULATORS:
+            parser.error("Unknown demodulator {}".format(demodulator))
+    config = {
+        'demodulators': demodulators,
+        'snrs': parse_range(args.snr),
+        'seeds': args.seeds,
+        'min_errors': args.min_errors,
+        'max_packets': args.max_packets,
+        'payload': args.payload,
+        'channel': args.channel,
+        'params': parse_params(args.params),
+        'sync_bits': args.sync_bits,
+        'sync_errors': args.sync_errors,
+    }
+
+    began = time.time()
+    progress = lambda done, total: sys.stderr.write("\r{}/{} jobs".format(done, total))
+    points = benchmark(processes=args.jobs or os.cpu_count(), progress=progress, **config)
+    sys.stderr.write("\n")
+    print(format_points(points))
+    print("Took {:.1f}s, results in {}".format(time.time() - began, args.output))
+    save(args.output, config, points)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
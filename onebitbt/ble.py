@@ -0,0 +1,361 @@
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Bits and pieces of the Bluetooth Low Energy spec that are shared between the gateware and
+# host side code.
+#
+# research/Parsing.ipynb walks through whitening, the CRC and the packet layout a bit at a time,
+# which is great for understanding and hopeless for checking a few hundred thousand packets. So
+# everything here works on bytes (as they go over the air, LSB first) using lookup tables, and
+# the *_packets functions take a whole (packets x bytes) array at once. Run
+# `python -m onebitbt.ble conformance` to check the tables against the gateware.
+
+ADVERTISING_CHANNELS = [37, 38, 39]
+CHANNELS = 40
+
+ACCESS_ADDRESS = 0x8E89BED6 # Used by every advertising packet
+PREAMBLE = 0xAA # For access addresses that start (LSB) with a 0
+
+MAX_PDU = 2 + 255 # Header plus the largest payload the length field allows
+
+# The uncoded PHYs: symbols a second, how far a one is above the carrier and how many bytes of
+# preamble go before the access address. 2M is only ever on the secondary advertising and data
+# channels, the primary advertising channels (37-39) are always 1M.
+PHY = namedtuple('PHY', ['symbol_rate', 'deviation', 'preamble_bytes'])
+PHYS = {
+    '1m': PHY(1e6, 250e3, 1),
+    '2m': PHY(2e6, 500e3, 2),
+}
+
+def advertising_pattern(phy='1m'):
+    # Preamble and advertising access address as bits, what the synchronizer looks for
+    return to_bits(bytes([PREAMBLE])*PHYS[phy].preamble_bytes + ACCESS_ADDRESS.to_bytes(4, 'little'))
+
+def demodulator_options(phy='1m', demodulator='fsk'):
+    # The demodulators' filters are a 1M symbol long (and the phase demodulator looks a quarter of
+    # one back), so they shrink along with the symbols
+    phy = PHYS[phy]
+    scale = 1e6/phy.symbol_rate
+    options = {'deviation': phy.deviation, 'width': int(64*scale)}
+    if demodulator == 'phase':
+        options['lag'] = int(16*scale)
+    return options
+
+def channel_frequency(channel):
+    # The advertising channels are sprinkled in between the data channels (to dodge the most
+    # common WiFi channels), so the numbering isn't in frequency order
+    if channel == 37:
+        return 2.402e9
+    if channel == 38:
+        return 2.426e9
+    if channel == 39:
+        return 2.480e9
+    if channel <= 10:
+        return 2.404e9 + 2e6*channel
+    return 2.428e9 + 2e6*(channel - 11)
+
+def whitening_seed(channel):
+    # The whitening LFSR starts with a one in position 0 and the channel index (MSB first) in
+    # positions 1-6. Returned with position i in bit i.
+    return 1 | sum(((channel >> (5 - i)) & 1) << (i + 1) for i in range(6))
+
+# PDU types of the advertising channel PDUs
+PDU_TYPES = {
+    0x0: 'ADV_IND',
+    0x1: 'ADV_DIRECT_IND',
+    0x2: 'ADV_NONCONN_IND',
+    0x3: 'SCAN_REQ',
+    0x4: 'SCAN_RSP',
+    0x5: 'CONNECT_IND',
+    0x6: 'ADV_SCAN_IND',
+    0x7: 'ADV_EXT_IND',
+}
+
+# PDU types whose payload is an advertiser address followed by AD structures
+AD_PDU_TYPES = (0x0, 0x2, 0x4, 0x6)
+
+# PDU types whose payload starts with an address at all
+ADDRESS_PDU_TYPES = (0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6)
+
+CRC_INIT = 0x555555
+CRC_POLY = 0b11001011010
+
+def to_bits(data):
+    # Bytes go over the air LSB first
+    return [(byte >> i) & 1 for byte in data for i in range(8)]
+
+def to_bytes(bits):
+    return bytes(sum(bit << i for i, bit in enumerate(bits[j:j + 8])) for j in range(0, len(bits) - len(bits) % 8, 8))
+
+# Bit reversal of every byte, the CRC shifts in bits MSB first but bytes go over the air LSB first
+REVERSE = np.array([int('{:08b}'.format(i)[::-1], 2) for i in range(256)], dtype=np.uint8)
+
+def whitening_bits(channel, count):
+    # Straight from the notebook, one bit at a time. Only used to build the tables.
+    state = [(whitening_seed(channel) >> i) & 1 for i in range(7)]
+    out = []
+    for _ in range(count):
+        out.append(state[6])
+        state = [state[6]] + state[0:3] + [state[3] ^ state[6]] + state[4:6]
+    return out
+
+# The whitening keystream for each of the 40 channels, as bytes. Whitening covers the PDU and CRC.
+KEYSTREAM = np.array([np.frombuffer(to_bytes(whitening_bits(channel, 8*(MAX_PDU + 3))), dtype=np.uint8)
+    for channel in range(40)])
+
+def crc(bits, init=CRC_INIT):
+    # Reference bit at a time CRC, returns the CRC bits in the order they go over the air
+    state = init
+    for bit in bits:
+        ni = ((state >> 23) & 1) ^ bit
+        state = (((state << 1) | ni) ^ ni*CRC_POLY) & 0xFFFFFF
+    return [(state >> (23 - i)) & 1 for i in range(24)]
+
+def _crc_table():
+    table = np.zeros(256, dtype=np.uint32)
+    for i in range(256):
+        state = i << 16
+        for _ in range(8):
+            state = ((state << 1) ^ ((CRC_POLY | 1) if state & 0x800000 else 0)) & 0xFFFFFF
+        table[i] = state
+    return table
+CRC_TABLE = _crc_table()
+
+def crc_state(data, lengths=None, init=CRC_INIT):
+    # Byte at a time CRC over every row of a (packets x bytes) array, only counting the first
+    # lengths[i] bytes of row i. Returns the final shift register contents (same as GaloisCRC.crc).
+    data = np.atleast_2d(np.asarray(data, dtype=np.uint8))
+    state = np.full(len(data), init, dtype=np.uint32)
+    if lengths is None:
+        lengths = np.full(len(data), data.shape[1])
+    for j in range(int(np.max(lengths, initial=0))):
+        updated = ((state << 8) & 0xFFFFFF) ^ CRC_TABLE[((state >> 16) ^ REVERSE[data[:, j]]) & 0xFF]
+        state = np.where(lengths > j, updated, state)
+    return state
+
+def crc_state_to_bytes(state):
+    # The CRC goes over the air MSB first
+    state = np.asarray(state, dtype=np.uint32)
+    return np.stack([REVERSE[(state >> shift) & 0xFF] for shift in (16, 8, 0)], axis=-1)
+
+def crc_bytes(pdu, init=CRC_INIT):
+    return crc_state_to_bytes(crc_state(np.frombuffer(bytes(pdu), dtype=np.uint8), init=init))[0].tobytes()
+
+def whiten_packets(data, channels):
+    # Whitens (or dewhitens, it's the same thing) a (packets x bytes) array of everything after
+    # the access address. channels can be a single channel or one per packet.
+    data = np.atleast_2d(np.asarray(data, dtype=np.uint8))
+    channels = np.broadcast_to(np.asarray(channels), (len(data),))
+    return data ^ KEYSTREAM[channels, :data.shape[1]]
+
+def whiten(bits, channel=37):
+    return [bit ^ w for bit, w in zip(bits, to_bits(KEYSTREAM[channel, :(len(bits) + 7)//8]))]
+
+Packets = namedtuple('Packets', ['channel', 'pdu_type', 'tx_add', 'rx_add', 'length', 'address', 'crc_ok', 'data'])
+
+def parse_packets(data, channels=37, whitened=True):
+    # Parses a (packets x bytes) array of everything after the access address. Rows that are
+    # too short for the length they claim come back with crc_ok False. address is the 48 bit
+    # advertiser address as an integer (0 for PDUs without one).
+    data = np.atleast_2d(np.asarray(data, dtype=np.uint8))
+    channels = np.broadcast_to(np.asarray(channels), (len(data),))
+    if whitened:
+        data = whiten_packets(data, channels)
+    if data.shape[1] < 8:
+        data = np.concatenate((data, np.zeros((len(data), 8 - data.shape[1]), dtype=np.uint8)), axis=1)
+
+    length = data[:, 1].astype(np.int32)
+    complete = 2 + length + 3 <= data.shape[1]
+
+    # Pull the received CRC out from wherever each packet ends
+    rows = np.arange(len(data))
+    padded = np.concatenate((data, np.zeros((len(data), 3), dtype=np.uint8)), axis=1)
+    ends = np.minimum(2 + length, data.shape[1])
+    received = np.stack([padded[rows, ends + i] for i in range(3)], axis=-1)
+    expected = crc_state_to_bytes(crc_state(data, ends))
+    crc_ok = complete & (received == expected).all(axis=1)
+
+    pdu_type = data[:, 0] & 0xF
+    address = np.zeros(len(data), dtype=np.uint64)
+    for i in range(6):
+        address |= data[:, 2 + i].astype(np.uint64) << np.uint64(8*i)
+    address[~(np.isin(pdu_type, ADDRESS_PDU_TYPES) & (length >= 6))] = 0
+
+    return Packets(channels, pdu_type, (data[:, 0] >> 6) & 1, (data[:, 0] >> 7) & 1, length, address, crc_ok, data)
+
+ADStructures = namedtuple('ADStructures', ['packet', 'ad_type', 'offset', 'size'])
+
+def parse_ad_packets(packets):
+    # Finds every AD structure in a batch of parsed packets. Walks all the packets' AD chains in
+    # lock step, so it only loops as many times as the longest chain is long. Returns flat arrays
+    # with the packet index, AD type, and the offset (into packets.data) and size of each value.
+    data = packets.data
+    rows = np.arange(len(data))
+    ends = 2 + packets.length
+    position = np.full(len(data), 2 + 6)
+    active = np.isin(packets.pdu_type, AD_PDU_TYPES) & (ends <= data.shape[1])
+
+    found = []
+    while active.any():
+        idx = rows[active]
+        pos = position[idx]
+        size = np.zeros(len(idx), dtype=np.int32)
+        ok = pos + 1 < ends[idx]
+        size[ok] = data[idx[ok], pos[ok]]
+        ok &= (size > 0) & (pos + 1 + size <= ends[idx])
+        found.append((idx[ok], data[idx[ok], pos[ok] + 1], pos[ok] + 2, size[ok] - 1))
+        position[idx[ok]] = pos[ok] + 1 + size[ok]
+        active[idx[~ok]] = False
+
+    if not found:
+        empty = np.zeros(0, dtype=np.int64)
+        return ADStructures(empty, empty.astype(np.uint8), empty, empty)
+    packet, ad_type, offset, size = [np.concatenate(parts) for parts in zip(*found)]
+    order = np.lexsort((offset, packet))
+    return ADStructures(packet[order], ad_type[order], offset[order], size[order])
+
+def ad_values(packets, structures, ad_type):
+    # Returns {packet index: value} for the first AD structure of the given type in each packet
+    out = {}
+    selected = structures.ad_type == ad_type
+    for packet, offset, size in zip(structures.packet[selected], structures.offset[selected], structures.size[selected]):
+        if packet not in out:
+            out[int(packet)] = packets.data[packet, offset:offset + size].tobytes()
+    return out
+
+# Single packet conveniences, mostly for the host tools
+
+Packet = namedtuple('Packet', ['channel', 'pdu_type', 'tx_add', 'rx_add', 'length', 'address', 'payload', 'crc_ok', 'ad'])
+
+def format_address(address):
+    return ':'.join('{:02x}'.format((int(address) >> (8*i)) & 0xFF) for i in reversed(range(6)))
+
+def parse_ad(data):
+    # Splits advertising data into (type, value) pairs, stopping at the first malformed one
+    out = []
+    i = 0
+    while i < len(data):
+        size = data[i]
+        if size == 0 or i + 1 + size > len(data):
+            break
+        out.append((data[i + 1], bytes(data[i + 2:i + 1 + size])))
+        i += 1 + size
+    return out
+
+def parse_packet(data, channel=37):
+    # Parses a dewhitened PDU + CRC (i.e. everything after the access address). Returns None if
+    # there isn't even a whole packet's worth of data.
+    data = bytes(data)
+    if len(data) < 2 or len(data) < 2 + data[1] + 3:
+        return None
+    packets = parse_packets(np.frombuffer(data, dtype=np.uint8), channel, whitened=False)
+    length = data[1]
+    payload = data[2:2 + length]
+    pdu_type = int(packets.pdu_type[0])
+    address = format_address(packets.address[0]) if pdu_type in ADDRESS_PDU_TYPES and length >= 6 else None
+    ad = parse_ad(payload[6:]) if pdu_type in AD_PDU_TYPES else []
+    return Packet(channel, pdu_type, int(packets.tx_add[0]), int(packets.rx_add[0]), length, address, payload,
+        bool(packets.crc_ok[0]), ad)
+
+def decode_bits(bits, channel=37):
+    # Dewhitens and parses raw on-air bits starting right after the access address
+    return parse_packet(to_bytes(whiten(bits, channel)), channel)
+
+def local_name(packet):
+    for ad_type, value in packet.ad:
+        if ad_type in (0x08, 0x09):
+            return value.decode('utf-8', 'replace')
+    return None
+
+# Building packets
+
+def build_pdu(pdu_type, address, ad=(), tx_add=0, rx_add=0, payload=None):
+    # Builds an (unwhitened, CRC-less) advertising PDU. ad is a list of (type, value) pairs,
+    # address an integer or 'aa:bb:..' string. Pass payload to skip the address/AD layout.
+    if payload is None:
+        if isinstance(address, str):
+            address = int(address.replace(':', ''), 16)
+        payload = address.to_bytes(6, 'little') + b''.join(bytes([len(value) + 1, ad_type]) + bytes(value) for ad_type, value in ad)
+    if len(payload) > 255:
+        raise ValueError("Payload too long ({} bytes)".format(len(payload)))
+    return bytes([(pdu_type & 0xF) | (tx_add << 6) | (rx_add << 7), len(payload)]) + bytes(payload)
+
+def build_packet(pdu, channel=37, access_address=ACCESS_ADDRESS, preamble=True):
+    # Turns a PDU into the bytes that go over the air: preamble, access address and the
+    # whitened PDU and CRC
+    body = whiten_packets(np.frombuffer(pdu + crc_bytes(pdu), dtype=np.uint8), channel)[0].tobytes()
+    return (bytes([PREAMBLE]) if preamble else b'') + access_address.to_bytes(4, 'little') + body
+
+def conformance(count=100, length=40, seed=0):
+    # Checks the tables against the gateware the parser actually uses, by pushing random bytes
+    # through the nmigen simulator. Returns the number of mismatched packets.
+    from nmigen import Module
+    from nmigen.sim import Simulator, Settle
+
+    from alldigitalradio.shiftregisters import GaloisCRC
+    from onebitbt.parser import Whitener
+
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 256, (count, length), dtype=np.uint8)
+    channels = rng.integers(0, 40, count)
+    expected_crc = crc_state(data)
+    expected_keystream = whiten_packets(np.zeros_like(data), channels)
+
+    mismatches = 0
+    for row in range(count):
+        m = Module()
+        m.submodules.crc = galois = GaloisCRC()
+        m.submodules.whitener = whitener = Whitener(int(channels[row]))
+        keystream = []
+        result = []
+
+        def process():
+            for bit in to_bits(data[row]):
+                yield Settle()
+                keystream.append((yield whitener.output))
+                yield galois.input.eq(int(bit))
+                yield galois.en.eq(1)
+                yield whitener.run_strobe.eq(1)
+                yield
+            yield galois.en.eq(0)
+            yield whitener.run_strobe.eq(0)
+            yield
+            yield Settle()
+            result.append((yield galois.crc))
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(process)
+        sim.run()
+
+        if result[0] != expected_crc[row] or to_bytes(keystream) != expected_keystream[row].tobytes():
+            mismatches += 1
+    return mismatches
+
+def benchmark(count=200000, seed=0):
+    # Parses `count` whitened ADV_INDs with a name and some manufacturer data, returns packets/s
+    rng = np.random.default_rng(seed)
+    ad = [(0x09, b'bench'), (0xFF, bytes(range(16)))]
+    pdus = [build_pdu(0, int(address), ad) for address in rng.integers(0, 1 << 47, 1000)]
+    packets = np.array([np.frombuffer(build_packet(pdu, 37)[5:], dtype=np.uint8) for pdu in pdus])
+    packets = packets[rng.integers(0, len(packets), count)]
+
+    start = time.time()
+    parsed = parse_packets(packets, 37)
+    structures = parse_ad_packets(parsed)
+    elapsed = time.time() - start
+    assert parsed.crc_ok.all() and len(structures.packet) == 2*count
+    return count/elapsed
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'conformance':
+        mismatches = conformance()
+        if mismatches:
+            print("{} packets did not match the gateware!".format(mismatches))
+            sys.exit(1)
+        print("Whitening and CRC tables match the gateware")
+    elif sys.argv[1] == 'benchmark':
+        print("{:.0f} packets/s".format(benchmark()))
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import functools
+import subprocess
+
+from nmigen.build.run import LocalBuildProducts
+
+from onebitbt.tables import CACHE_DIR
+
+# Content addressed cache of toolchain builds. A Vivado build takes minutes even when the design
+# didn't change, so rather than building straight into build/, every build goes into a directory
+# named after a hash of everything that goes into it: the files of the build plan (the elaborated
+# RTL, constraints and build scripts) and the toolchain version. If that directory already exists
+# the build is skipped entirely, and the reports the toolchain wrote are right there next to the
+# bitstream.
+#
+#   python -m onebitbt.radio te0714 37,38,39 --program-only   # flash the cached build, or fail
+#   python -m onebitbt.radio te0714 37,38,39 --rebuild        # ignore the cache
+
+BUILD_CACHE = os.path.join(CACHE_DIR, 'builds')
+
+# Written last, so an entry without it is a build that didn't finish
+MANIFEST = 'cache.json'
+
+@functools.lru_cache()
+def tool_version(tool):
+    # First line of whatever version banner the tool prints, or None if it isn't there
+    for flag in ('-version', '--version', '-V'):
+        try:
+            result = subprocess.run([tool, flag], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        output = result.stdout.decode('utf-8', 'replace').strip()
+        if result.returncode == 0 and output:
+            return output.splitlines()[0]
+    return None
+
+def toolchain(platform):
+    # What identifies the toolchain a platform builds with
+    info = {
+        'platform': type(platform).__name__,
+        'toolchain': getattr(platform, 'toolchain', None),
+        'env': os.environ.get(getattr(platform, '_toolchain_env_var', '')),
+    }
+    for tool in platform.required_tools:
+        info[tool] = tool_version(os.environ.get(tool.upper().replace('-', '_'), tool))
+    return info
+
+def digest(plan, extra):
+    hasher = hashlib.sha256(plan.digest())
+    hasher.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()[:24]
+
+def lookup(key, cache_dir=BUILD_CACHE):
+    # The cached build for key, if there is a complete one
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        return path
+    return None
+
+def build(platform, design, name='top', do_program=True, program_only=False, rebuild=False,
+        cache_dir=BUILD_CACHE, program_opts=None, **kwargs):
+    # Drop-in for platform.build(design, do_program=...). Returns the build products.
+    plan = platform.prepare(design, name, **kwargs)
+    info = toolchain(platform)
+    key = digest(plan, info)
+    path = lookup(key, cache_dir)
+
+    if program_only:
+        if path is None:
+            raise FileNotFoundError("No cached build of this design ({}), build it first".format(key))
+    elif path is None or rebuild:
+        path = os.path.join(cache_dir, key)
+        partial = path + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        start = time.time()
+        plan.execute_local(partial)
+        with open(os.path.join(partial, MANIFEST), 'w') as f:
+            json.dump({
+                'key': key,
+                'name': name,
+                'toolchain': info,
+                'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'seconds': round(time.time() - start, 1),
+                'command': sys.argv,
+            }, f, indent=2, sort_keys=True)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(partial, path)
+        print("Built {} in {:.0f}s".format(path, time.time() - start))
+    else:
+        print("Using cached build {}".format(path))
+
+    products = LocalBuildProducts(path)
+    if do_program:
+        platform.toolchain_program(products, name, **(program_opts or {}))
+    return products
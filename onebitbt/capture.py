@@ -0,0 +1,169 @@
+import sys
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# A compact on-disk format for 1-bit SERDES captures. Text captures (like data/bt1bit.txt) spend a
+# whole byte per sample, which gets silly at 5GSPS. Instead, we store a small header followed by
+# the samples packed 8 to a byte (first sample in the LSB), which means every 5 bytes hold exactly
+# two 20-bit SERDES words and we can memory map the file and unpack words straight out of it.
+#
+# Header layout (little endian):
+#   magic         4s   b'1BIT'
+#   version       H
+#   header_size   H    offset of the packed samples from the start of the file
+#   word_width    H    bits per SERDES word (20)
+#   channel       h    BLE channel index, or -1 if unknown
+#   sample_rate   d    samples per second
+#   frequency     d    center/carrier frequency in Hz (or 0 if unknown)
+#   samples       Q    number of valid samples
+
+MAGIC = b'1BIT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHhddQ')
+
+CaptureHeader = namedtuple('CaptureHeader', ['word_width', 'channel', 'sample_rate', 'frequency', 'samples'])
+
+def read_header(f):
+    magic, version, header_size, word_width, channel, sample_rate, frequency, samples = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a packed capture file")
+    if version != VERSION:
+        raise ValueError("Unsupported capture version {}".format(version))
+    return CaptureHeader(word_width, channel, sample_rate, frequency, samples), header_size
+
+def is_packed(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class CaptureWriter:
+    # Streams 1-bit samples (or 20-bit words) into a packed capture, the sample count in the
+    # header gets filled in on close
+    def __init__(self, filename, sample_rate=5e9, frequency=2.402e9, channel=37, word_width=20):
+        self.f = open(filename, 'wb')
+        self.header = CaptureHeader(word_width, channel, sample_rate, frequency, 0)
+        self.samples = 0
+        self.carry = np.zeros(0, dtype=np.uint8)
+        self.f.write(self.pack_header())
+
+    def pack_header(self):
+        h = self.header._replace(samples=self.samples)
+        return HEADER.pack(MAGIC, VERSION, HEADER.size, h.word_width, h.channel, h.sample_rate, h.frequency, h.samples)
+
+    def write_samples(self, samples):
+        # Anything > 0 is a one, same as pack_mem
+        bits = np.concatenate((self.carry, (np.asarray(samples) > 0).astype(np.uint8)))
+        whole = len(bits) - len(bits) % 8
+        self.f.write(np.packbits(bits[:whole], bitorder='little').tobytes())
+        self.carry = bits[whole:]
+        self.samples += len(samples)
+
+    def write_words(self, words):
+        words = np.asarray(words, dtype=np.uint32)
+        width = self.header.word_width
+        self.write_samples(((words[:, None] >> np.arange(width, dtype=np.uint32)) & 1).flatten())
+
+    def close(self):
+        if len(self.carry):
+            self.f.write(np.packbits(self.carry, bitorder='little').tobytes())
+            self.carry = np.zeros(0, dtype=np.uint8)
+        self.f.seek(0)
+        self.f.write(self.pack_header())
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_capture(filename):
+    # Returns the header and a read-only memory map over the packed samples
+    with open(filename, 'rb') as f:
+        header, offset = read_header(f)
+    data = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=((header.samples + 7)//8,))
+    return header, data
+
+def unpack_words(data, width=20):
+    # Turns packed bytes into words. For 20-bit words every 5 bytes hold exactly two words so
+    # we can do this without ever expanding out to one byte per sample.
+    if width == 20:
+        data = np.asarray(data)
+        if len(data) % 5:
+            data = np.concatenate((data, np.zeros(5 - len(data) % 5, dtype=np.uint8)))
+        data = data.reshape(-1, 5).astype(np.uint64)
+        packed = data[:, 0] | (data[:, 1] << 8) | (data[:, 2] << 16) | (data[:, 3] << 24) | (data[:, 4] << 32)
+        words = np.empty((len(packed), 2), dtype=np.uint32)
+        words[:, 0] = packed & 0xFFFFF
+        words[:, 1] = packed >> 20
+        return words.flatten()
+    bits = np.unpackbits(np.asarray(data), bitorder='little')
+    bits = bits[:len(bits) - len(bits) % width].reshape(-1, width).astype(np.uint32)
+    return (bits << np.arange(width, dtype=np.uint32)).sum(axis=1, dtype=np.uint32)
+
+def iter_words(filename, chunk_words=1 << 20, start=0, count=None):
+    # Yields chunks of pack_mem compatible words from a capture (packed or text). `start` and
+    # `count` are in words.
+    if not is_packed(filename):
+        words = read_text(filename)
+        end = len(words) if count is None else min(len(words), start + count)
+        for i in range(start, end, chunk_words):
+            yield words[i:min(i + chunk_words, end)]
+        return
+
+    header, data = open_capture(filename)
+    width = header.word_width
+    total = header.samples//width
+    end = total if count is None else min(total, start + count)
+
+    # Keep chunks aligned to whole bytes so we can slice straight out of the memory map
+    align = 8//np.gcd(width, 8)
+    chunk_words = max(align, chunk_words - chunk_words % align)
+    if start % align:
+        raise ValueError("start must be a multiple of {} words".format(align))
+
+    for i in range(start, end, chunk_words):
+        n = min(chunk_words, end - i)
+        first = i*width//8
+        last = (i + n)*width
+        words = unpack_words(data[first:(last + 7)//8], width)
+        yield words[:n]
+
+def count_words(filename):
+    if not is_packed(filename):
+        return len(read_text(filename))
+    with open(filename, 'rb') as f:
+        header, offset = read_header(f)
+    return header.samples//header.word_width
+
+def read_words(filename, start=0, count=None):
+    return np.concatenate(list(iter_words(filename, start=start, count=count)) + [np.zeros(0, dtype=np.uint32)])
+
+def read_text(filename):
+    # Captures like data/bt1bit.txt are just a long string of 1s and 0s
+    samples = np.frombuffer(open(filename, 'rb').read(), dtype=np.uint8)
+    samples = samples[(samples == ord('0')) | (samples == ord('1'))] - ord('0')
+    return unpack_words(np.packbits(samples, bitorder='little'))[:len(samples)//20]
+
+def convert_text(src, dst, sample_rate=5e9, frequency=2.402e9, channel=37, chunk=1 << 24):
+    # One-shot conversion of a text capture, reading it a chunk at a time so multi-GB captures
+    # never have to fit in memory
+    with open(src, 'rb') as f, CaptureWriter(dst, sample_rate=sample_rate, frequency=frequency, channel=channel) as out:
+        while True:
+            text = f.read(chunk)
+            if not text:
+                break
+            samples = np.frombuffer(text, dtype=np.uint8)
+            samples = samples[(samples == ord('0')) | (samples == ord('1'))] - ord('0')
+            out.write_samples(samples)
+        return out.samples
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'convert':
+        samples = convert_text(sys.argv[2], sys.argv[3])
+        print("Wrote {} samples to {}".format(samples, sys.argv[3]))
+    elif sys.argv[1] == 'info':
+        with open(sys.argv[2], 'rb') as f:
+            header, _ = read_header(f)
+        print(header)
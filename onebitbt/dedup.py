@@ -0,0 +1,130 @@
+from nmigen import Elaboratable, Module, Signal, Array, Cat, Mux
+
+# Drops repeats of advertisements we've already sent out. Advertisers send the exact same PDU
+# every interval, so one chatty phone nearby fills the UART with identical packets and crowds out
+# everything else.
+#
+# Every packet gets hashed (CRC-32) as it comes in: the header, advertiser address, payload and
+# CRC, i.e. everything between the access address and the parser's CRC check. The lane hands over
+# the bits after dewhitening them, so the same PDU hashes the same on every channel the scan lane
+# (onebitbt.scan) hears it on.
+# The hashes of the last few distinct packets live in a small table, each with a time to live.
+# A packet whose hash is in the table (and hasn't expired) is suppressed and counted instead of
+# printed, anything else goes through and takes the least recently seen entry in the table. Seeing
+# a packet again doesn't refresh its time to live, so a device that never changes still shows up
+# once every ttl_ms.
+#
+# Only packets that passed their CRC check are ever suppressed, so in raw mode (where the parser
+# doesn't check CRCs) everything goes through.
+
+# CRC-32 (reflected), only used as a hash here
+POLY = 0xEDB88320
+
+class DedupFilter(Elaboratable):
+    # Goes between a parser and its printer (or PacketRing writer) and looks like the printer to
+    # the parser. Besides that it needs to see the same bits the parser does (sample and the
+    # dewhitened bitstream), `checked` pulsed when the parser checks the CRC (with crc_ok if it
+    # matched) and packet_done at the end of every packet.
+    def __init__(self, printer, entries=8, ttl_ms=1000, clock=25e6):
+        self.printer = printer
+        self.mem = printer.mem
+        self.entries = entries
+        self.ttl = ttl_ms
+        self.tick = int(clock/1000)
+
+        self.start = Signal()
+        self.done = Signal()
+        self.length = Signal(8)
+
+        self.sample = Signal()
+        self.bitstream = Signal()
+        self.checked = Signal()
+        self.crc_ok = Signal()
+        self.packet_done = Signal()
+
+        self.suppressed = Signal() # Pulses whenever a packet gets suppressed
+
+    def elaborate(self, platform):
+        m = Module()
+        n = self.entries
+
+        # Hash the packet until the CRC gets checked
+        hash = Signal(32, reset=0xFFFFFFFF)
+        checked = Signal()
+        valid = Signal()
+        with m.If(self.packet_done):
+            m.d.sync += [
+                hash.eq(hash.reset),
+                checked.eq(0),
+                valid.eq(0),
+            ]
+        with m.Elif(self.checked & ~checked):
+            m.d.sync += [
+                checked.eq(1),
+                valid.eq(self.crc_ok),
+            ]
+        with m.Elif(self.sample & ~checked):
+            m.d.sync += hash.eq((hash >> 1) ^ Mux(hash[0] ^ self.bitstream, POLY, 0))
+
+        # The table. life counts down the milliseconds an entry has left and rank is how
+        # recently it was seen (0 is the most recent), which starts out as any order.
+        keys = [Signal(32, name="key{}".format(i)) for i in range(n)]
+        life = [Signal(range(self.ttl + 1), name="life{}".format(i)) for i in range(n)]
+        rank = [Signal(range(n), name="rank{}".format(i), reset=i) for i in range(n)]
+
+        tick = Signal()
+        prescaler = Signal(range(self.tick))
+        m.d.sync += prescaler.eq(Mux(tick, 0, prescaler + 1))
+        m.d.comb += tick.eq(prescaler == self.tick - 1)
+        with m.If(tick):
+            for i in range(n):
+                with m.If(life[i] != 0):
+                    m.d.sync += life[i].eq(life[i] - 1)
+
+        hits = Cat(*[(keys[i] == hash) & (life[i] != 0) for i in range(n)])
+        hit = Signal(range(n))
+        victim = Signal(range(n))
+        # Prefer an expired entry over the least recently seen one. Going backwards so the
+        # lowest matching index wins.
+        for i in reversed(range(n)):
+            with m.If(hits[i]):
+                m.d.comb += hit.eq(i)
+        for i in reversed(range(n)):
+            with m.If(rank[i] == n - 1):
+                m.d.comb += victim.eq(i)
+        for i in reversed(range(n)):
+            with m.If(life[i] == 0):
+                m.d.comb += victim.eq(i)
+
+        def touch(index):
+            # Make entry index the most recently seen
+            current = Array(rank)[index]
+            for i in range(n):
+                with m.If(index == i):
+                    m.d.sync += rank[i].eq(0)
+                with m.Elif(rank[i] < current):
+                    m.d.sync += rank[i].eq(rank[i] + 1)
+
+        suppress = Signal()
+        skipped = Signal()
+        m.d.comb += [
+            suppress.eq(self.start & valid & hits.any()),
+            self.suppressed.eq(suppress),
+            self.printer.start.eq(self.start & ~suppress),
+            self.done.eq(self.printer.done | skipped),
+        ]
+        if hasattr(self.printer, 'length'):
+            m.d.comb += self.printer.length.eq(self.length)
+
+        # Like the printers, done follows start (a cycle later) when the packet is skipped
+        m.d.sync += skipped.eq(suppress)
+        with m.If(suppress):
+            touch(hit)
+        with m.Elif(self.start & valid):
+            m.d.sync += [
+                Array(keys)[victim].eq(hash),
+                Array(life)[victim].eq(self.ttl),
+            ]
+            touch(victim)
+
+        return m
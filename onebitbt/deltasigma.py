@@ -0,0 +1,249 @@
+import time
+import argparse
+
+import numpy as np
+
+from onebitbt import gmsk
+from onebitbt.ble import channel_frequency
+
+# Noise shaped (delta-sigma) 1-bit quantization for the transmit symbol tables (see
+# onebitbt.tables). Rounding a carrier to one bit spreads the quantization noise all over the
+# spectrum. A delta-sigma modulator feeds the quantization error back instead, so that the noise
+# ends up where the output filter gets rid of it. See the Delta Sigma section of
+# research/Transmission.ipynb, which does the same with pwm2 and pydsm.
+#
+# The noise transfer function (NTF) here is a monic FIR filter: the output is the input minus the
+# quantization error filtered by the NTF. pwm2 is the NTF 1 + k z^-1 + z^-2 (a notch at the
+# carrier). design_ntf picks one for a given output filter (a .s2p file or a traced CSV like the
+# ones in research/) by minimizing the noise that makes it through the filter, which is just a
+# linear prediction problem, while keeping the out of band gain low enough for a 1-bit quantizer
+# to stay stable.
+#
+# The modulator loop is inherently one sample at a time. Rather than run it over a whole training
+# sequence, every table entry is its own lane (with a few hundred samples to warm up on
+# beforehand) and all the lanes step together, so a whole table costs about as much as a symbol.
+#
+#   python -m onebitbt.deltasigma research/crysteksawfilter.s2p --channel 37 --h-inf 1.5,2
+
+# The 2.4GHz ISM band, everything outside of it is out of band emission
+BAND = (2400e6, 2483.5e6)
+
+# Bandwidth either side of the carrier that counts for the in-band SNR
+SIGNAL_BANDWIDTH = 1e6
+
+def resonator_ntf(frequency, sample_rate):
+    # pwm2 from the notebook
+    return [1.0, -2.0*np.cos(2*np.pi*frequency/sample_rate), 1.0]
+
+def shape(x, ntf, limit=100.0):
+    # Delta-sigma modulates every row of x (lanes, samples) to +-1 with the given NTF
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    lanes, n = x.shape
+    feedback = np.asarray(ntf[1:], dtype=np.float64)[::-1] # oldest error first
+    order = len(feedback)
+    # Samples along the first axis so every step works on contiguous rows
+    x = np.ascontiguousarray(x.T)
+    errors = np.zeros((n + order, lanes))
+    out = np.empty((n, lanes))
+    v = np.empty(lanes)
+    for i in range(n):
+        np.subtract(x[i], feedback @ errors[i:i + order], out=v)
+        np.copysign(1.0, v, out=out[i])
+        np.subtract(v, out[i], out=errors[i + order])
+    if not np.max(np.abs(errors)) <= limit:
+        raise ValueError("Modulator went unstable, try an NTF with less out of band gain")
+    return out.T
+
+def quantize(sig, frequency, sample_rate, ntf):
+    return shape(sig, ntf)
+
+def quantize_resonator(sig, frequency, sample_rate):
+    return shape(sig, resonator_ntf(frequency, sample_rate))
+
+def pwm2_reference(sig, k=1.0):
+    # pwm2 from research/Transmission.ipynb, only here to benchmark against
+    z1 = 0.0
+    z2 = 0.0
+    out = np.zeros((len(sig,)))
+    for i in range(len(sig)):
+        v = sig[i] - (k*z1 + z2)
+        out[i] = np.sign(v)
+        z2 = z1
+        z1 = v - out[i]
+    return out
+
+def read_touchstone(path):
+    # Frequencies (Hz) and S21 from a 2-port Touchstone (v1) file
+    scale = {'HZ': 1.0, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9}
+    unit, fmt = 'GHZ', 'MA'
+    rows = []
+    for line in open(path):
+        line = line.split('!')[0].strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            options = line[1:].upper().split()
+            unit = next((o for o in options if o in scale), unit)
+            fmt = next((o for o in options if o in ('RI', 'MA', 'DB')), fmt)
+            continue
+        rows.append([float(v) for v in line.split()])
+    rows = np.array(rows)
+    a, b = rows[:, 3], rows[:, 4] # S21
+    if fmt == 'RI':
+        s21 = a + 1j*b
+    elif fmt == 'MA':
+        s21 = a*np.exp(1j*np.radians(b))
+    else:
+        s21 = 10**(a/20)*np.exp(1j*np.radians(b))
+    return rows[:, 0]*scale[unit], s21
+
+def read_traced(path):
+    # `MHz, attenuation (dB)` pairs traced off a datasheet plot (see the notebook), no phase
+    rows = np.loadtxt(path, delimiter=',', ndmin=2)
+    order = np.argsort(rows[:, 0])
+    return rows[order, 0]*1e6, 10**(-rows[order, 1]/20)
+
+def read_filter(path):
+    if path.lower().endswith('.csv'):
+        return read_traced(path)
+    return read_touchstone(path)
+
+def filter_power(response, freqs):
+    # |H(f)|^2 at any (analog) frequency, holding the edge values beyond the measured range
+    f, h = response
+    return np.interp(np.abs(freqs), f, np.abs(h)**2)
+
+def noise_weight(response, sample_rate, n=4096, images=3):
+    # How much of the noise at each digital frequency (n bins over [0, sample_rate)) makes it out
+    # of the filter: the SERDES's zero order hold puts copies at every k*sample_rate +- f.
+    f = np.arange(n)*sample_rate/n
+    weight = np.zeros(n)
+    for k in range(images):
+        for image in (k*sample_rate + f, (k + 1)*sample_rate - f):
+            weight += filter_power(response, image)*np.sinc(image/sample_rate)**2
+    return weight
+
+def ntf_gain(ntf, n=4096):
+    # Peak NTF gain, i.e. the H_inf in the notebook (as a ratio, not dB)
+    return np.max(np.abs(np.fft.rfft(ntf, 2*n)))
+
+def prediction_ntf(weight, order, floor=0.0):
+    # The monic FIR of the given order minimizing the weighted noise power, with `floor` (relative
+    # to the average weight) added everywhere. That's the linear prediction error filter for
+    # the autocorrelation the weight implies, which is minimum phase.
+    from scipy.linalg import solve_toeplitz
+    r = np.fft.irfft(weight[:len(weight)//2 + 1], len(weight))[:order + 1]
+    r[0] += floor*r[0]
+    return np.concatenate(([1.0], solve_toeplitz(r[:order], -r[1:order + 1])))
+
+def design_ntf(response, sample_rate, order=32, h_inf=1.5, steps=40):
+    # Raises the noise floor in the weighting until the NTF's out of band gain is below h_inf
+    weight = noise_weight(response, sample_rate)
+    ntf = prediction_ntf(weight, order)
+    if ntf_gain(ntf) <= h_inf:
+        return ntf
+    low, high = 0.0, 1.0
+    while ntf_gain(prediction_ntf(weight, order, high)) > h_inf:
+        low, high = high, high*10
+        if high > 1e12:
+            raise ValueError("Can't get the NTF gain down to {}".format(h_inf))
+    for _ in range(steps):
+        middle = (low + high)/2
+        if ntf_gain(prediction_ntf(weight, order, middle)) > h_inf:
+            low = middle
+        else:
+            high = middle
+    return prediction_ntf(weight, order, high)
+
+def play(table, bits):
+    # The 1-bit waveform for on-air bits played out of a (full) symbol table
+    from onebitbt.symbols import encode
+    return np.concatenate([table[symbol] for symbol in encode(bits)])
+
+def evaluate(table, channel, sample_rate=5e9, response=None, bits=None, resolution=1e6):
+    # In-band SNR and out of band emission of a table, from playing a PRBS through it. The noise is
+    # the difference from the ideal modulation of the same bits, with the best (complex) gain
+    # fitted over the signal bandwidth, so the GMSK signal's own skirt doesn't count as emission.
+    # Emission is the noise after the zero order hold and the output filter (if any) over the
+    # first two Nyquist zones, in `resolution` bins, relative to the strongest signal bin (peak)
+    # and the total signal power (total).
+    bits = np.array(gmsk.prbs9() if bits is None else bits)
+    frequency = channel_frequency(channel)
+    sig = play(table, bits)
+    ideal = gmsk.modulate(bits, frequency=frequency, sample_rate=sample_rate)
+
+    freqs = np.fft.rfftfreq(len(sig), 1/sample_rate)
+    y = np.fft.rfft(sig)
+    x = np.fft.rfft(ideal)
+    band = np.abs(freqs - frequency) <= SIGNAL_BANDWIDTH
+    gain = np.vdot(x[band], y[band])/np.vdot(x[band], x[band])
+    signal = np.abs(gain*x)**2
+    noise = np.abs(y - gain*x)**2
+    snr = 10*np.log10(np.sum(signal[band])/np.sum(noise[band]))
+
+    # Mirror into the second zone and sum into resolution sized bins
+    analog = np.concatenate((freqs, sample_rate - freqs[::-1]))
+    weight = np.sinc(analog/sample_rate)**2
+    if response is not None:
+        weight = weight*filter_power(response, analog)
+    bins = (analog//resolution).astype(np.int64)
+    signal = np.bincount(bins, np.concatenate((signal, signal[::-1]))*weight)
+    noise = np.bincount(bins, np.concatenate((noise, noise[::-1]))*weight)
+    centers = (np.arange(len(noise)) + 0.5)*resolution
+    outside = (centers < BAND[0]) | (centers > BAND[1])
+    return {
+        'snr_db': snr,
+        'oob_peak_dbc': 10*np.log10(np.max(noise[outside])/np.max(signal)),
+        'oob_total_dbc': 10*np.log10(np.sum(noise[outside])/np.sum(signal)),
+    }
+
+def benchmark(channel=37, sample_rate=5e9):
+    # Time to quantize a whole table with pwm2: the notebook loop over the training sequence for
+    # every quadrant vs tables.generate
+    from onebitbt import tables
+    frequency = channel_frequency(channel)
+    k = resonator_ntf(frequency, sample_rate)[1]
+    start = time.time()
+    for quadrant in range(4):
+        sig = gmsk.modulate(1 - np.array(tables.SEQUENCE), frequency=frequency, sample_rate=sample_rate,
+            phase=-quadrant*np.pi/2)
+        pwm2_reference(sig, k)
+    reference = time.time() - start
+    start = time.time()
+    tables.generate(frequency, sample_rate, 'pwm2')
+    return reference, time.time() - start
+
+if __name__ == '__main__':
+    from onebitbt import tables
+
+    parser = argparse.ArgumentParser(description="Compare noise shaping for the transmit symbol tables")
+    parser.add_argument('filter', nargs='?', help=".s2p or traced .csv of the output filter")
+    parser.add_argument('--channel', type=int, default=37)
+    parser.add_argument('--rate', type=float, default=5e9, help="SERDES line rate")
+    parser.add_argument('--order', type=int, default=32, help="NTF order")
+    parser.add_argument('--h-inf', default='1.5', help="comma separated NTF gain limits to try")
+    parser.add_argument('--benchmark', action='store_true', help="time against the notebook's pwm2 loop")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        reference, ours = benchmark(args.channel, args.rate)
+        print("Notebook pwm2: {:.2f}s, tables.generate: {:.2f}s ({:.0f}x)".format(reference, ours, reference/ours))
+
+    response = read_filter(args.filter) if args.filter else None
+    candidates = [('sign', {}), ('pwm2', {})]
+    if response is not None:
+        for h_inf in args.h_inf.split(','):
+            ntf = design_ntf(response, args.rate, args.order, float(h_inf))
+            candidates.append(('dsm', {'ntf': [float(c) for c in ntf]}))
+
+    print("{:<24} {:>8} {:>12} {:>13} {:>8}".format("quantizer", "SNR", "OOB peak", "OOB total", "time"))
+    for quantizer, options in candidates:
+        start = time.time()
+        table = tables.expand(tables.load(args.channel, args.rate, quantizer, **options))
+        elapsed = time.time() - start
+        name = quantizer
+        if 'ntf' in options:
+            name = "dsm (order {}, H_inf {:.2f})".format(len(options['ntf']) - 1, ntf_gain(options['ntf']))
+        result = evaluate(table, args.channel, args.rate, response)
+        print("{:<24} {:>6.1f}dB {:>9.1f}dBc {:>10.1f}dBc {:>7.2f}s".format(
+            name, result['snr_db'], result['oob_peak_dbc'], result['oob_total_dbc'], elapsed))
@@ -0,0 +1,244 @@
+import math
+
+from nmigen import Elaboratable, Module, Signal, Mux, Array, Const, signed
+
+from alldigitalradio.mixer import SummingMixer
+from alldigitalradio.filter import RunningBoxcarFilter
+from alldigitalradio.trig import MagnitudeApproximator
+
+from onebitbt.ble import CHANNELS, channel_frequency
+from onebitbt.mixer import NCOMixer, phase_increment
+
+def settle_words(demodulator, width=64, lag=16, iterations=12):
+    # rx cycles for everything after the mixers to flush out what came before a retune: the
+    # boxcar filters plus the magnitude and compare registers (fsk) or the CORDIC, delay line and
+    # diff register (phase)
+    if demodulator == 'fsk':
+        return 4*(width + 2)
+    return 4*(width + iterations + 1 + lag + 1)
+
+class Retunable:
+    # Shared by the demodulators: with retunable=True their mixers are NCOMixers and pulsing
+    # retune (in sync) moves them to the BLE channel in `channel`. tuned is low from then until
+    # the filters only hold samples from the new channel.
+    def make_mixer(self, offset):
+        if not self.retunable:
+            return SummingMixer(sample_rate=self.sample_rate, frequency=self.frequency + offset, max_error=0.0001, domain="rx")
+        mixer = NCOMixer(sample_rate=self.sample_rate, frequency=self.frequency + offset, settle=self.settle_words, domain="rx")
+        self.mixers.append((mixer, offset))
+        return mixer
+
+    def connect_mixers(self, m):
+        m.d.comb += self.tuned.eq(1)
+        if not self.retunable:
+            return
+        for mixer, offset in self.mixers:
+            increments = Array(Const(phase_increment(channel_frequency(channel) + offset, self.sample_rate), len(mixer.increment))
+                for channel in range(CHANNELS))
+            with m.If(self.retune):
+                m.d.sync += mixer.increment.eq(increments[self.channel])
+            m.d.comb += mixer.retune.eq(self.retune)
+            with m.If(~mixer.tuned):
+                m.d.comb += self.tuned.eq(0)
+
+class FSKDemodulator(Retunable, Elaboratable):
+    # Demodulates GMSK as if it were FSK: mix the 20-bit wide SERDES words down with two
+    # one bit oscillators (one above and one below the carrier), low pass filter and then
+    # compare the magnitudes of the two tones.
+    #
+    # Expects an "rx" domain (the SERDES word clock), an "rxdiv4" domain (rx/4) and a
+    # regular sync domain which the baseband bit is registered into.
+    def __init__(self, sample_rate=5e9, frequency=2.402e9, deviation=250e3, width=64, retunable=False):
+        self.sample_rate = sample_rate
+        self.frequency = frequency
+        self.deviation = deviation
+        self.width = width
+        self.retunable = retunable
+        self.mixers = []
+        self.settle_words = settle_words('fsk', width)
+        self.channel = Signal(range(CHANNELS))
+        self.retune = Signal()
+        self.tuned = Signal()
+
+        self.input = Signal(20)
+        self.diff = Signal(signed(32))
+        self.baseband = Signal()
+        self.strength = Signal(16) # Magnitude of the stronger tone, a rough signal strength
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Mix the incoming data down to BB
+        m.submodules.mixerHigh = mixerHigh = self.make_mixer(self.deviation)
+        m.submodules.mixerLow = mixerLow = self.make_mixer(-self.deviation)
+        self.connect_mixers(m)
+        m.d.comb += [
+            mixerHigh.input.eq(self.input),
+            mixerLow.input.eq(self.input)
+        ]
+
+        # Now add low pass filters on the outputs
+        width = self.width
+        m.submodules.lpfHighI = lpfHighI = RunningBoxcarFilter(width, domain="rxdiv4")
+        m.submodules.lpfHighQ = lpfHighQ = RunningBoxcarFilter(width, domain="rxdiv4")
+        m.submodules.lpfLowI = lpfLowI = RunningBoxcarFilter(width, domain="rxdiv4")
+        m.submodules.lpfLowQ = lpfLowQ = RunningBoxcarFilter(width, domain="rxdiv4")
+        m.d.comb += [
+            lpfHighI.input.eq(mixerHigh.outputIsum),
+            lpfHighQ.input.eq(mixerHigh.outputQsum),
+            lpfLowI.input.eq(mixerLow.outputIsum),
+            lpfLowQ.input.eq(mixerLow.outputQsum),
+        ]
+
+        # Next compute the magnitude of the low-pass-filtered I and Q
+        # These are fully combinatoric so don't need a domain specified
+        m.submodules.highMag = highMag = MagnitudeApproximator()
+        m.submodules.lowMag = lowMag = MagnitudeApproximator()
+        m.d.comb += [
+            highMag.inputI.eq(lpfHighI.output),
+            highMag.inputQ.eq(lpfHighQ.output),
+            lowMag.inputI.eq(lpfLowI.output),
+            lowMag.inputQ.eq(lpfLowQ.output),
+        ]
+
+        # Finally, compare the two magnitudes
+        # (We need to pipeline this a bit to meet timing)
+        m.d.rxdiv4 += self.diff.eq(highMag.magnitude - lowMag.magnitude)
+        m.d.sync += self.baseband.eq(self.diff > 0)
+
+        strength = Signal(16)
+        with m.If(highMag.magnitude > lowMag.magnitude):
+            m.d.rxdiv4 += strength.eq(highMag.magnitude)
+        with m.Else():
+            m.d.rxdiv4 += strength.eq(lowMag.magnitude)
+        m.d.sync += self.strength.eq(strength)
+
+        return m
+
+class Cordic(Elaboratable):
+    # Pipelined vectoring CORDIC: rotates (inputI, inputQ) onto the positive I axis one
+    # iteration per cycle, accumulating the angle it took. phase is the angle as a fraction of a
+    # full turn (0 to 2**phase_bits - 1, so it wraps around just like the angle does) and
+    # magnitude is the length of the vector times ~1.65. Both come out iterations + 1 cycles
+    # after the input.
+    def __init__(self, width=18, iterations=12, phase_bits=16, domain="sync"):
+        self.width = width
+        self.iterations = iterations
+        self.phase_bits = phase_bits
+        self.domain = domain
+
+        self.inputI = Signal(signed(width))
+        self.inputQ = Signal(signed(width))
+        self.phase = Signal(phase_bits)
+        self.magnitude = Signal(width)
+
+    def elaborate(self, platform):
+        m = Module()
+        domain = m.d[self.domain]
+        angles = [int(round(math.atan(2.0**-i)/(2*math.pi)*(1 << self.phase_bits))) for i in range(self.iterations)]
+
+        # One extra bit for the CORDIC gain
+        xs = [Signal(signed(self.width + 1), name="x{}".format(i)) for i in range(self.iterations + 1)]
+        ys = [Signal(signed(self.width + 1), name="y{}".format(i)) for i in range(self.iterations + 1)]
+        zs = [Signal(self.phase_bits, name="z{}".format(i)) for i in range(self.iterations + 1)]
+
+        # CORDIC only converges within +-90 degrees, so start by rotating the left half plane
+        # round by 180 degrees
+        flip = self.inputI < 0
+        domain += [
+            xs[0].eq(Mux(flip, -self.inputI, self.inputI)),
+            ys[0].eq(Mux(flip, -self.inputQ, self.inputQ)),
+            zs[0].eq(Mux(flip, 1 << (self.phase_bits - 1), 0)),
+        ]
+
+        for i, angle in enumerate(angles):
+            x, y, z = xs[i], ys[i], zs[i]
+            with m.If(y >= 0):
+                domain += [
+                    xs[i + 1].eq(x + (y >> i)),
+                    ys[i + 1].eq(y - (x >> i)),
+                    zs[i + 1].eq(z + angle),
+                ]
+            with m.Else():
+                domain += [
+                    xs[i + 1].eq(x - (y >> i)),
+                    ys[i + 1].eq(y + (x >> i)),
+                    zs[i + 1].eq(z - angle),
+                ]
+
+        m.d.comb += [
+            self.phase.eq(zs[-1]),
+            self.magnitude.eq(xs[-1]),
+        ]
+
+        return m
+
+class PhaseDemodulator(Retunable, Elaboratable):
+    # Alternative to FSKDemodulator that demodulates GMSK properly, by its phase: one mixer
+    # right at the carrier, low pass filter, CORDIC to get the phase of I/Q and then look at
+    # which way the phase moved over the last `lag` rxdiv4 samples. The deviation only turns
+    # the phase ~0.025 radians per rxdiv4 sample, hence comparing against a delayed copy rather
+    # than the previous sample.
+    #
+    # Same domains and outputs as FSKDemodulator, so the two are interchangeable.
+    def __init__(self, sample_rate=5e9, frequency=2.402e9, deviation=250e3, width=64, lag=16, iterations=12, phase_bits=16,
+            retunable=False):
+        self.sample_rate = sample_rate
+        self.frequency = frequency
+        self.deviation = deviation
+        self.width = width
+        self.lag = lag
+        self.iterations = iterations
+        self.phase_bits = phase_bits
+        self.retunable = retunable
+        self.mixers = []
+        self.settle_words = settle_words('phase', width, lag, iterations)
+        self.channel = Signal(range(CHANNELS))
+        self.retune = Signal()
+        self.tuned = Signal()
+
+        self.input = Signal(20)
+        self.diff = Signal(signed(phase_bits))
+        self.baseband = Signal()
+        self.strength = Signal(16) # CORDIC magnitude of the filtered signal
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.mixer = mixer = self.make_mixer(0)
+        self.connect_mixers(m)
+        m.d.comb += mixer.input.eq(self.input)
+
+        m.submodules.lpfI = lpfI = RunningBoxcarFilter(self.width, domain="rxdiv4")
+        m.submodules.lpfQ = lpfQ = RunningBoxcarFilter(self.width, domain="rxdiv4")
+        m.d.comb += [
+            lpfI.input.eq(mixer.outputIsum),
+            lpfQ.input.eq(mixer.outputQsum),
+        ]
+
+        m.submodules.cordic = cordic = Cordic(iterations=self.iterations, phase_bits=self.phase_bits, domain="rxdiv4")
+        m.d.comb += [
+            cordic.inputI.eq(lpfI.output),
+            cordic.inputQ.eq(lpfQ.output),
+        ]
+
+        # Delay line of past phases
+        delayed = [Signal(self.phase_bits, name="phase{}".format(i)) for i in range(self.lag)]
+        m.d.rxdiv4 += delayed[0].eq(cordic.phase)
+        for previous, current in zip(delayed, delayed[1:]):
+            m.d.rxdiv4 += current.eq(previous)
+
+        # A tone above the carrier shows up as the phase going backwards. Truncating the
+        # difference to phase_bits takes care of wrapping around.
+        m.d.rxdiv4 += self.diff.eq((delayed[-1] - cordic.phase)[:self.phase_bits])
+        m.d.sync += [
+            self.baseband.eq(self.diff > 0),
+            self.strength.eq(cordic.magnitude),
+        ]
+
+        return m
+
+DEMODULATORS = {
+    'fsk': FSKDemodulator,
+    'phase': PhaseDemodulator,
+}
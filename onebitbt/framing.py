@@ -0,0 +1,253 @@
+from nmigen import Elaboratable, Module, Signal, Array, Const, Memory
+
+# A tiny framing layer for getting binary data from the gateware to a host over a UART. Every frame
+# looks like:
+#
+#   0xA5 0x5A  type  length  payload (length bytes)  checksum
+#
+# where the checksum is picked so that type + length + payload + checksum is 0 (mod 256). The
+# sync word lets the host find frame boundaries in the middle of a stream (or after garbage) and
+# the checksum lets it throw away frames that got mangled on the way. The same framing is used
+# for commands going the other way (see FrameReceiver).
+
+SYNC = (0xA5, 0x5A)
+
+# Frame types
+FRAME_RAW = 0x01 # channel, then the raw (still whitened) bits following the access address
+FRAME_RECORD = 0x02 # a packet record, see below
+FRAME_STATS = 0x03 # a snapshot of the performance counters, see onebitbt.stats
+
+# Packet records (FRAME_RECORD) are a fixed header followed by the dewhitened PDU (header and
+# payload, the advertiser address is the first 6 bytes of the payload):
+#
+#   channel    1 byte
+#   flags      1 byte   bit 0: CRC matched, bits 1-7: carrier offset estimate (signed, in 5kHz steps,
+#                       0 unless the lane has an offset bank, see onebitbt.bank)
+#   timestamp  4 bytes  sync (25MHz) cycles when the first bit after the access address arrived
+#   strength   2 bytes  peak demodulator magnitude over the packet
+#   pdu        2 + length bytes
+#
+# All multi-byte fields are little endian.
+RECORD_HEADER = 8
+RECORD_CRC_OK = 0x01
+RECORD_OFFSET_SHIFT = 1
+RECORD_OFFSET_STEP = 5e3
+
+class FramePrinter(Elaboratable):
+    # Same interface as the serialcommander printers (so it can sit behind a PrinterArbiter), but
+    # sends the first `length` bytes of mem as a frame rather than as text. length is sampled when
+    # start goes high.
+    def __init__(self, mem, frame_type):
+        self.mem = mem
+        self.frame_type = frame_type
+        self.length = Signal(8)
+        self.start = Signal()
+        self.done = Signal()
+        self.tx_data = Signal(8)
+        self.tx_rdy = Signal()
+        self.tx_ack = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.rport = rport = self.mem.read_port()
+
+        length = Signal(8)
+        header = Array([Const(SYNC[0], 8), Const(SYNC[1], 8), Const(self.frame_type, 8), length])
+        header_idx = Signal(2)
+
+        idx = Signal(8)
+        valid = Signal() # rport.data is showing mem[idx]
+        checksum = Signal(8)
+
+        m.d.comb += rport.addr.eq(idx)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        length.eq(self.length),
+                        header_idx.eq(0),
+                        idx.eq(0),
+                        valid.eq(0),
+                        checksum.eq(0),
+                    ]
+                    m.next = "HEADER"
+
+            with m.State("HEADER"):
+                m.d.comb += [
+                    self.tx_data.eq(header[header_idx]),
+                    self.tx_rdy.eq(1),
+                ]
+                with m.If(self.tx_ack):
+                    m.d.sync += header_idx.eq(header_idx + 1)
+                    # The sync word doesn't count towards the checksum
+                    with m.If(header_idx >= 2):
+                        m.d.sync += checksum.eq(checksum + header[header_idx])
+                    with m.If(header_idx == 3):
+                        with m.If(length == 0):
+                            m.next = "CHECKSUM"
+                        with m.Else():
+                            m.next = "PAYLOAD"
+
+            with m.State("PAYLOAD"):
+                # The read port takes a cycle to catch up every time idx moves
+                m.d.sync += valid.eq(1)
+                m.d.comb += [
+                    self.tx_data.eq(rport.data),
+                    self.tx_rdy.eq(valid),
+                ]
+                with m.If(valid & self.tx_ack):
+                    m.d.sync += [
+                        idx.eq(idx + 1),
+                        valid.eq(0),
+                        checksum.eq(checksum + rport.data),
+                    ]
+                    with m.If(idx == length - 1):
+                        m.next = "CHECKSUM"
+
+            with m.State("CHECKSUM"):
+                m.d.comb += [
+                    self.tx_data.eq(-checksum),
+                    self.tx_rdy.eq(1),
+                ]
+                with m.If(self.tx_ack):
+                    m.d.comb += self.done.eq(1)
+                    m.next = "IDLE"
+
+        return m
+
+class FrameReceiver(Elaboratable):
+    # The gateware end of frames coming from the host. Hand it every byte off the UART (pulse
+    # strobe with data) and once a frame with a good checksum is in, valid pulses for a cycle
+    # with frame_type and length set and the payload in mem. The first few payload bytes are
+    # also kept in header, for frames that are just a couple of arguments. mem gets
+    # overwritten by the next frame, so whatever handles valid needs to be done with it by
+    # then (a few byte times).
+    def __init__(self, depth=256, header_bytes=3):
+        self.mem = Memory(width=8, depth=depth)
+        self.data = Signal(8)
+        self.strobe = Signal()
+        self.valid = Signal()
+        self.frame_type = Signal(8)
+        self.length = Signal(8)
+        self.header = Signal(8*header_bytes)
+        self.errors = Signal(16) # frames thrown away for a bad checksum
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.wport = wport = self.mem.write_port()
+
+        header_bytes = len(self.header)//8
+        header = Array(self.header[i:i + 8] for i in range(0, len(self.header), 8))
+        idx = Signal(8)
+        checksum = Signal(8)
+
+        m.d.comb += [
+            wport.addr.eq(idx),
+            wport.data.eq(self.data),
+        ]
+
+        with m.FSM():
+            with m.State("SYNC0"):
+                with m.If(self.strobe & (self.data == SYNC[0])):
+                    m.next = "SYNC1"
+
+            with m.State("SYNC1"):
+                with m.If(self.strobe):
+                    with m.If(self.data == SYNC[1]):
+                        m.next = "TYPE"
+                    with m.Elif(self.data != SYNC[0]):
+                        m.next = "SYNC0"
+
+            with m.State("TYPE"):
+                with m.If(self.strobe):
+                    m.d.sync += [
+                        self.frame_type.eq(self.data),
+                        checksum.eq(self.data),
+                    ]
+                    m.next = "LENGTH"
+
+            with m.State("LENGTH"):
+                with m.If(self.strobe):
+                    m.d.sync += [
+                        self.length.eq(self.data),
+                        checksum.eq(checksum + self.data),
+                        idx.eq(0),
+                    ]
+                    with m.If(self.data == 0):
+                        m.next = "CHECKSUM"
+                    with m.Else():
+                        m.next = "PAYLOAD"
+
+            with m.State("PAYLOAD"):
+                with m.If(self.strobe):
+                    m.d.comb += wport.en.eq(1)
+                    m.d.sync += [
+                        idx.eq(idx + 1),
+                        checksum.eq(checksum + self.data),
+                    ]
+                    with m.If(idx < header_bytes):
+                        m.d.sync += header[idx].eq(self.data)
+                    with m.If(idx == self.length - 1):
+                        m.next = "CHECKSUM"
+
+            with m.State("CHECKSUM"):
+                with m.If(self.strobe):
+                    with m.If((checksum + self.data)[:8] == 0):
+                        m.d.sync += self.valid.eq(1)
+                    with m.Else():
+                        m.d.sync += self.errors.eq(self.errors + 1)
+                    m.next = "SYNC0"
+
+        with m.If(self.valid):
+            m.d.sync += self.valid.eq(0)
+
+        return m
+
+def encode_frame(frame_type, payload):
+    # Host side equivalent of FramePrinter, handy for testing decoders
+    payload = bytes(payload)
+    body = bytes([frame_type, len(payload)]) + payload
+    return bytes(SYNC) + body + bytes([-sum(body) & 0xFF])
+
+class FrameDecoder:
+    # Streaming decoder for the frames above. Feed it whatever comes off the serial port (in
+    # whatever sized chunks) and it hands back (type, payload) for every good frame. Bad frames
+    # are counted and skipped by looking for the next sync word.
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+        self.errors = 0
+        self.skipped = 0 # bytes thrown away while hunting for a sync word
+
+    def feed(self, data):
+        self.buffer += data
+        out = []
+        while True:
+            start = self.buffer.find(bytes(SYNC))
+            if start < 0:
+                # Keep a trailing first sync byte around, the second might be in the next chunk
+                keep = 1 if self.buffer[-1:] == bytes(SYNC[:1]) else 0
+                self.skipped += len(self.buffer) - keep
+                del self.buffer[:len(self.buffer) - keep]
+                return out
+            self.skipped += start
+            del self.buffer[:start]
+
+            if len(self.buffer) < 4:
+                return out
+            length = self.buffer[3]
+            if len(self.buffer) < 5 + length:
+                return out
+
+            body = self.buffer[2:5 + length]
+            if sum(body) & 0xFF:
+                # Corrupt, so this probably wasn't really a sync word. Look for the next one.
+                self.errors += 1
+                self.skipped += 1
+                del self.buffer[:1]
+                continue
+
+            out.append((body[0], bytes(body[2:-1])))
+            self.frames += 1
+            del self.buffer[:5 + length]
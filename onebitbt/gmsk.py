@@ -0,0 +1,167 @@
+import sys
+import time
+import functools
+
+import numpy as np
+
+from onebitbt.ble import channel_frequency
+
+# GMSK waveforms for testing the receiver and building transmit symbol tables, without the per
+# sample Python loop from the notebooks (which takes seconds per packet at 5GSPS).
+#
+# The frequency deviation of a GMSK signal is the bits (as +-1) convolved with a rectangle one
+# symbol long and then with a Gaussian. Rather than doing that convolution at the sample rate,
+# we do it once for a single symbol (frequency_pulse) and then overlap-add a scaled copy of that
+# for every symbol, one symbol-sized slice of the pulse at a time. The phase is just the cumulative
+# sum of the deviation, and the whole thing is generated in chunks of symbols (carrying the phase
+# across) so arbitrarily long bit streams don't need arbitrarily much memory.
+#
+# A one is +250kHz, as per the spec (+500kHz with symbol_rate=2e6 for the LE 2M PHY, the
+# modulation index is the same). Note the notebooks' modulate_gmsk has it the other way round
+# (they invert the bits before encoding), so modulate(bits) matches the notebook's
+# modulate_gmsk(1 - bits). Run `python -m onebitbt.gmsk check` to compare against it.
+
+SYMBOL_RATE = 1e6
+BT = 0.5
+
+def samples_per_symbol(sample_rate, symbol_rate=SYMBOL_RATE):
+    sps = sample_rate/symbol_rate
+    if abs(sps - round(sps)) > 1e-6:
+        raise ValueError("Sample rate {} isn't a whole number of samples per symbol".format(sample_rate))
+    return int(round(sps))
+
+def gaussian_kernel(sample_rate=5e9, bt=BT, symbol_rate=SYMBOL_RATE):
+    # Same kernel as the notebooks (two symbols long)
+    sps = samples_per_symbol(sample_rate, symbol_rate)
+    bw = bt/sps
+    t = np.arange(-sps, sps)
+    kernel = np.exp(-(2/np.log(2))*np.power(np.pi*t*bw, 2))
+    return kernel/kernel.sum()
+
+@functools.lru_cache()
+def frequency_pulse(sample_rate=5e9, bt=BT, symbol_rate=SYMBOL_RATE):
+    # The deviation (as a fraction of the full deviation) a single +1 symbol contributes, as
+    # (3, samples_per_symbol): the symbol before, the symbol itself and the one after
+    sps = samples_per_symbol(sample_rate, symbol_rate)
+    kernel = gaussian_kernel(sample_rate, bt, symbol_rate)
+    n = 1 << int(np.ceil(np.log2(sps + len(kernel))))
+    pulse = np.fft.irfft(np.fft.rfft(np.ones(sps), n)*np.fft.rfft(kernel, n), n)[:sps + len(kernel) - 1]
+
+    # The notebooks' np.convolve(..., mode='same') lags by a sample
+    pulse = np.concatenate(([0], pulse))
+    return pulse.reshape(3, sps)
+
+def iter_phase(bits, sample_rate=5e9, phase=0.0, bt=BT, chunk=256, symbol_rate=SYMBOL_RATE):
+    # The baseband phase (radians) for every sample of bits, in chunks of `chunk` symbols.
+    # Symbols outside of bits count as no deviation at all, like in the notebooks.
+    bits = np.asarray(bits)
+    sps = samples_per_symbol(sample_rate, symbol_rate)
+    pulse = frequency_pulse(sample_rate, bt, symbol_rate)
+    symbols = np.concatenate(([0.0], bits*2.0 - 1.0, [0.0]))
+    per_sample = (np.pi/2)/sps
+
+    for start in range(0, len(bits), chunk):
+        end = min(start + chunk, len(bits))
+        # Symbol m gets the tail of m - 1, its own pulse and the head of m + 1
+        rotation = (np.outer(symbols[start + 2:end + 2], pulse[0]) +
+                    np.outer(symbols[start + 1:end + 1], pulse[1]) +
+                    np.outer(symbols[start:end], pulse[2])).ravel()
+        angle = phase + np.cumsum(rotation)*per_sample
+        phase = angle[-1] % (2*np.pi)
+        yield angle
+
+def add_noise(sig, snr_db, rng=None, power=0.5):
+    # AWGN over the whole sampled bandwidth, relative to a signal of the given power
+    rng = rng if rng is not None else np.random.default_rng()
+    return sig + rng.standard_normal(len(sig))*np.sqrt(power*10**(-snr_db/10))
+
+def iter_modulate(bits, frequency=2.402e9, sample_rate=5e9, phase=0.0, channel=None, amplitude=1.0,
+        snr_db=None, rng=None, one_bit=False, bt=BT, chunk=256, symbol_rate=SYMBOL_RATE):
+    # The real passband signal, in chunks of `chunk` symbols. With snr_db noise is added, and
+    # with one_bit the result is quantized to +-1 (as int8) like the SERDES would.
+    if channel is not None:
+        frequency = channel_frequency(channel)
+    step = (frequency/sample_rate) % 1 # carrier cycles per sample
+    offset = 0 # carrier cycles at the start of this chunk
+    for angle in iter_phase(bits, sample_rate, phase, bt, chunk, symbol_rate):
+        carrier = 2*np.pi*(offset + step*np.arange(len(angle)))
+        offset = (offset + step*len(angle)) % 1
+        sig = amplitude*np.cos(carrier + angle)
+        if snr_db is not None:
+            sig = add_noise(sig, snr_db, rng, power=amplitude*amplitude/2)
+        if one_bit:
+            sig = np.where(sig > 0, 1, -1).astype(np.int8)
+        yield sig
+
+def modulate(bits, **kwargs):
+    # All of iter_modulate at once
+    chunks = list(iter_modulate(bits, **kwargs))
+    return np.concatenate(chunks) if chunks else np.zeros(0)
+
+def baseband(bits, sample_rate=5e9, phase=0.0, bt=BT, symbol_rate=SYMBOL_RATE):
+    # Complex baseband (unit amplitude)
+    chunks = list(iter_phase(bits, sample_rate, phase, bt, symbol_rate=symbol_rate))
+    return np.exp(1j*np.concatenate(chunks)) if chunks else np.zeros(0, dtype=np.complex128)
+
+def prbs(n=0, taps=[]):
+    # Straight from the notebooks
+    state = [1]*n
+    shift = lambda s: [sum([s[i] for i in taps]) % 2] + s[0:-1]
+    out = []
+    for i in range(2**n - 1):
+        out.append(state[-1])
+        state = shift(state)
+    return out
+
+def prbs9():
+    return prbs(n=9, taps=[4, 8])
+
+def modulate_reference(bits, carrier_freq=2.402e9, sample_rate=5e9, phase_offset=0):
+    # modulate_gmsk from research/Transmission.ipynb, loop and all. Only here to check against.
+    symbol_rate = 1e6
+    bw = symbol_rate*BT/sample_rate
+    sps = int(sample_rate/symbol_rate)
+    kernel = np.array([(np.sqrt(2*np.pi/np.log(2))*bw)*np.exp(-(2/np.log(2))*np.power(np.pi*t*bw, 2)) for t in range(-sps, sps)])
+    kernel /= sum(kernel)
+
+    rotation = np.repeat(bits, sps)*2.0 - 1.0
+    smoothed_rotation = np.convolve(rotation, kernel, mode='same')
+
+    angle_per_sample = (np.pi/2.0)/sps
+    current_angle = phase_offset
+    modulated = np.zeros((len(smoothed_rotation),), dtype=np.complex64)
+    for i, bit in enumerate(smoothed_rotation):
+        current_angle += angle_per_sample*bit
+        modulated[i] = np.exp(1j*current_angle)
+
+    t = (1/sample_rate)*np.arange(len(modulated))
+    I = np.cos(2*np.pi*carrier_freq*t)
+    Q = np.cos(2*np.pi*carrier_freq*t - np.pi/2)
+    return np.real(modulated)*I + np.imag(modulated)*Q
+
+def check(bits=None, sample_rate=5e9, tolerance=1e-5):
+    # Max difference against the notebook (see above for why the bits are inverted), which is
+    # down to the notebook keeping the phase as complex64
+    bits = np.array(prbs9()[:64] if bits is None else bits)
+    expected = modulate_reference(1 - bits, sample_rate=sample_rate)
+    actual = modulate(bits, sample_rate=sample_rate, chunk=7)
+    error = np.max(np.abs(actual - expected))
+    return error, error <= tolerance
+
+def benchmark(symbols=10000, sample_rate=5e9):
+    bits = np.random.default_rng(0).integers(0, 2, symbols)
+    start = time.time()
+    samples = sum(len(chunk) for chunk in iter_modulate(bits, sample_rate=sample_rate, one_bit=True))
+    elapsed = time.time() - start
+    return samples/elapsed, symbols/elapsed
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'check':
+        sample_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 5e9
+        error, ok = check(sample_rate=sample_rate)
+        print("Max difference from the notebook modulator: {:.2e}".format(error))
+        if not ok:
+            sys.exit(1)
+    elif sys.argv[1] == 'benchmark':
+        samples, symbols = benchmark()
+        print("{:.1f}M samples/s ({:.0f} symbols/s)".format(samples/1e6, symbols))
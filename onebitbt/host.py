@@ -0,0 +1,106 @@
+import sys
+import struct
+from collections import namedtuple
+
+from onebitbt import ble
+from onebitbt.framing import FrameDecoder, FRAME_RAW, FRAME_RECORD, RECORD_HEADER, RECORD_CRC_OK, RECORD_OFFSET_SHIFT, RECORD_OFFSET_STEP
+
+# Host side half of the binary modes of BLERadio (`python -m onebitbt.radio te0714 --raw` or
+# `--records`). In raw mode the gateware ships the whitened bits of every packet it syncs to and
+# we do the dewhitening, CRC checking and parsing here, in record mode it has already done the
+# dewhitening and CRC check. Reads from a serial port (needs pyserial), a file, or - for stdin:
+#
+#   python -m onebitbt.host /dev/ttyUSB1 3125000
+
+# Timestamps count cycles of the 25MHz sync clock
+TIMESTAMP_RATE = 25e6
+
+# A packet plus whatever the gateware could tell us about it (None for raw frames). offset is the
+# carrier offset estimate in Hz, 0 from lanes without an offset bank.
+Reception = namedtuple('Reception', ['packet', 'timestamp', 'strength', 'offset'], defaults=(None,))
+
+RECORD = struct.Struct('<BBIH')
+
+def decode_frame(frame_type, payload):
+    if frame_type == FRAME_RAW and len(payload) > 1:
+        packet = ble.decode_bits(ble.to_bits(payload[1:]), channel=payload[0])
+        if packet is not None:
+            return Reception(packet, None, None)
+    elif frame_type == FRAME_RECORD and len(payload) >= RECORD_HEADER + 2:
+        channel, flags, timestamp, strength = RECORD.unpack(payload[:RECORD_HEADER])
+        pdu = payload[RECORD_HEADER:]
+        if len(pdu) == 2 + pdu[1]:
+            packet = ble.parse_packet(pdu + ble.crc_bytes(pdu), channel)
+            offset = flags >> RECORD_OFFSET_SHIFT
+            offset -= (offset & 0x40) << 1
+            return Reception(packet._replace(crc_ok=bool(flags & RECORD_CRC_OK)), timestamp, strength, offset*RECORD_OFFSET_STEP)
+    return None
+
+def format_reception(reception):
+    prefix = ''
+    if reception.timestamp is not None:
+        prefix = "{:12.6f} rssi={:<5} ".format(reception.timestamp/TIMESTAMP_RATE, reception.strength)
+    if reception.offset:
+        prefix += "cfo={:+4.0f}k ".format(reception.offset/1e3)
+    return prefix + format_packet(reception.packet)
+
+def format_packet(packet):
+    name = ble.local_name(packet)
+    return "ch{} {:<15} {} len={:<2} crc={} {}{}".format(
+        packet.channel,
+        ble.PDU_TYPES.get(packet.pdu_type, hex(packet.pdu_type)),
+        packet.address or '-',
+        packet.length,
+        'ok ' if packet.crc_ok else 'BAD',
+        ' '.join('{:02x}:{}'.format(ad_type, value.hex()) for ad_type, value in packet.ad),
+        ' "{}"'.format(name) if name else '')
+
+def decode_stream(chunks, only_valid=False, decoder=None):
+    # Yields a Reception for every packet found in an iterable of byte chunks
+    decoder = decoder or FrameDecoder()
+    for chunk in chunks:
+        for frame_type, payload in decoder.feed(chunk):
+            reception = decode_frame(frame_type, payload)
+            if reception is not None and (reception.packet.crc_ok or not only_valid):
+                yield reception
+
+class PacketWriter:
+    # File-like sink that prints packets out of whatever frames get written to it, so it can
+    # stand in for stdout when running the virtual radio in raw or record mode
+    def __init__(self, out=sys.stdout):
+        self.decoder = FrameDecoder()
+        self.out = out
+
+    def write(self, data):
+        for frame_type, payload in self.decoder.feed(data):
+            reception = decode_frame(frame_type, payload)
+            if reception is not None:
+                print(format_reception(reception), file=self.out)
+
+    def flush(self):
+        self.out.flush()
+
+def open_source(name, baud=115200):
+    if name == '-':
+        f = sys.stdin.buffer
+    elif name.startswith('/dev/') or name.startswith('COM'):
+        import serial
+        f = serial.Serial(name, baud, timeout=0.1)
+    else:
+        f = open(name, 'rb')
+    while True:
+        data = f.read(4096)
+        if data is None or (not data and not hasattr(f, 'in_waiting')):
+            break
+        if data:
+            yield data
+
+if __name__ == '__main__':
+    source = open_source(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else 115200)
+    decoder = FrameDecoder()
+    try:
+        for reception in decode_stream(source, only_valid='--valid' in sys.argv, decoder=decoder):
+            print(format_reception(reception))
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write("{} frames, {} corrupt, {} bytes skipped\n".format(decoder.frames, decoder.errors, decoder.skipped))
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+import alldigitalradio.hardware as hardware
+
+from onebitbt import virtual
+from onebitbt.bank import parse_offsets, offset_args
+from onebitbt.synth import truth_path
+
+# Where the cycles go between a packet coming in off the SERDES and it going out over the UART.
+# Runs a capture through the virtual radio (see onebitbt.virtual) tracing the pulses one lane
+# already has at each stage boundary, pairs them up packet by packet and prints a histogram of
+# every stage:
+#
+#   lock     first sample_strobe after the parser was last done (the synchronizer locked on)
+#   header   parser.header_done, the length byte is in
+#   crc      parser.crc_passed/crc_failed, the last CRC bit is in and checked
+#   readout  parser.debug, the parser hands the packet to the ring (START_READOUT)
+#   done     parser.done, the synchronizer is released for the next packet
+#   drain    ring.start for the slot the packet went in, the UART is free for it
+#   sent     ring.done for that slot, the last byte is out
+#
+# The parser's own pulses are used rather than parser.state, whose numbering depends on the order
+# the FSM got elaborated in. Trace times are in sync (25MHz) cycles, and the rx and rxdiv4 domains
+# only show up as part of the first stage. Given the ground truth of a synthetic capture (see
+# onebitbt.synth, picked up automatically) there are two more: `air` (when the first bit after the
+# access address went out) and `end` (when the last CRC bit did), so air -> lock covers the
+# demodulator and synchronizer, and end -> done is how long after a packet is over the lane can
+# take the next one.
+#
+#   python -m onebitbt.radio latency room.1bit --channels 37,38,39 [--lane 38] [--phase] [--offsets ...]
+#
+# The trace goes to --vcd, and --from-vcd reads back an earlier one instead of simulating again.
+
+# The intervals that get a histogram, in pipeline order
+INTERVALS = [
+    ('air', 'lock'), # demodulator, domain crossings and synchronizer
+    ('lock', 'header'),
+    ('header', 'crc'),
+    ('crc', 'readout'), # CHECK_CRC (or WRITE_HEADER for records)
+    ('readout', 'done'), # handing over to the ring
+    ('end', 'done'), # pipeline latency after the last bit
+    ('done', 'drain'), # waiting in the ring for the UART
+    ('drain', 'sent'), # UART
+    ('end', 'sent'),
+]
+
+# Sync cycles a microsecond
+CYCLES_PER_US = 25
+
+# Histogram bar length at the most common bin
+BAR = 40
+
+# A lock this close (in sync cycles) after a ground truth packet's first bit is that packet
+TOLERANCE = 250
+
+def probes(offsets=None):
+    # Signal names (within a lane) for each event. The bank stands in for the synchronizer.
+    return {
+        'strobe': 'bank.sample_strobe' if offsets else 'synchronizer.sample_strobe',
+        'header': 'parser.header_done',
+        'crc_passed': 'parser.crc_passed',
+        'crc_failed': 'parser.crc_failed',
+        'readout': 'parser.debug',
+        'done': 'parser.done',
+        'commit': 'ring.write_slot',
+        'drain': 'ring.start',
+        'sent': 'ring.done',
+    }
+
+def read_vcd(filename):
+    # {name: [(sync cycle, value), ...]} for every signal in a VCD from the virtual radio
+    ids = {}
+    changes = {}
+    t = 0
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('$var'):
+                _, _, width, ident, name = line.split()[:5]
+                ids[ident] = name
+                changes[name] = []
+            elif line.startswith('#'):
+                t = int(line[1:])//(virtual.SYNC_RATIO*4)
+            elif line.startswith('b'):
+                value, ident = line[1:].split()
+                changes[ids[ident]].append((t, int(value, 2)))
+            elif line and line[0] in '01' and line[1:] in ids:
+                changes[ids[line[1:]]].append((t, int(line[0])))
+    return changes
+
+def rising(changes):
+    # Cycles the signal went high on (single cycle pulses never stay high for two)
+    times = []
+    last = 0
+    for t, value in changes:
+        if value and not last:
+            times.append(t)
+        last = value
+    return np.array(times, dtype=np.int64)
+
+def changed(changes):
+    # Cycles the value changed on, after the first
+    return np.array([t for (t, value), (_, last) in zip(changes[1:], changes) if value != last], dtype=np.int64)
+
+def after(times, start, end=None):
+    # The first of times at or after start (and before end), or None
+    i = np.searchsorted(times, start)
+    if i == len(times) or (end is not None and times[i] >= end):
+        return None
+    return int(times[i])
+
+def pair(changes, names):
+    # Every packet the parser went through as a dict of stage -> sync cycle, stages that
+    # didn't happen (no header for a raw lane, no readout for a bad CRC) left out. names are
+    # the traced (qualified) names of the probes.
+    events = {event: changes.get(name, []) for event, name in names.items()}
+    strobes = rising(events['strobe'])
+    dones = rising(events['done'])
+    headers = rising(events['header'])
+    crcs = np.sort(np.concatenate((rising(events['crc_passed']), rising(events['crc_failed']))))
+    readouts = rising(events['readout'])
+    # The ring takes the packet the cycle after the readout, unless it was full (or dedup ate it)
+    commits = changed(events['commit'])
+    drains = rising(events['drain'])
+    sents = rising(events['sent'])
+
+    packets = []
+    start = 0
+    queued = []
+    for done in dones:
+        lock = after(strobes, start, done + 1)
+        if lock is None:
+            start = done + 1
+            continue
+        packet = {'lock': lock, 'done': int(done)}
+        for stage, times in [('header', headers), ('crc', crcs), ('readout', readouts)]:
+            t = after(times, lock, done + 1)
+            if t is not None:
+                packet[stage] = t
+        if 'readout' in packet and after(commits, packet['readout'], packet['readout'] + 3) is not None:
+            queued.append(packet)
+        packets.append(packet)
+        start = done + 1
+
+    # The ring drains in the order it filled
+    for packet, drain in zip(queued, drains):
+        packet['drain'] = int(drain)
+        sent = after(sents, drain)
+        if sent is not None:
+            packet['sent'] = sent
+    return packets
+
+def match_truth(packets, truth, channel):
+    # Adds air and end times from a synthetic capture's ground truth to the packets that were one
+    ground = [p for p in truth['packets'] if p['channel'] == channel]
+    times = np.array([p['timestamp'] for p in ground], dtype=np.int64)
+    matched = 0
+    for packet in packets:
+        i = np.searchsorted(times, packet['lock'] - TOLERANCE)
+        if i < len(times) and times[i] <= packet['lock']:
+            packet['air'] = int(times[i])
+            # The PDU (header included) and CRC after the access address
+            packet['end'] = int(times[i]) + 8*(len(ground[i]['pdu'])//2 + 3)*CYCLES_PER_US
+            matched += 1
+    return matched
+
+def histogram(values, bins=10, out=sys.stdout):
+    values = np.asarray(values)
+    low, high = int(values.min()), int(values.max())
+    width = max(1, -(-(high - low + 1)//bins))
+    counts = np.bincount((values - low)//width)
+    for i, count in enumerate(counts):
+        if count:
+            first, last = low + i*width, low + (i + 1)*width - 1
+            label = str(first) if width == 1 else "{} - {}".format(first, last)
+            print("    {:>19} {:>6} {}".format(label, count, '#'*max(1, int(round(BAR*count/counts.max())))), file=out)
+
+def report(packets, out=sys.stdout):
+    print("{} packets".format(len(packets)), file=out)
+    for first, second in INTERVALS:
+        values = [p[second] - p[first] for p in packets if first in p and second in p]
+        if not values:
+            continue
+        p50, p99 = np.percentile(values, [50, 99])
+        print("{:>8} -> {:<8} n={:<6} min={} median={:.0f} p99={:.0f} max={} cycles ({:.2f}us median)".format(
+            first, second, len(values), min(values), p50, p99, max(values), p50/CYCLES_PER_US), file=out)
+        histogram(values, out=out)
+
+    # What stops the lane from taking the next packet, and what stops the ring from emptying
+    busy = [p['done'] - p['crc'] for p in packets if 'crc' in p]
+    uart = [p['sent'] - p['drain'] for p in packets if 'sent' in p]
+    if busy:
+        print("After the last CRC bit the lane is deaf for up to {} cycles ({:.2f}us), and needs the next packet's "
+            "preamble and access address after that".format(max(busy), max(busy)/CYCLES_PER_US), file=out)
+    if uart:
+        print("The UART takes {:.0f} cycles ({:.1f}us) a packet, at most {:.0f} packets/s across all lanes".format(
+            np.median(uart), np.median(uart)/CYCLES_PER_US, 25e6/np.median(uart)), file=out)
+
+def main(args, make_radio):
+    parser = argparse.ArgumentParser(prog='python -m onebitbt.radio latency')
+    parser.add_argument('capture', help='text or packed capture of SERDES samples')
+    parser.add_argument('--channels', default='37', help='comma separated channels to receive on, e.g. 37,38,39')
+    parser.add_argument('--lane', type=int, default=None, help='channel of the lane to probe (default: the first)')
+    parser.add_argument('--truth', default=None, help='ground truth of a synthetic capture (default: capture + .truth if there is one)')
+    parser.add_argument('--baud', type=int, default=3125000)
+    parser.add_argument('--raw', dest='mode', action='store_const', const='raw', default='records')
+    parser.add_argument('--text', dest='mode', action='store_const', const='text')
+    parser.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk')
+    parser.add_argument('--2m', dest='phy', action='store_const', const='2m', default='1m')
+    parser.add_argument('--offsets', default=None, help='kHz offsets to demodulate at, e.g. -150,-75,0,75,150')
+    parser.add_argument('--dedup', type=int, default=0)
+    parser.add_argument('--build-dir', default=None, help='where to cache simulator builds')
+    parser.add_argument('--vcd', default='build/latency.vcd')
+    parser.add_argument('--from-vcd', action='store_true', help="don't simulate, just read back --vcd")
+    args = parser.parse_args(offset_args(args))
+
+    channels = [int(channel) for channel in args.channels.split(',')]
+    lane = channels[0] if args.lane is None else args.lane
+    offsets = parse_offsets(args.offsets) if args.offsets else None
+    names = {event: virtual.qualify(name, lane) for event, name in probes(offsets).items()}
+    if not args.from_vcd:
+        with hardware.use('virtual'):
+            radio = make_radio(channels, mode=args.mode, baud=args.baud, demodulator=args.demodulator, phy=args.phy,
+                offsets=offsets, dedup=args.dedup)
+            binary = virtual.build(radio, args.build_dir)
+        os.makedirs(os.path.dirname(args.vcd) or '.', exist_ok=True)
+        virtual.run(binary, args.capture, output=None, trace=list(probes(offsets).values()), vcd=args.vcd,
+            divisor=radio.uart.divisor, lane=lane)
+
+    packets = pair(read_vcd(args.vcd), names)
+    truth = args.truth or truth_path(args.capture)
+    if os.path.exists(truth):
+        with open(truth) as f:
+            matched = match_truth(packets, json.load(f), lane)
+        print("{} of {} packets matched the ground truth".format(matched, len(packets)))
+    report(packets)
@@ -0,0 +1,114 @@
+from nmigen import Elaboratable, Module, Signal, Cat, signed
+from nmigen.lib.cdc import FFSynchronizer
+
+# A summing mixer (same math and outputs as alldigitalradio's SummingMixer) whose oscillator is a
+# phase accumulator rather than a table of words, so it can be retuned at runtime. The oscillator
+# tables of SummingMixer repeat only every ~1000 words for BLE channels, so preloading tables for
+# all 40 channels would take more BRAM than the FPGA has.
+#
+# Every rx cycle the accumulator moves on by a word's worth of phase, and each sample in the word
+# gets its own offset from it (k times the increment, k = 0..width-1). A 1-bit cosine is just
+# whether the phase is within a quarter turn of zero, which is the top two bits, and a 1-bit sine
+# whether it's in the first half turn, which is the top bit.
+#
+# Retuning is driven from sync: set increment, pulse retune, and tuned goes low until the new
+# frequency has made it through the mixer and `settle` more words have gone by (the demodulator
+# sets that to however long its filters take to forget the old channel).
+
+# At 5GSPS this is a ~300Hz frequency resolution, which is plenty
+PHASE_BITS = 24
+
+def phase_increment(frequency, sample_rate=5e9, bits=PHASE_BITS):
+    return int(round(frequency/sample_rate*(1 << bits))) % (1 << bits)
+
+def popcount(value):
+    # Adder tree, so it's log2(width) adders deep
+    terms = [value[i] for i in range(len(value))]
+    while len(terms) > 1:
+        terms = [terms[i] + terms[i + 1] if i + 1 < len(terms) else terms[i] for i in range(0, len(terms), 2)]
+    return terms[0]
+
+class NCOMixer(Elaboratable):
+    def __init__(self, sample_rate=5e9, frequency=2.4e9, width=20, window=4, phase_bits=PHASE_BITS, settle=0, domain="rx"):
+        self.width = width
+        self.window = window
+        self.phase_bits = phase_bits
+        self.settle = settle
+        self.domain = domain
+
+        self.input = Signal(width)
+        self.outputIsum = Signal(signed(8))
+        self.outputQsum = Signal(signed(8))
+
+        # Control, in sync
+        self.increment = Signal(phase_bits, reset=phase_increment(frequency, sample_rate, phase_bits))
+        self.retune = Signal()
+        self.tuned = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        rx = m.d[self.domain]
+        n = self.width
+
+        # Hand the new increment over to rx. increment is held while a retune is in flight, so
+        # by the time the toggle makes it across it's safe to sample.
+        request = Signal()
+        request_rx = Signal()
+        seen = Signal()
+        with m.If(self.retune):
+            m.d.sync += request.eq(~request)
+        m.submodules.request_sync = FFSynchronizer(request, request_rx, o_domain=self.domain)
+        rx += seen.eq(request_rx)
+
+        increment = Signal(self.phase_bits, reset=self.increment.reset)
+        offsets = [Signal(self.phase_bits, name="offset{}".format(k), reset=k*increment.reset % (1 << self.phase_bits))
+            for k in range(n + 1)]
+        # The offsets ripple through one adder per cycle after a retune, rather than all be
+        # multiplied out at once
+        with m.If(request_rx != seen):
+            rx += increment.eq(self.increment)
+        for k in range(1, n + 1):
+            rx += offsets[k].eq(offsets[k - 1] + increment)
+
+        # Count down until the new frequency is all the way through: the ripple, the mixer
+        # pipeline and then however long the caller asked for
+        countdown = Signal(range(n + 4 + self.settle + 1))
+        done = Signal()
+        with m.If(request_rx != seen):
+            rx += countdown.eq(n + 4 + self.settle)
+        with m.Elif(countdown == 1):
+            rx += [
+                countdown.eq(0),
+                done.eq(request_rx),
+            ]
+        with m.Elif(countdown != 0):
+            rx += countdown.eq(countdown - 1)
+        done_sync = Signal()
+        m.submodules.done_sync = FFSynchronizer(done, done_sync)
+        m.d.comb += self.tuned.eq((done_sync == request) & ~self.retune)
+
+        # The oscillator, a word of cosine and sine per cycle
+        phase = Signal(self.phase_bits)
+        rx += phase.eq(phase + offsets[n])
+        oscI = Signal(n)
+        oscQ = Signal(n)
+        for k in range(n):
+            sample = Signal(self.phase_bits, name="sample{}".format(k))
+            m.d.comb += sample.eq(phase + offsets[k])
+            rx += [
+                oscI[k].eq(sample[-1] == sample[-2]),
+                oscQ[k].eq(~sample[-1]),
+            ]
+        data = Signal(n)
+        rx += data.eq(self.input)
+
+        # Multiplying two one bit (+1/-1) signals is an XNOR, so the sum over a word is
+        # (matching bits) - (mismatched bits), then summed over the last `window` words
+        for osc, output in ((oscI, self.outputIsum), (oscQ, self.outputQsum)):
+            mix = Signal(signed(6))
+            rx += mix.eq(n - 2*popcount(data ^ osc))
+            history = [Signal(signed(6), name="history{}".format(i)) for i in range(self.window - 1)]
+            rx += Cat(*history).eq(Cat(mix, *history[:-1]))
+            rx += output.eq(sum(history, mix))
+
+        return m
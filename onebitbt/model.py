@@ -0,0 +1,433 @@
+import sys
+from fractions import Fraction
+
+import numpy as np
+
+from onebitbt.capture import iter_words, read_words
+
+# A vectorized numpy model of the demodulators in onebitbt.demodulator (i.e. the receive chain in
+# BLERadio). Stepping the gateware through nmigen (or even iverilog) one cycle at a time is far
+# too slow to push multi-second 5GSPS captures through, so this does the exact same integer math
+# on whole arrays of SERDES words at once. Run `python -m onebitbt.model conformance` to check it
+# against the nmigen simulation.
+
+WORD_WIDTH = 20
+
+# Where the rx/4 clock samples the running sums of the summing mixers (in rx cycles) and how
+# the 25MHz sync domain lines up with the rxdiv4 pipeline. These depend on how the clocks are
+# phased relative to each other in the nmigen simulation, and `conformance` only passes if the
+# model matches at exactly this phasing.
+DIVIDER_PHASE = 0
+SYNC_OFFSET = 2
+
+# The rx domain (250MHz) runs 10x faster than the sync domain (25MHz)
+SYNC_RATIO = 10
+
+def make_carrier(freq=None, sample_rate=None, samples=None, phase=0):
+    t = (1/sample_rate)*np.arange(samples)
+    return np.real(np.exp(1j*(2*np.pi*freq*t - phase)))
+
+def pack_words(samples, width=WORD_WIDTH):
+    # Same layout as alldigitalradio.util.pack_mem: sample i of each word ends up in bit i and
+    # anything > 0 is a one.
+    bits = (np.asarray(samples)[:len(samples) - len(samples) % width] > 0).astype(np.uint32)
+    return (bits.reshape(-1, width) << np.arange(width, dtype=np.uint32)).sum(axis=1, dtype=np.uint32)
+
+def unpack_words(words, width=WORD_WIDTH):
+    words = np.asarray(words, dtype=np.uint32)
+    return ((words[:, None] >> np.arange(width, dtype=np.uint32)) & 1).astype(np.uint8).flatten()
+
+_popcount = None
+def popcount(words):
+    global _popcount
+    if _popcount is None:
+        table = np.arange(1 << WORD_WIDTH, dtype=np.uint32)
+        _popcount = np.zeros(1 << WORD_WIDTH, dtype=np.uint8)
+        for i in range(WORD_WIDTH):
+            _popcount += ((table >> i) & 1).astype(np.uint8)
+    return _popcount[words]
+
+def oscillator_period(sample_rate, frequency, max_error=0.0001, width=WORD_WIDTH):
+    # The smallest number of words that holds a whole number of carrier cycles (within
+    # max_error of a cycle), so the oscillator can loop seamlessly
+    cycles_per_word = width*frequency/sample_rate
+    words = 1
+    while abs(words*cycles_per_word - round(words*cycles_per_word)) > max_error:
+        words += 1
+    return words
+
+class SummingMixerModel:
+    def __init__(self, sample_rate=5e9, frequency=2.4e9, max_error=0.0001, width=WORD_WIDTH, window=4):
+        self.width = width
+        period = oscillator_period(sample_rate, frequency, max_error, width)
+        samples = period*width
+        self.oscI = pack_words(make_carrier(freq=frequency, sample_rate=sample_rate, samples=samples, phase=0), width)
+        self.oscQ = pack_words(make_carrier(freq=frequency, sample_rate=sample_rate, samples=samples, phase=np.pi/2), width)
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.index = 0
+        self.historyI = np.zeros(self.window - 1, dtype=np.int32)
+        self.historyQ = np.zeros(self.window - 1, dtype=np.int32)
+
+    def process(self, words):
+        words = np.asarray(words, dtype=np.uint32)
+        idx = (self.index + np.arange(len(words))) % len(self.oscI)
+        self.index = (self.index + len(words)) % len(self.oscI)
+
+        # Multiplying two one bit (+1/-1) signals is an XNOR, so the sum over a word is
+        # (matching bits) - (mismatched bits)
+        mixI = self.width - 2*popcount(words ^ self.oscI[idx]).astype(np.int32)
+        mixQ = self.width - 2*popcount(words ^ self.oscQ[idx]).astype(np.int32)
+
+        # Running sum over the last `window` words
+        sumI, self.historyI = running_sum(mixI, self.historyI)
+        sumQ, self.historyQ = running_sum(mixQ, self.historyQ)
+        return sumI, sumQ
+
+class NCOMixerModel(SummingMixerModel):
+    # Model of onebitbt.mixer.NCOMixer: the oscillator is a phase accumulator (so it can be
+    # retuned) rather than a table, otherwise the same
+    def __init__(self, sample_rate=5e9, frequency=2.4e9, width=WORD_WIDTH, window=4, phase_bits=24):
+        from onebitbt.mixer import phase_increment
+        self.width = width
+        self.window = window
+        self.sample_rate = sample_rate
+        self.phase_bits = phase_bits
+        self.increment = phase_increment(frequency, sample_rate, phase_bits)
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.phase = 0
+
+    def retune(self, frequency):
+        from onebitbt.mixer import phase_increment
+        self.increment = phase_increment(frequency, self.sample_rate, self.phase_bits)
+
+    def process(self, words):
+        words = np.asarray(words, dtype=np.uint32)
+        mask = (1 << self.phase_bits) - 1
+        phases = (self.phase + self.increment*np.arange(len(words)*self.width, dtype=np.int64)) & mask
+        self.phase = (self.phase + self.increment*len(words)*self.width) & mask
+        top = (phases >> (self.phase_bits - 2)).reshape(-1, self.width)
+        weights = np.uint32(1) << np.arange(self.width, dtype=np.uint32)
+        oscI = (((top == 0) | (top == 3)).astype(np.uint32)*weights).sum(axis=1, dtype=np.uint32)
+        oscQ = ((top < 2).astype(np.uint32)*weights).sum(axis=1, dtype=np.uint32)
+
+        mixI = self.width - 2*popcount(words ^ oscI).astype(np.int32)
+        mixQ = self.width - 2*popcount(words ^ oscQ).astype(np.int32)
+        sumI, self.historyI = running_sum(mixI, self.historyI)
+        sumQ, self.historyQ = running_sum(mixQ, self.historyQ)
+        return sumI, sumQ
+
+def make_mixer(sample_rate, frequency, retunable=False):
+    if retunable:
+        return NCOMixerModel(sample_rate=sample_rate, frequency=frequency)
+    return SummingMixerModel(sample_rate=sample_rate, frequency=frequency, max_error=0.0001)
+
+def running_sum(values, history):
+    # Sum over a sliding window of len(history) + 1, carrying the tail into the next call
+    window = len(history) + 1
+    padded = np.concatenate((history, values))
+    acc = np.concatenate(([0], np.cumsum(padded, dtype=np.int64)))
+    sums = (acc[window:] - acc[:-window]).astype(np.int32)
+    return sums, padded[len(padded) - (window - 1):]
+
+class RunningBoxcarModel:
+    def __init__(self, width):
+        self.width = width
+        self.reset()
+
+    def reset(self):
+        self.history = np.zeros(self.width - 1, dtype=np.int32)
+
+    def process(self, values):
+        out, self.history = running_sum(np.asarray(values, dtype=np.int32), self.history)
+        return out
+
+def magnitude(i, q):
+    # Alpha max plus beta min with alpha = 1, beta = 1/2, same as MagnitudeApproximator
+    i = np.abs(i)
+    q = np.abs(q)
+    return np.maximum(i, q) + (np.minimum(i, q) >> 1)
+
+class DemodulatorModel:
+    # Shared by the demodulator models: turns the rxdiv4 rate output of diff() into the baseband
+    # bits the sync domain sees
+    def __init__(self, divider_phase=DIVIDER_PHASE, sync_offset=SYNC_OFFSET, sync_ratio=SYNC_RATIO):
+        self.divider_phase = divider_phase
+        self.sync_offset = sync_offset
+        self.sync_ratio = sync_ratio
+
+    def reset(self):
+        self.words = 0 # rx cycles consumed so far
+        self.ticks = 0 # sync cycles produced so far
+        self.pending = np.zeros(0, dtype=np.uint8) # rxdiv4 rate bits not yet sampled by sync
+        self.pending_base = 0 # rxdiv4 index of pending[0]
+
+    def sample(self, words):
+        # Indices into a block of `words` of the running sums the rxdiv4 domain samples
+        first = (self.divider_phase - self.words) % 4
+        self.words += len(words)
+        return slice(first, None, 4)
+
+    def process(self, words):
+        # Returns the baseband bit for every sync cycle that completes within `words`
+        bits = (self.diff(words) > 0).astype(np.uint8)
+        self.pending = np.concatenate((self.pending, bits))
+
+        # Each sync edge picks up whatever the rxdiv4 pipeline is showing at that moment
+        available = self.pending_base + len(self.pending)
+        ticks = (4*available - 1 - self.sync_offset)//self.sync_ratio + 1
+        k = np.arange(self.ticks, max(ticks, self.ticks))
+        m = (self.sync_ratio*k + self.sync_offset)//4
+        self.ticks += len(m)
+
+        out = np.zeros(len(m), dtype=np.uint8)
+        valid = m >= self.pending_base
+        out[valid] = self.pending[m[valid] - self.pending_base]
+
+        # Drop whatever the next sync edge can no longer see
+        keep = min(len(self.pending), max(0, (self.sync_ratio*self.ticks + self.sync_offset)//4 - self.pending_base))
+        self.pending = self.pending[keep:]
+        self.pending_base += keep
+        return out
+
+class FSKDemodulatorModel(DemodulatorModel):
+    def __init__(self, sample_rate=5e9, frequency=2.402e9, deviation=250e3, width=64, retunable=False, **kwargs):
+        super().__init__(**kwargs)
+        self.deviation = deviation
+        self.mixerHigh = make_mixer(sample_rate, frequency + deviation, retunable)
+        self.mixerLow = make_mixer(sample_rate, frequency - deviation, retunable)
+        self.lpfs = [RunningBoxcarModel(width) for _ in range(4)]
+        self.reset()
+
+    def retune(self, frequency):
+        # Only with retunable=True, takes effect from the next word
+        self.mixerHigh.retune(frequency + self.deviation)
+        self.mixerLow.retune(frequency - self.deviation)
+
+    def reset(self):
+        super().reset()
+        self.mixerHigh.reset()
+        self.mixerLow.reset()
+        for lpf in self.lpfs:
+            lpf.reset()
+
+    def diff(self, words):
+        # Returns the (registered) difference of magnitudes, one per rxdiv4 cycle
+        highI, highQ = self.mixerHigh.process(words)
+        lowI, lowQ = self.mixerLow.process(words)
+
+        # The rxdiv4 domain only samples every 4th running sum
+        sampled = self.sample(words)
+
+        highI, highQ, lowI, lowQ = [lpf.process(s[sampled]) for lpf, s in zip(self.lpfs, (highI, highQ, lowI, lowQ))]
+        return magnitude(highI, highQ) - magnitude(lowI, lowQ)
+
+def cordic_angles(iterations, phase_bits=16):
+    return [int(round(np.arctan(2.0**-i)/(2*np.pi)*(1 << phase_bits))) for i in range(iterations)]
+
+def cordic(i, q, iterations=12, phase_bits=16):
+    # Same integer vectoring CORDIC as onebitbt.demodulator.Cordic. Returns the angle of (i, q)
+    # as a fraction of a full turn (scaled to phase_bits) and the magnitude (scaled by ~1.65).
+    x = np.asarray(i, dtype=np.int64).copy()
+    y = np.asarray(q, dtype=np.int64).copy()
+    mask = (1 << phase_bits) - 1
+
+    # Rotate into the right half plane first, CORDIC only converges within +-90 degrees
+    flip = x < 0
+    x[flip] = -x[flip]
+    y[flip] = -y[flip]
+    z = np.where(flip, 1 << (phase_bits - 1), 0).astype(np.int64)
+
+    for n, angle in enumerate(cordic_angles(iterations, phase_bits)):
+        down = y >= 0
+        x, y = np.where(down, x + (y >> n), x - (y >> n)), np.where(down, y - (x >> n), y + (x >> n))
+        z = np.where(down, z + angle, z - angle) & mask
+    return z, x
+
+def wrap(values, bits):
+    # Reinterpret as a signed `bits` wide integer
+    values = np.asarray(values, dtype=np.int64) & ((1 << bits) - 1)
+    return values - ((values >> (bits - 1)) << bits)
+
+class PhaseDemodulatorModel(DemodulatorModel):
+    # Model of onebitbt.demodulator.PhaseDemodulator: one mixer at the carrier, CORDIC to get
+    # the phase and the phase change over `lag` rxdiv4 samples as diff
+    def __init__(self, sample_rate=5e9, frequency=2.402e9, deviation=250e3, width=64, lag=16, iterations=12, phase_bits=16,
+            retunable=False, **kwargs):
+        super().__init__(**kwargs)
+        self.mixer = make_mixer(sample_rate, frequency, retunable)
+        self.lpfs = [RunningBoxcarModel(width) for _ in range(2)]
+        self.lag = lag
+        self.iterations = iterations
+        self.phase_bits = phase_bits
+        self.reset()
+
+    def retune(self, frequency):
+        self.mixer.retune(frequency)
+
+    def reset(self):
+        super().reset()
+        self.mixer.reset()
+        for lpf in self.lpfs:
+            lpf.reset()
+        # The CORDIC pipeline (pre-rotation plus one register per iteration) and the delay
+        # line both start out full of zeros
+        self.history = np.zeros(self.iterations + 1 + self.lag, dtype=np.int64)
+
+    def diff(self, words):
+        sumI, sumQ = self.mixer.process(words)
+        sampled = self.sample(words)
+        i, q = [lpf.process(s[sampled]) for lpf, s in zip(self.lpfs, (sumI, sumQ))]
+        phase, _ = cordic(i, q, self.iterations, self.phase_bits)
+
+        phases = np.concatenate((self.history, phase))
+        self.history = phases[len(phases) - len(self.history):]
+
+        # A tone above the carrier shows up as the phase going backwards
+        delayed = phases[:len(phases) - len(self.history)]
+        current = phases[self.lag:len(phases) - (len(self.history) - self.lag)]
+        return wrap(delayed - current, self.phase_bits)
+
+DEMODULATORS = {
+    'fsk': FSKDemodulatorModel,
+    'phase': PhaseDemodulatorModel,
+}
+
+class SynchronizerModel:
+    # Model of onebitbt.synchronizer.FractionalSynchronizer, on a whole array of baseband bits
+    # (one per sync cycle) at once. Samples before the start of baseband count as zeros, like the
+    # gateware's shift register coming out of reset.
+    def __init__(self, pattern, samples_per_symbol=25):
+        spp = Fraction(samples_per_symbol).limit_denominator(16)
+        self.pattern = np.array(pattern, dtype=np.uint8)
+        self.step = 2*spp.denominator
+        self.period = 2*spp.numerator
+        n = len(pattern)
+        self.taps = [int((n - 1 - k)*spp + Fraction(1, 2)) for k in range(n)]
+        self.longest = int(spp) + 1
+
+    def matches(self, baseband):
+        # Whether every pattern bit matches with the last one at each cycle
+        padded = np.concatenate((np.zeros(max(self.taps), dtype=np.uint8), baseband))
+        match = np.ones(len(baseband), dtype=bool)
+        for tap, bit in zip(self.taps, self.pattern):
+            match &= padded[max(self.taps) - tap:len(padded) - tap] == bit
+        return match
+
+    def lock(self, match, start=0):
+        # The first lock on the way out of a reset that ended at `start` as (cycle, score): the
+        # cycle the run ended on, which is the one before the strobes start being counted
+        hits = np.flatnonzero(match[start:])
+        if not len(hits):
+            return None
+        first = start + hits[0]
+        misses = np.flatnonzero(~match[first:])
+        if not len(misses):
+            return None
+        end = first + misses[0]
+        return end, min(end - first, self.longest)
+
+    def strobes(self, cycle, score, count):
+        # Cycles of the first `count` sample strobes after locking at (cycle, score)
+        remaining = self.period - (score + 1)*(self.step//2) - self.step
+        strobes = []
+        u = cycle + 1
+        while len(strobes) < count:
+            # Down a step a cycle until within half a sample of the middle of the symbol
+            wait = max(0, (remaining - self.step//2)//self.step + 1)
+            u += wait
+            remaining -= wait*self.step
+            strobes.append(u)
+            remaining += self.period - self.step
+            u += 1
+        return np.array(strobes)
+
+def demodulate(words, chunk=1 << 20, demodulator='fsk', **kwargs):
+    # Convenience wrapper to demodulate a whole array (or iterator of arrays) of words
+    model = DEMODULATORS[demodulator](**kwargs)
+    if isinstance(words, np.ndarray):
+        chunks = [words[i:i + chunk] for i in range(0, len(words), chunk)]
+    else:
+        chunks = words
+    return np.concatenate([model.process(c) for c in chunks] + [np.zeros(0, dtype=np.uint8)])
+
+def simulate_gateware(words, demodulator='fsk'):
+    # Runs the real demodulator through the nmigen simulator and returns the baseband bit seen
+    # on every sync cycle
+    from nmigen import Module
+    from nmigen.sim import Simulator
+
+    from onebitbt.demodulator import DEMODULATORS
+    from onebitbt.clocking import ClockDivider4
+
+    m = Module()
+    m.submodules.clockdivider = ClockDivider4("rx", "rxdiv4")
+    m.submodules.demodulator = demodulator = DEMODULATORS[demodulator]()
+
+    out = []
+    def feed():
+        for word in words:
+            yield demodulator.input.eq(int(word))
+            yield
+
+    def collect():
+        for _ in range(len(words)//SYNC_RATIO):
+            yield
+            out.append((yield demodulator.baseband))
+
+    sim = Simulator(m)
+    sim.add_clock(4e-9, domain="rx")
+    sim.add_clock(4e-9*SYNC_RATIO)
+    sim.add_sync_process(feed, domain="rx")
+    sim.add_sync_process(collect)
+    sim.run()
+    return np.array(out, dtype=np.uint8)
+
+def find_phasing(words, expected, demodulator='fsk'):
+    # The (divider_phase, sync_offset) the model matches expected at, if there is one
+    for divider_phase in range(4):
+        for sync_offset in range(-4*SYNC_RATIO, 4*SYNC_RATIO):
+            actual = demodulate(words, chunk=997, demodulator=demodulator, divider_phase=divider_phase, sync_offset=sync_offset)
+            n = min(len(actual), len(expected))
+            if n and np.array_equal(actual[:n], expected[:n]):
+                return divider_phase, sync_offset
+    return None
+
+def conformance(words, demodulator='fsk'):
+    # Compare the model (at DIVIDER_PHASE and SYNC_OFFSET) against the gateware, it should match
+    # for every single cycle. Returns the number of cycles compared, the first one that differs
+    # (None if they all matched) and, if one did, the phasing the model matches at instead (if
+    # any), to tell a model that's off by a clock phase apart from one that's just wrong.
+    expected = simulate_gateware(words, demodulator)
+    actual = demodulate(words, chunk=997, demodulator=demodulator)
+    n = min(len(actual), len(expected))
+    mismatches = np.flatnonzero(actual[:n] != expected[:n])
+    if not len(mismatches):
+        return n, None, None
+    return n, int(mismatches[0]), find_phasing(words, expected, demodulator)
+
+if __name__ == '__main__':
+    # --phase picks the CORDIC phase demodulator instead of the FSK magnitude comparator
+    demodulator = 'phase' if '--phase' in sys.argv else 'fsk'
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if args[0] == 'conformance':
+        words = read_words(args[1] if len(args) > 1 else 'data/bt1bit.txt', count=int(args[2]) if len(args) > 2 else 20000)
+        cycles, mismatch, phasing = conformance(words, demodulator)
+        if not cycles:
+            print("Not enough words to compare anything!")
+            sys.exit(1)
+        if mismatch is not None:
+            print("Model does not match the gateware from cycle {} of {}!".format(mismatch, cycles))
+            if phasing:
+                print("It does match with divider_phase={}, sync_offset={} (DIVIDER_PHASE={}, SYNC_OFFSET={})".format(
+                    *phasing, DIVIDER_PHASE, SYNC_OFFSET))
+            sys.exit(1)
+        print("Matched {} cycles with divider_phase={}, sync_offset={}".format(cycles, DIVIDER_PHASE, SYNC_OFFSET))
+    elif args[0] == 'demodulate':
+        baseband = demodulate(iter_words(args[1]), demodulator=demodulator)
+        sys.stdout.write(''.join(map(str, baseband)))
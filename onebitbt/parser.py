@@ -1,17 +1,55 @@
-from nmigen import Elaboratable, Signal, Module, Memory, Cat
-from alldigitalradio.shiftregisters import LinearFeedbackShiftRegister, GaloisCRC
+from nmigen import Elaboratable, Signal, Module, Memory, Cat, Array, Const, Value, signed
+from alldigitalradio.shiftregisters import GaloisCRC
+
+from onebitbt.ble import CHANNELS, whitening_seed
+from onebitbt.framing import RECORD_HEADER
+
+class Whitener(Elaboratable):
+    # The (de)whitening LFSR (x^7 + x^4 + 1), seeded from the channel index. Advances one bit
+    # on every cycle run_strobe is high and goes back to the seed while reset is high. channel
+    # can also be a signal (for a lane that retunes, see onebitbt.scan), in which case pulse load
+    # after changing it.
+    def __init__(self, channel=37):
+        self.channel = channel
+        self.run_strobe = Signal()
+        self.reset = Signal()
+        self.load = Signal()
+        self.output = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if isinstance(self.channel, int):
+            seed = whitening_seed(self.channel)
+            state = Signal(7, reset=seed)
+        else:
+            seed = Array(Const(whitening_seed(channel), 7) for channel in range(CHANNELS))[self.channel]
+            state = Signal(7)
+        m.d.comb += self.output.eq(state[6])
+
+        with m.If(self.reset | self.load):
+            m.d.sync += state.eq(seed)
+        with m.Elif(self.run_strobe):
+            m.d.sync += state.eq(Cat(state[6], state[0:3], state[3] ^ state[6], state[4:6]))
+
+        return m
 
 class PacketParser(Elaboratable):
-    def __init__(self, printer=None):
+    def __init__(self, printer=None, channel=37):
         self.bitstream = Signal()
         self.sample = Signal()
         self.currentbit = Signal()
-        self.lfsr = LinearFeedbackShiftRegister()
+        self.lfsr = Whitener(channel)
         self.crc = GaloisCRC()
         self.done = Signal()
         self.debug = Signal()
         self.printer = printer
         self.state = Signal(5)
+
+        # Single cycle pulses for the performance counters
+        self.header_done = Signal()
+        self.crc_passed = Signal()
+        self.crc_failed = Signal()
         self.crc_matches = Signal()
 
     def elaborate(self, platform):
@@ -99,6 +137,7 @@ class PacketParser(Elaboratable):
                             self.crc.en.eq(1),
                     ]
                     with m.If(header_idx == 15):
+                        m.d.comb += self.header_done.eq(1)
                         m.d.sync += [
                                 payload_read.eq(0),
                                 payload_addr.eq(0),
@@ -233,6 +272,10 @@ class PacketParser(Elaboratable):
                     ]
 
             with m.State("CHECK_CRC"):
+                m.d.comb += [
+                    self.crc_passed.eq(crc_matches),
+                    self.crc_failed.eq(~crc_matches),
+                ]
                 with m.If(crc_matches & should_print):
                     m.next = "START_READOUT"
                 with m.Else():
@@ -274,4 +317,257 @@ class PacketParser(Elaboratable):
                     pass
 
 
-        return m
\ No newline at end of file
+        return m
+
+class RawPacketCapture(Elaboratable):
+    # Drop-in alternative to PacketParser that doesn't parse anything. It just grabs the first
+    # packet_bytes worth of (still whitened) bits after the access address into the printer's
+    # memory, prefixed with the channel, and leaves everything else to the host (see
+    # onebitbt.host). The printer is expected to be a FramePrinter.
+    def __init__(self, printer, channel=37, packet_bytes=2 + 37 + 3):
+        self.bitstream = Signal()
+        self.sample = Signal()
+        self.done = Signal()
+        self.debug = Signal()
+        self.printer = printer
+        self.channel = channel
+        self.packet_bytes = packet_bytes
+        self.state = Signal(2)
+
+        # Nothing gets parsed here, but keep the same performance counter pulses as PacketParser
+        self.header_done = Signal()
+        self.crc_passed = Signal()
+        self.crc_failed = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.payload_wport = wport = self.printer.mem.write_port()
+
+        byte = Signal(8)
+        bit_idx = Signal(3)
+        addr = Signal(range(self.packet_bytes + 1))
+
+        # Bits arrive LSB first, so shift them in from the top
+        next_byte = Cat(byte[1:8], self.bitstream)
+
+        with m.FSM() as fsm:
+            m.d.comb += self.state.eq(fsm.state)
+
+            with m.State("CAPTURE"):
+                with m.If(self.sample):
+                    m.d.sync += [
+                        byte.eq(next_byte),
+                        bit_idx.eq(bit_idx + 1),
+                    ]
+                    with m.If(bit_idx == 7):
+                        m.d.comb += [
+                            wport.addr.eq(addr + 1),
+                            wport.en.eq(1),
+                            wport.data.eq(next_byte),
+                        ]
+                        m.d.sync += addr.eq(addr + 1)
+                        with m.If(addr == self.packet_bytes - 1):
+                            m.next = "START_READOUT"
+
+            with m.State("START_READOUT"):
+                m.d.comb += [
+                    wport.addr.eq(0),
+                    wport.en.eq(1),
+                    wport.data.eq(self.channel),
+                    self.debug.eq(1),
+                    self.printer.start.eq(1),
+                    self.printer.length.eq(self.packet_bytes + 1),
+                ]
+                m.next = "WAIT_READOUT"
+
+            with m.State("WAIT_READOUT"):
+                with m.If(self.printer.done):
+                    m.d.comb += self.done.eq(1)
+                    m.d.sync += [
+                        addr.eq(0),
+                        bit_idx.eq(0),
+                    ]
+                    m.next = "CAPTURE"
+
+        return m
+
+class PacketRecorder(Elaboratable):
+    # Another drop-in alternative to PacketParser. It dewhitens and CRC checks every packet but
+    # otherwise doesn't look inside it, the whole PDU goes into the printer's memory behind a
+    # small header (channel, CRC flag and offset estimate, timestamp and signal strength, see
+    # onebitbt.framing) to be sent as a FRAME_RECORD by a FramePrinter. Packets with a payload
+    # longer than max_payload are dropped.
+    def __init__(self, printer, channel=37, max_payload=37):
+        self.bitstream = Signal()
+        self.sample = Signal()
+        self.timestamp = Signal(32)
+        self.strength = Signal(16)
+        self.offset = Signal(signed(7)) # Carrier offset estimate, see onebitbt.bank
+        self.done = Signal()
+        self.debug = Signal()
+        self.printer = printer
+        self.channel = channel
+        self.max_payload = max_payload
+        self.lfsr = Whitener(channel)
+        self.crc = GaloisCRC()
+        self.state = Signal(3)
+        self.crc_matches = Signal()
+
+        # Single cycle pulses for the performance counters
+        self.header_done = Signal()
+        self.crc_passed = Signal()
+        self.crc_failed = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.lfsr = self.lfsr
+        m.submodules.crc = self.crc
+        m.submodules.payload_wport = wport = self.printer.mem.write_port()
+
+        dewhitened = Signal()
+        m.d.comb += dewhitened.eq(self.bitstream ^ self.lfsr.output)
+
+        byte = Signal(8)
+        bit_idx = Signal(3)
+        pdu_idx = Signal(8) # Which byte of the PDU we're on
+        length = Signal(8)
+
+        # Bits arrive LSB first, so shift them in from the top
+        next_byte = Cat(byte[1:8], dewhitened)
+
+        crc = Signal(24)
+        crc_idx = Signal(5)
+        m.d.comb += self.crc_matches.eq(Cat([self.crc.crc[i] == crc[24 - i - 1] for i in range(24)]).all())
+
+        timestamp = Signal(32)
+        strength = Signal(16)
+        offset = Signal(signed(7))
+        header = Array([
+            Value.cast(self.channel),
+            Cat(self.crc_matches, offset),
+            timestamp[0:8], timestamp[8:16], timestamp[16:24], timestamp[24:32],
+            strength[0:8], strength[8:16],
+        ])
+        header_idx = Signal(range(RECORD_HEADER))
+
+        with m.FSM() as fsm:
+            m.d.comb += self.state.eq(fsm.state)
+
+            with m.State("READ_PDU"):
+                with m.If(self.sample):
+                    m.d.sync += [
+                        byte.eq(next_byte),
+                        bit_idx.eq(bit_idx + 1),
+                        self.lfsr.run_strobe.eq(1),
+
+                        self.crc.input.eq(dewhitened),
+                        self.crc.en.eq(1),
+                    ]
+
+                    # Note when the packet started and keep track of how strong it is
+                    with m.If((pdu_idx == 0) & (bit_idx == 0)):
+                        m.d.sync += [
+                            timestamp.eq(self.timestamp),
+                            strength.eq(self.strength),
+                            offset.eq(self.offset),
+                        ]
+                    with m.Elif(self.strength > strength):
+                        m.d.sync += strength.eq(self.strength)
+
+                    with m.If(bit_idx == 7):
+                        m.d.comb += [
+                            wport.addr.eq(RECORD_HEADER + pdu_idx),
+                            wport.en.eq(1),
+                            wport.data.eq(next_byte),
+                        ]
+                        m.d.sync += pdu_idx.eq(pdu_idx + 1)
+
+                        with m.If(pdu_idx == 1):
+                            m.d.comb += self.header_done.eq(1)
+                            m.d.sync += length.eq(next_byte)
+                            with m.If(next_byte > self.max_payload):
+                                m.next = "DROP"
+                            with m.Elif(next_byte == 0):
+                                m.d.sync += crc_idx.eq(0)
+                                m.next = "READ_CRC"
+                        with m.Elif((pdu_idx > 1) & (pdu_idx == length + 1)):
+                            m.d.sync += crc_idx.eq(0)
+                            m.next = "READ_CRC"
+                with m.Else():
+                    m.d.sync += [
+                        self.lfsr.run_strobe.eq(0),
+                        self.lfsr.reset.eq(0),
+                        self.crc.en.eq(0),
+                        self.crc.reset.eq(0),
+                    ]
+
+            with m.State("READ_CRC"):
+                with m.If(self.sample):
+                    m.d.sync += [
+                        crc_idx.eq(crc_idx + 1),
+                        crc.eq(Cat(crc[1:24], dewhitened)),
+                        self.lfsr.run_strobe.eq(1),
+                        self.crc.en.eq(0),
+                    ]
+                    with m.If(self.strength > strength):
+                        m.d.sync += strength.eq(self.strength)
+                    with m.If(crc_idx == 23):
+                        m.d.sync += header_idx.eq(0)
+                        m.next = "WRITE_HEADER"
+                with m.Else():
+                    m.d.sync += [
+                        self.lfsr.run_strobe.eq(0),
+                        self.crc.en.eq(0)
+                    ]
+
+            with m.State("WRITE_HEADER"):
+                with m.If(header_idx == 0):
+                    m.d.comb += [
+                        self.crc_passed.eq(self.crc_matches),
+                        self.crc_failed.eq(~self.crc_matches),
+                    ]
+                m.d.sync += [
+                    self.lfsr.run_strobe.eq(0),
+                    self.crc.en.eq(0),
+                    header_idx.eq(header_idx + 1),
+                ]
+                m.d.comb += [
+                    wport.addr.eq(header_idx),
+                    wport.en.eq(1),
+                    wport.data.eq(header[header_idx]),
+                ]
+                with m.If(header_idx == RECORD_HEADER - 1):
+                    m.next = "START_READOUT"
+
+            with m.State("START_READOUT"):
+                m.d.comb += [
+                    self.debug.eq(1),
+                    self.printer.start.eq(1),
+                    self.printer.length.eq(RECORD_HEADER + 2 + length),
+                ]
+                m.next = "WAIT_READOUT"
+
+            with m.State("WAIT_READOUT"):
+                with m.If(self.printer.done):
+                    m.next = "READ_PDU"
+                    m.d.comb += self.done.eq(1)
+                    m.d.sync += [
+                        pdu_idx.eq(0),
+                        bit_idx.eq(0),
+                        self.lfsr.run_strobe.eq(0),
+                        self.lfsr.reset.eq(1),
+                        self.crc.reset.eq(1)
+                    ]
+
+            with m.State("DROP"):
+                m.next = "READ_PDU"
+                m.d.comb += self.done.eq(1)
+                m.d.sync += [
+                    pdu_idx.eq(0),
+                    bit_idx.eq(0),
+                    self.lfsr.run_strobe.eq(0),
+                    self.lfsr.reset.eq(1),
+                    self.crc.reset.eq(1)
+                ]
+
+        return m
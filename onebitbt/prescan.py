@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from onebitbt import ble, model
+from onebitbt.capture import iter_words, count_words
+
+# Finds where in a capture there might be packets, so that replaying it through the virtual radio
+# (see onebitbt.replay) only has to simulate around those. Most of a real capture is an idle
+# channel, and the simulator spends as long on that as on packets.
+#
+# This demodulates the whole capture with the numpy model (onebitbt.model), which is an order of
+# magnitude or two faster than the simulator, and slides the same preamble and access address the
+# synchronizer in BLERadio looks for along the baseband, one bit every symbol. Anywhere at least
+# `threshold` of the 40 bits match is a candidate. The candidates (offset in words of the start of
+# the preamble, channel and the number of matching bits) go in a JSON index next to the capture,
+# so it only has to be done once per capture:
+#
+#   python -m onebitbt.prescan capture.1bit --channels 37,38,39
+#   python -m onebitbt.radio replay capture.1bit --channels 37,38,39 --index
+
+# The preamble and advertising access address
+PATTERN = ble.advertising_pattern('1m')
+
+# SERDES words a second at 5GSPS
+WORD_RATE = 250e6
+
+# Baseband bits (sync cycles) per symbol
+SAMPLES_PER_SYMBOL = 25
+
+# From the first to the last pattern bit, in baseband bits
+SPAN = SAMPLES_PER_SYMBOL*(len(PATTERN) - 1)
+
+# The synchronizer wants all 40 bits, but the model's clocks aren't phased quite like the
+# simulator's and a missed candidate is a missed packet, so leave some slack
+THRESHOLD = 36
+
+# Words the model gets to settle (fill its filters) before its output counts
+WARMUP = 400
+
+# Words of capture each job scans
+PIECE = 1 << 22
+
+INDEX_VERSION = 1
+
+def index_path(capture):
+    return capture + '.idx'
+
+def correlate(baseband):
+    # Number of pattern bits that match starting at every offset the whole pattern fits
+    n = len(baseband) - SPAN
+    score = np.zeros(max(n, 0), dtype=np.int16)
+    for k, bit in enumerate(PATTERN):
+        score += baseband[SAMPLES_PER_SYMBOL*k:SAMPLES_PER_SYMBOL*k + len(score)] == bit
+    return score
+
+def peaks(score, threshold=THRESHOLD):
+    # The best offset of every run of offsets that make the threshold (the middle of the best
+    # ones, like the synchronizer) as (offset, score)
+    hits = np.flatnonzero(score >= threshold)
+    found = []
+    for run in np.split(hits, np.flatnonzero(np.diff(hits) > SAMPLES_PER_SYMBOL) + 1):
+        if len(run):
+            best = run[score[run] == score[run].max()]
+            found.append((int(best[len(best)//2]), int(score[best[0]])))
+    return found
+
+def scan_piece(job):
+    capture, channel, demodulator, threshold, core_start, core_end = job
+    start = max(0, core_start - WARMUP)
+    start -= start % (4*model.SYNC_RATIO)
+    end = core_end + (SPAN + SAMPLES_PER_SYMBOL)*model.SYNC_RATIO
+    demod = model.DEMODULATORS[demodulator](frequency=ble.channel_frequency(channel))
+    baseband = np.concatenate([demod.process(words) for words in iter_words(capture, start=start, count=end - start)]
+        + [np.zeros(0, dtype=np.uint8)])
+
+    candidates = []
+    for offset, score in peaks(correlate(baseband), threshold):
+        # Back from the middle of the first preamble symbol to its start
+        offset = start + offset*model.SYNC_RATIO - SAMPLES_PER_SYMBOL*model.SYNC_RATIO//2
+        if core_start <= offset < core_end or (offset < 0 and core_start == 0):
+            candidates.append((max(0, offset), channel, score))
+    return candidates
+
+def scan(capture, channels, demodulator='fsk', threshold=THRESHOLD, jobs=None, piece=PIECE):
+    # Candidates as (word offset, channel, score), sorted by offset
+    total = count_words(capture)
+    work = [(capture, channel, demodulator, threshold, core, min(total, core + piece))
+        for channel in channels for core in range(0, total, piece)]
+    with ProcessPoolExecutor(jobs or os.cpu_count()) as pool:
+        return sorted(c for found in pool.map(scan_piece, work) for c in found)
+
+def stat(capture):
+    info = os.stat(capture)
+    return {'size': info.st_size, 'mtime': info.st_mtime}
+
+def write_index(capture, candidates, channels, demodulator, threshold):
+    index = {
+        'version': INDEX_VERSION,
+        'capture': os.path.basename(capture),
+        'words': count_words(capture),
+        'channels': list(channels),
+        'demodulator': demodulator,
+        'threshold': threshold,
+        'candidates': [list(c) for c in candidates],
+    }
+    index.update(stat(capture))
+    path = index_path(capture)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+    return index
+
+def read_index(capture, channels, demodulator='fsk', threshold=THRESHOLD):
+    # The index for the capture, or None if there isn't one or it doesn't cover this
+    try:
+        with open(index_path(capture)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    current = dict(stat(capture), version=INDEX_VERSION, demodulator=demodulator)
+    if any(index.get(key) != value for key, value in current.items()):
+        return None
+    if not set(channels) <= set(index['channels']) or index['threshold'] > threshold:
+        return None
+    return index
+
+def load_index(capture, channels, demodulator='fsk', threshold=THRESHOLD, jobs=None):
+    # The candidates on `channels`, scanning the capture first if the index is missing or stale
+    index = read_index(capture, channels, demodulator, threshold)
+    if index is None:
+        start = time.time()
+        candidates = scan(capture, channels, demodulator, threshold, jobs)
+        index = write_index(capture, candidates, channels, demodulator, threshold)
+        print("Scanned {} in {:.1f}s".format(capture, time.time() - start), file=sys.stderr)
+    return [tuple(c) for c in index['candidates'] if c[1] in channels and c[2] >= threshold]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index where the packets in a capture might be")
+    parser.add_argument('capture', help='text or packed capture of SERDES samples')
+    parser.add_argument('--channels', default='37', help='comma separated channels to look on, e.g. 37,38,39')
+    parser.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk',
+        help='use the CORDIC phase demodulator instead of the FSK one')
+    parser.add_argument('--threshold', type=int, default=THRESHOLD, help='pattern bits (of 40) that have to match')
+    parser.add_argument('--jobs', type=int, default=None, help='processes to scan with (default: one per core)')
+    parser.add_argument('--list', action='store_true', help='print every candidate')
+    args = parser.parse_args()
+
+    channels = [int(channel) for channel in args.channels.split(',')]
+    start = time.time()
+    candidates = scan(args.capture, channels, args.demodulator, args.threshold, args.jobs)
+    write_index(args.capture, candidates, channels, args.demodulator, args.threshold)
+    if args.list:
+        for offset, channel, score in candidates:
+            print("{:12.6f} ch{} {}/{}".format(offset/WORD_RATE, channel, score, len(PATTERN)))
+    print("{} candidates in {:.1f}s, written to {}".format(len(candidates), time.time() - start, index_path(args.capture)))
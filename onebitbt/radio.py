@@ -6,35 +6,246 @@ from nmigen.build import Resource, Pins, Attrs
 from alldigitalradio.io.generic_serdes import get_serdes_implementation
 import alldigitalradio.hardware as hardware
 
-from alldigitalradio.mixer import SummingMixer
-from alldigitalradio.filter import RunningBoxcarFilter
-from alldigitalradio.trig import MagnitudeApproximator
 from alldigitalradio.sync import CorrelativeSynchronizer
 
-from onebitbt.parser import PacketParser
+from onebitbt.demodulator import DEMODULATORS
+from onebitbt.parser import PacketParser, RawPacketCapture, PacketRecorder
+from onebitbt.framing import FramePrinter, FRAME_RAW, FRAME_RECORD
+from onebitbt.arbiter import PrinterArbiter
+from onebitbt.ring import PacketRing
+from onebitbt.stats import StatsBlock, COMMAND_SNAPSHOT, COMMAND_CLEAR, SCAN_LANE, lane_name
+from onebitbt.dedup import DedupFilter
+from onebitbt.scan import ChannelScanner, COMMAND_RESUME, parse_channels as scan_channels
+from onebitbt.synchronizer import FractionalSynchronizer
+from onebitbt.bank import OffsetBank, parse_offsets
+from onebitbt.ble import CHANNELS, PHYS, channel_frequency, advertising_pattern, demodulator_options
 from onebitbt.clocking import ClockDivider4
+from onebitbt import buildcache
 
 from serialcommander.uart import UART
 from serialcommander.commander import Commander
 from serialcommander.printer import TextMemoryPrinter, BinarySignalPrinter, BinaryMemoryPrinter
 from serialcommander.toggler import Toggler
 
+# What gets sent out over the UART:
+#   text     the names of advertising devices, as text
+#   raw      binary frames of the raw bits of every packet, parsed on the host (onebitbt.host)
+#   records  binary frames of every dewhitened packet with its CRC status, a timestamp and
+#            signal strength (also decoded by onebitbt.host)
+MODES = ('text', 'raw', 'records')
+
+# How the lanes turn the SERDES words into baseband bits (see onebitbt.demodulator):
+#   fsk    compare the magnitudes of the two tones (the default)
+#   phase  CORDIC phase discriminator on a single mixer at the channel center
+DEMODULATOR_NAMES = tuple(DEMODULATORS)
+
+# Which PHY the lanes receive (see onebitbt.ble.PHYS): 1m, or 2m for the secondary advertising
+# channels. The demodulators' filters scale with the symbol rate, and at 2M there are 12.5 sync
+# cycles a symbol so the lanes use onebitbt.synchronizer instead.
+PHY_NAMES = tuple(PHYS)
+
+class ReceiveLane(Elaboratable):
+    # Everything needed to pull packets off a single channel: demodulator, synchronizer,
+    # parser (with the whitener seeded for the channel) and a ring of `slots` printers to read
+    # packets out while the parser gets on with the next one. Depending on the mode the parser
+    # is a PacketParser, RawPacketCapture or PacketRecorder. With dedup (a number of table
+    # entries) repeats of the same packet within dedup_ttl_ms are dropped on the way to the ring,
+    # see onebitbt.dedup.
+    #
+    # Given a list of channels to scan instead, the lane retunes itself between them every
+    # dwell_ms (see onebitbt.scan) and shows up in the stats as SCAN_LANE.
+    #
+    # With a list of offsets (in Hz) there's a demodulator for each offset from the channel
+    # frequency and every packet gets parsed from the one that synced best, see onebitbt.bank.
+    def __init__(self, channel=37, mode='text', slots=4, demodulator='fsk', dedup=0, dedup_ttl_ms=1000, scan=None, dwell_ms=10,
+            phy='1m', offsets=None):
+        if scan and offsets:
+            raise ValueError("A scan lane can't have an offset bank")
+        self.mode = mode
+        self.demodulator = demodulator
+        self.phy = phy
+        self.offsets = offsets
+        if scan:
+            self.scanner = ChannelScanner(scan, dwell_ms)
+            self.channel = self.scanner.channel
+            self.id = SCAN_LANE
+        else:
+            self.scanner = None
+            self.channel = channel
+            self.id = channel
+        self.input = Signal(20)
+        self.timestamp = Signal(32)
+        self.ring = PacketRing([self.make_printer() for _ in range(slots)])
+        self.dedup = DedupFilter(self.ring.writer, dedup, dedup_ttl_ms) if dedup else None
+
+        # The ring is what gets shared with the other lanes
+        self.printer = self.ring
+
+        # Pulses for the performance counters
+        self.synced = Signal()
+        self.header_done = Signal()
+        self.crc_passed = Signal()
+        self.crc_failed = Signal()
+        self.suppressed = Signal()
+        self.retuned = Signal()
+        self.retuning = Signal()
+
+    def make_printer(self):
+        if self.mode == 'raw':
+            return FramePrinter(Memory(width=8, depth=64), FRAME_RAW)
+        elif self.mode == 'records':
+            return FramePrinter(Memory(width=8, depth=64), FRAME_RECORD)
+        else:
+            return TextMemoryPrinter(Memory(width=8, depth=32), 32)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.ring = ring = self.ring
+        printer = ring.writer
+        if self.dedup:
+            m.submodules.dedup = printer = self.dedup
+
+        # Demodulate the incoming data down to a single bit at baseband
+        options = demodulator_options(self.phy, self.demodulator)
+        samples_per_symbol = 25e6/PHYS[self.phy].symbol_rate
+        pattern = advertising_pattern(self.phy)
+        synchronizer = None
+        if self.scanner:
+            m.submodules.scanner = scanner = self.scanner
+            m.submodules.demodulator = demodulator = DEMODULATORS[self.demodulator](
+                frequency=channel_frequency(scanner.channel.reset), retunable=True, **options)
+            m.d.comb += [
+                demodulator.channel.eq(scanner.channel),
+                demodulator.retune.eq(scanner.retune),
+                scanner.tuned.eq(demodulator.tuned),
+            ]
+        elif self.offsets:
+            # The bank synchronizes too, and hands over the baseband of whichever demodulator won
+            m.submodules.bank = synchronizer = OffsetBank(pattern, samples_per_symbol, self.offsets)
+            for i, offset in enumerate(self.offsets):
+                demodulator = DEMODULATORS[self.demodulator](frequency=channel_frequency(self.channel) + offset, **options)
+                m.submodules["demodulator{}".format(i)] = demodulator
+                m.d.comb += [
+                    demodulator.input.eq(self.input),
+                    synchronizer.inputs[i].eq(demodulator.baseband),
+                    synchronizer.strengths[i].eq(demodulator.strength),
+                ]
+            baseband = synchronizer.bitstream
+            strength = synchronizer.strength
+        else:
+            m.submodules.demodulator = demodulator = DEMODULATORS[self.demodulator](frequency=channel_frequency(self.channel),
+                **options)
+        if synchronizer is None:
+            m.d.comb += demodulator.input.eq(self.input)
+            baseband = demodulator.baseband
+            strength = demodulator.strength
+
+            # Synchronize by looking for the start of an advertizing packet
+            if samples_per_symbol == int(samples_per_symbol):
+                synchronizer = CorrelativeSynchronizer(pattern, samples_per_symbol=int(samples_per_symbol))
+            else:
+                synchronizer = FractionalSynchronizer(pattern, samples_per_symbol)
+            m.submodules.synchronizer = synchronizer
+            m.d.comb += synchronizer.input.eq(baseband)
+
+        # Now parse the synchronized data
+        if self.mode == 'raw':
+            m.submodules.parser = parser = RawPacketCapture(printer, channel=self.channel)
+        elif self.mode == 'records':
+            m.submodules.parser = parser = PacketRecorder(printer, channel=self.channel)
+            m.d.comb += [
+                parser.timestamp.eq(self.timestamp),
+                parser.strength.eq(strength),
+            ]
+            if self.offsets:
+                m.d.comb += parser.offset.eq(synchronizer.offset)
+        else:
+            m.submodules.parser = parser = PacketParser(printer=printer, channel=self.channel)
+        m.d.comb += [
+            parser.sample.eq(synchronizer.sample_strobe),
+            parser.bitstream.eq(baseband),
+            synchronizer.reset.eq(parser.done),
+            ring.packet_done.eq(parser.done),
+        ]
+        if self.scanner:
+            # Nothing the demodulator says while it's retuning means anything, and the whitener
+            # needs the new channel's seed
+            with m.If(~demodulator.tuned):
+                m.d.comb += synchronizer.reset.eq(1)
+            if hasattr(parser, 'lfsr'):
+                m.d.comb += parser.lfsr.load.eq(self.scanner.retune)
+        if self.dedup:
+            # Hash the dewhitened bits, so the scan lane sees the same PDU the same way on every
+            # channel. The raw capture doesn't dewhiten, but never suppresses anything either.
+            dewhitened = baseband ^ parser.lfsr.output if hasattr(parser, 'lfsr') else baseband
+            m.d.comb += [
+                self.dedup.sample.eq(synchronizer.sample_strobe),
+                self.dedup.bitstream.eq(dewhitened),
+                self.dedup.checked.eq(parser.crc_passed | parser.crc_failed),
+                self.dedup.crc_ok.eq(parser.crc_passed),
+                self.dedup.packet_done.eq(parser.done),
+                self.suppressed.eq(self.dedup.suppressed),
+            ]
+
+        # The first sample strobe after the parser was done means the synchronizer locked on
+        in_packet = Signal()
+        with m.If(parser.done):
+            m.d.sync += in_packet.eq(0)
+        with m.Elif(synchronizer.sample_strobe):
+            m.d.sync += in_packet.eq(1)
+        m.d.comb += [
+            self.synced.eq(synchronizer.sample_strobe & ~in_packet),
+            self.header_done.eq(parser.header_done),
+            self.crc_passed.eq(parser.crc_passed),
+            self.crc_failed.eq(parser.crc_failed),
+        ]
+        if self.scanner:
+            m.d.comb += [
+                self.scanner.busy.eq(in_packet),
+                self.retuned.eq(self.scanner.retune),
+                self.retuning.eq(~demodulator.tuned),
+            ]
+
+        return m
+
 class BLERadio(Elaboratable):
-    def __init__(self):
+    def __init__(self, channels=[37], mode='text', baud=115200, slots=4, demodulator='fsk', dedup=0, dedup_ttl_ms=1000,
+            scan=None, dwell_ms=10, phy='1m', offsets=None):
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}".format(mode))
+        if demodulator not in DEMODULATORS:
+            raise ValueError("Unknown demodulator {}".format(demodulator))
+        if phy not in PHYS:
+            raise ValueError("Unknown PHY {}".format(phy))
+        self.channels = channels
+        self.mode = mode
         self.serdes = get_serdes_implementation()()
-        self.uart = UART(int(25e6/115200))
+        # The UART runs off the 25MHz sync clock, so bauds that divide it evenly (1000000,
+        # 3125000, ...) are exact and everything else is off by a bit
+        self.uart = UART(round(25e6/baud))
+        self.lanes = [ReceiveLane(channel, mode=mode, slots=slots, demodulator=demodulator, dedup=dedup,
+            dedup_ttl_ms=dedup_ttl_ms, phy=phy, offsets=offsets) for channel in channels]
+        # Plus a lane that hops between the `scan` channels (see onebitbt.scan)
+        self.scanner = None
+        if scan:
+            lane = ReceiveLane(mode=mode, slots=slots, demodulator=demodulator, dedup=dedup, dedup_ttl_ms=dedup_ttl_ms,
+                scan=scan, dwell_ms=dwell_ms, phy=phy)
+            self.lanes.append(lane)
+            self.scanner = lane.scanner
+        self.stats = StatsBlock([lane.id for lane in self.lanes])
 
     def elaborate(self, platform):
         m = Module()
         m.submodules.serdes = serdes = self.serdes
 
-        # Set up a UART and a printer (and directly connectt the printer to the UART)
+        # Set up a UART and share it between the printers of every lane (and the stats)
         m.submodules.uart = uart = self.uart
-        m.submodules.printer = printer = TextMemoryPrinter(Memory(width=8, depth=32), 32)
+        m.submodules.stats = stats = self.stats
+        m.submodules.arbiter = arbiter = PrinterArbiter([lane.printer for lane in self.lanes] + [stats.printer])
         m.d.comb += [
-            uart.tx_data.eq(printer.tx_data),
-            uart.tx_rdy.eq(printer.tx_rdy),
-            printer.tx_ack.eq(uart.tx_ack),
+            uart.tx_data.eq(arbiter.tx_data),
+            uart.tx_rdy.eq(arbiter.tx_rdy),
+            arbiter.tx_ack.eq(uart.tx_ack),
         ]
         if platform:
             m.d.comb += [
@@ -45,65 +256,112 @@ class BLERadio(Elaboratable):
         # Set up a clock divider on the RX clock because we can't do everything at 250MHz
         m.submodules.clockdivider = ClockDivider4("rx", "rxdiv4")
 
-        # Mix the incoming data down to BB
-        m.submodules.mixerHigh = mixerHigh = SummingMixer(sample_rate=5e9, frequency=2.40225e9, max_error=0.0001, domain="rx")
-        m.submodules.mixerLow = mixerLow = SummingMixer(sample_rate=5e9, frequency=2.40175e9, max_error=0.0001, domain="rx")
-        m.d.comb += [
-            mixerHigh.input.eq(serdes.rx_data),
-            mixerLow.input.eq(serdes.rx_data)
-        ]
+        # The SERDES sees the whole band at once, so every channel just gets its own lane
+        # hanging off the same stream of words
+        timestamp = Signal(32)
+        m.d.sync += timestamp.eq(timestamp + 1)
+        for lane in self.lanes:
+            m.submodules["lane{}".format(lane_name(lane.id))] = lane
+            m.d.comb += [
+                lane.input.eq(serdes.rx_data),
+                lane.timestamp.eq(timestamp),
+            ]
 
-        # Now add low pass filters on the outputs
-        width = 64
-        m.submodules.lpfHighI = lpfHighI = RunningBoxcarFilter(width, domain="rxdiv4")
-        m.submodules.lpfHighQ = lpfHighQ = RunningBoxcarFilter(width, domain="rxdiv4")
-        m.submodules.lpfLowI = lpfLowI = RunningBoxcarFilter(width, domain="rxdiv4")
-        m.submodules.lpfLowQ = lpfLowQ = RunningBoxcarFilter(width, domain="rxdiv4")
+        # Performance counters, which get read out (or cleared) by sending a command over the UART
+        events = stats.events
         m.d.comb += [
-            lpfHighI.input.eq(mixerHigh.outputIsum),
-            lpfHighQ.input.eq(mixerHigh.outputQsum),
-            lpfLowI.input.eq(mixerLow.outputIsum),
-            lpfLowQ.input.eq(mixerLow.outputQsum),
+            events['uptime'].eq(1),
+            events['uart_stalls'].eq(arbiter.waiting[:len(self.lanes)].any()),
         ]
+        for lane in self.lanes:
+            prefix = '{}.'.format(lane_name(lane.id))
+            m.d.comb += [
+                events[prefix + 'syncs'].eq(lane.synced),
+                events[prefix + 'headers'].eq(lane.header_done),
+                events[prefix + 'crc_ok'].eq(lane.crc_passed),
+                events[prefix + 'crc_fail'].eq(lane.crc_failed),
+                events[prefix + 'dropped'].eq(lane.ring.drop),
+                events[prefix + 'ring_full'].eq(lane.ring.full),
+                events[prefix + 'suppressed'].eq(lane.suppressed),
+            ]
+            if lane.scanner:
+                m.d.comb += [
+                    events['retunes'].eq(lane.retuned),
+                    events['retuning'].eq(lane.retuning),
+                ]
 
-        # Next compute the magnitude of the low-pass-filtered I and Q
-        # These are fully combinatoric so don't need a domain specified
-        m.submodules.highMag = highMag = MagnitudeApproximator()
-        m.submodules.lowMag = lowMag = MagnitudeApproximator()
-        m.d.comb += [
-            highMag.inputI.eq(lpfHighI.output),
-            highMag.inputQ.eq(lpfHighQ.output),
-            lowMag.inputI.eq(lpfLowI.output),
-            lowMag.inputQ.eq(lpfLowQ.output),
-        ]
+        m.d.comb += uart.rx_ack.eq(uart.rx_rdy)
+        with m.If(uart.rx_rdy):
+            m.d.comb += [
+                stats.request.eq(uart.rx_data == COMMAND_SNAPSHOT),
+                stats.clear.eq(uart.rx_data == COMMAND_CLEAR),
+            ]
+            if self.scanner:
+                # 0x80 + channel (onebitbt.scan.COMMAND_TUNE) parks the scan lane
+                m.d.comb += [
+                    self.scanner.select.eq(uart.rx_data[7] & (uart.rx_data[:7] < CHANNELS)),
+                    self.scanner.select_channel.eq(uart.rx_data),
+                    self.scanner.resume.eq(uart.rx_data == COMMAND_RESUME),
+                ]
 
-        # Finally, compare the two magnitudes
-        # (We need to pipeline this a bit to meet timing)
-        diff = Signal(signed(32))
-        baseband = Signal()
-        m.d.rxdiv4 += diff.eq(highMag.magnitude - lowMag.magnitude)
-        m.d.sync += baseband.eq(diff > 0)
-
-        # Synchronize by looking for the start of an advertizing packet
-        pattern = [
-        0, 1, 0, 1, 0, 1, 0, 1, # Training sequence
-        0, 1, 1, 0, 1, 0, 1, 1, # Advertizing access address
-        0, 1, 1, 1, 1, 1, 0, 1,
-        1, 0, 0, 1, 0, 0, 0, 1,
-        0, 1, 1, 1, 0, 0, 0, 1]
-        m.submodules.synchronizer = synchronizer = CorrelativeSynchronizer(pattern, samples_per_symbol=25)
-        m.d.comb += synchronizer.input.eq(baseband)
+        return m
 
-        # Now parse the synchronized data
-        m.submodules.parser = parser = PacketParser(printer=printer)
-        m.d.comb += [
-            parser.sample.eq(synchronizer.sample_strobe),
-            parser.bitstream.eq(baseband),
-            synchronizer.reset.eq(parser.done)
-        ]
+def parse_channels(text):
+    return [int(channel) for channel in text.split(',')]
 
-        return m
+def parse_options(args):
+    # `[channels] [--raw | --records] [--baud N] [--phase] [--2m] [--offsets KHZ,...] [--dedup N [--ttl MS]]
+    #  [--scan CHANNELS [--dwell MS]] [--program-only | --rebuild]`
+    # With --scan and no channels there's only the scan lane
+    options = {'channels': None, 'mode': 'text', 'baud': 115200, 'demodulator': 'fsk', 'dedup': 0, 'ttl': 1000,
+        'scan': None, 'dwell': 10, 'phy': '1m', 'offsets': None, 'program_only': False, 'rebuild': False}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--raw':
+            options['mode'] = 'raw'
+        elif arg == '--records':
+            options['mode'] = 'records'
+        elif arg == '--baud':
+            options['baud'] = int(args.pop(0))
+        elif arg == '--phase':
+            options['demodulator'] = 'phase'
+        elif arg == '--2m':
+            options['phy'] = '2m'
+        elif arg == '--offsets':
+            options['offsets'] = parse_offsets(args.pop(0))
+        elif arg == '--dedup':
+            options['dedup'] = int(args.pop(0))
+        elif arg == '--ttl':
+            options['ttl'] = int(args.pop(0))
+        elif arg == '--scan':
+            options['scan'] = scan_channels(args.pop(0))
+        elif arg == '--dwell':
+            options['dwell'] = float(args.pop(0))
+        elif arg == '--program-only':
+            options['program_only'] = True
+        elif arg == '--rebuild':
+            options['rebuild'] = True
+        else:
+            options['channels'] = parse_channels(arg)
+    if options['channels'] is None:
+        options['channels'] = [] if options['scan'] else [37]
+    return options
 
 if __name__ == '__main__':
-    with hardware.use(sys.argv[1]) as platform:
-        platform().build(BLERadio(), do_program=True)
\ No newline at end of file
+    if sys.argv[1] == 'virtual':
+        from onebitbt.virtual import main
+        main(sys.argv[2:], BLERadio)
+    elif sys.argv[1] == 'replay':
+        from onebitbt.replay import main
+        main(sys.argv[2:], BLERadio)
+    elif sys.argv[1] == 'latency':
+        from onebitbt.latency import main
+        main(sys.argv[2:], BLERadio)
+    else:
+        with hardware.use(sys.argv[1]) as platform:
+            options = parse_options(sys.argv[2:])
+            radio = BLERadio(options['channels'], mode=options['mode'], baud=options['baud'], demodulator=options['demodulator'],
+                dedup=options['dedup'], dedup_ttl_ms=options['ttl'], scan=options['scan'], dwell_ms=options['dwell'],
+                phy=options['phy'], offsets=options['offsets'])
+            buildcache.build(platform(), radio, program_only=options['program_only'], rebuild=options['rebuild'])
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import alldigitalradio.hardware as hardware
+
+from onebitbt import virtual
+from onebitbt.bank import parse_offsets, offset_args
+from onebitbt.capture import count_words
+from onebitbt.framing import RECORD_HEADER
+from onebitbt.host import decode_stream, format_reception
+from onebitbt.symbols import MAX_SYMBOLS
+
+# Sharded replay of long captures through the virtual radio (see onebitbt.virtual). One simulator
+# chews through a few million SERDES words a second at best, so a minute at 5GSPS takes hours.
+# Instead, the capture is split into segments that each get their own simulator (and so a
+# freshly reset BLERadio), run in parallel, and the packets they find are merged back together.
+#
+# Every segment owns a stretch of the capture (its core) but simulates a bit either side of it:
+# a lead in before, for the synchronizer to see the preamble and access address of packets that
+# start just before the core, and the longest packet after, so every packet that starts in the
+# core also ends in the segment. Each segment is followed by enough silence for the UART to finish
+# sending what it found. The radio runs in record mode so every packet comes with a timestamp,
+# which (plus where the segment started) tells us where in the capture it was, and a segment only
+# keeps the packets that landed in its core. Packets cut off at the edge of a segment (that
+# another segment has whole) are dropped that way too.
+#
+#   python -m onebitbt.radio replay capture.1bit --channels 37,38,39 --jobs 16
+#
+# With --index, only windows around the candidates onebitbt.prescan finds get simulated (scanning
+# the capture first if it hasn't been), which skips all the idle channel in between.
+
+# SERDES words per microsecond (i.e. per symbol) at 5GSPS
+WORDS_PER_US = 250
+
+# Preamble and access address, plus some time for the filters and synchronizer to settle
+LEAD_US = 64
+
+# Segments start on a whole rxdiv4 cycle so they all see the same clock phases
+ALIGN = 4*virtual.SYNC_RATIO
+
+# Just in case two segments disagree about which side of a core boundary a packet was on, the
+# same packet this close together (in sync cycles) is only reported once
+TOLERANCE = 50
+
+# Segments are at least this many overlaps long, so the overlap stays a small overhead
+MIN_SEGMENT = 16
+
+def overlap_words():
+    return (LEAD_US + MAX_SYMBOLS)*WORDS_PER_US
+
+def drain_words(divisor, slots=4, max_payload=37):
+    # Silence to let the UART send a full ring of records (framing adds 5 bytes, 10 bits a byte)
+    frame = RECORD_HEADER + 2 + max_payload + 5
+    return slots*frame*10*divisor*virtual.SYNC_RATIO
+
+def plan(total, segment, overlap=None):
+    # (start, count, core_start, core_end) in words for each segment
+    overlap = overlap_words() if overlap is None else overlap
+    segment = max(ALIGN, segment - segment % ALIGN)
+    segments = []
+    for core in range(0, total, segment):
+        start = max(0, core - overlap)
+        start -= start % ALIGN
+        end = min(total, core + segment + overlap)
+        segments.append((start, end - start, core, min(total, core + segment)))
+    return segments
+
+def windows(offsets, total, overlap=None):
+    # Segments that simulate just around packets starting at each of `offsets`, merging the ones
+    # that overlap. Every segment is its own core.
+    overlap = overlap_words() if overlap is None else overlap
+    lead = LEAD_US*WORDS_PER_US
+    segments = []
+    for offset in sorted(offsets):
+        start = max(0, offset - lead)
+        start -= start % ALIGN
+        end = min(total, offset + overlap)
+        if segments and start <= segments[-1][1]:
+            segments[-1][1] = max(segments[-1][1], end)
+        else:
+            segments.append([start, end])
+    return [(start, end - start, start, end) for start, end in segments]
+
+def keep(receptions, start, core_start, core_end):
+    # Receptions with timestamps in the core, counted from the start of the capture rather than
+    # the start of the segment
+    offset = start//virtual.SYNC_RATIO
+    core = range(core_start//virtual.SYNC_RATIO, core_end//virtual.SYNC_RATIO)
+    receptions = [r._replace(timestamp=r.timestamp + offset) for r in receptions]
+    return [r for r in receptions if r.timestamp in core]
+
+def replay_segment(job):
+    binary, capture, divisor, (start, count, core_start, core_end) = job
+    data = virtual.run(binary, capture, output=None, divisor=divisor, start=start, count=count,
+        pad=drain_words(divisor))
+    return keep(decode_stream([data]), start, core_start, core_end)
+
+def identity(reception):
+    packet = reception.packet
+    return (packet.channel, packet.pdu_type, packet.address, bytes(packet.payload), packet.crc_ok)
+
+def merge(segments):
+    # All receptions from all segments, in capture order
+    receptions = sorted((r for found in segments for r in found), key=lambda r: r.timestamp)
+    merged = []
+    last = {}
+    for reception in receptions:
+        key = identity(reception)
+        if key in last and reception.timestamp - last[key] <= TOLERANCE:
+            continue
+        last[key] = reception.timestamp
+        merged.append(reception)
+    return merged
+
+def replay(binary, capture, divisor, jobs=None, segment=None, candidates=None, run=replay_segment):
+    # candidates are word offsets to simulate around (see onebitbt.prescan), or None for all of it
+    jobs = jobs or os.cpu_count()
+    total = count_words(capture)
+    if candidates is not None:
+        parts = windows(candidates, total)
+    else:
+        if segment is None:
+            # A few segments per job so the stragglers even out
+            segment = max(MIN_SEGMENT*overlap_words(), -(-total//(4*jobs)))
+        parts = plan(total, segment)
+    work = [(binary, capture, divisor, part) for part in parts]
+    with ProcessPoolExecutor(jobs) as pool:
+        return merge(pool.map(run, work)), parts
+
+def main(args, make_radio):
+    parser = argparse.ArgumentParser(prog='python -m onebitbt.radio replay')
+    parser.add_argument('capture', help='text or packed capture of SERDES samples')
+    parser.add_argument('--channels', default='37', help='comma separated channels to receive on, e.g. 37,38,39')
+    parser.add_argument('--jobs', type=int, default=None, help='simulators to run at once (default: one per core)')
+    parser.add_argument('--segment-ms', type=float, default=None, help='capture time per segment')
+    parser.add_argument('--baud', type=int, default=3125000, help='of the simulated UART, faster drains quicker')
+    parser.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk',
+        help='use the CORDIC phase demodulator instead of the FSK one')
+    parser.add_argument('--2m', dest='phy', action='store_const', const='2m', default='1m',
+        help='receive the LE 2M PHY instead of 1M')
+    parser.add_argument('--offsets', default=None, help='kHz offsets to demodulate at, e.g. -150,-75,0,75,150')
+    parser.add_argument('--build-dir', default=None, help='where to cache simulator builds')
+    parser.add_argument('--index', action='store_true',
+        help='only simulate around the packets onebitbt.prescan finds (scanning first if needed)')
+    parser.add_argument('--threshold', type=int, default=None, help='pattern bits (of 40) a candidate needs with --index')
+    args = parser.parse_args(offset_args(args))
+    if args.index and args.phy != '1m':
+        # The prescan only knows the 1M pattern
+        parser.error("--index only works on the 1M PHY")
+
+    channels = [int(channel) for channel in args.channels.split(',')]
+    with hardware.use('virtual'):
+        radio = make_radio(channels, mode='records', baud=args.baud, demodulator=args.demodulator, phy=args.phy,
+            offsets=parse_offsets(args.offsets) if args.offsets else None)
+        binary = virtual.build(radio, args.build_dir)
+
+    candidates = None
+    if args.index:
+        from onebitbt import prescan
+        threshold = prescan.THRESHOLD if args.threshold is None else args.threshold
+        found = prescan.load_index(args.capture, channels, args.demodulator, threshold, args.jobs)
+        candidates = [offset for offset, channel, score in found]
+
+    segment = None if args.segment_ms is None else int(args.segment_ms*1000*WORDS_PER_US)
+    start = time.time()
+    receptions, parts = replay(binary, args.capture, radio.uart.divisor, args.jobs, segment, candidates)
+    for reception in receptions:
+        print(format_reception(reception))
+    simulated = sum(count for _, count, _, _ in parts)/max(1, count_words(args.capture))
+    print("{} packets from {} segments ({:.1%} of the capture) in {:.1f}s".format(
+        len(receptions), len(parts), simulated, time.time() - start), file=sys.stderr)
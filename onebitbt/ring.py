@@ -0,0 +1,135 @@
+from nmigen import Elaboratable, Module, Signal, Array, Mux
+
+# Decouples parsing from output. Sending a packet out over the UART takes milliseconds, and any
+# packet that shows up while the parser waits for that is lost, which is most of them when
+# devices advertise back to back. So instead the parser writes into one of N slots (each with its
+# own BRAM and printer) and hands it off straight away, while a drain engine prints full slots
+# one after another. If every slot is full when a packet comes in, it's dropped and counted.
+
+class SlotWritePort(Elaboratable):
+    # Looks like a memory write port to the parser, but writes land in whichever slot the ring
+    # is currently filling (and nowhere if the ring is full)
+    def __init__(self, ring):
+        self.ring = ring
+        self.addr = Signal(range(ring.slot_depth))
+        self.data = Signal(8)
+        self.en = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        for i, mem in enumerate(self.ring.mems):
+            m.submodules["slot{}".format(i)] = port = mem.write_port()
+            m.d.comb += [
+                port.addr.eq(self.addr),
+                port.data.eq(self.data),
+                port.en.eq(self.en & (self.ring.write_slot == i) & ~self.ring.full),
+            ]
+        return m
+
+class SlotMemory:
+    def __init__(self, port):
+        self.port = port
+
+    def write_port(self):
+        return self.port
+
+class RingWriter:
+    # What the parser gets in place of a printer. done follows start a cycle later, the packet
+    # is either in the ring or dropped by then.
+    def __init__(self, ring):
+        self.port = SlotWritePort(ring)
+        self.mem = SlotMemory(self.port)
+        self.start = Signal()
+        self.done = Signal()
+        self.length = Signal(8)
+
+class PacketRing(Elaboratable):
+    # printers is one printer per slot, each with its own mem. The drain side has the same
+    # interface as a printer so a PrinterArbiter can share the UART between several rings.
+    # Pulse packet_done at the end of every packet (good or bad) so a packet that was partially
+    # written while the ring was full isn't held against the next one.
+    def __init__(self, printers):
+        self.printers = printers
+        self.mems = [printer.mem for printer in printers]
+        self.slot_depth = max(mem.depth for mem in self.mems)
+
+        n = len(printers)
+        self.write_slot = Signal(range(n))
+        self.read_slot = Signal(range(n))
+        self.count = Signal(range(n + 1))
+        self.full = Signal()
+        self.dropped = Signal(16)
+        self.drop = Signal() # Pulses whenever a packet gets dropped
+        self.packet_done = Signal()
+
+        self.writer = RingWriter(self)
+
+        self.start = Signal()
+        self.done = Signal()
+        self.tx_data = Signal(8)
+        self.tx_rdy = Signal()
+        self.tx_ack = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        n = len(self.printers)
+        for i, printer in enumerate(self.printers):
+            m.submodules["printer{}".format(i)] = printer
+
+        m.d.comb += self.full.eq(self.count == n)
+
+        lengths = Array(Signal(8, name="length{}".format(i)) for i in range(n))
+        advance = lambda slot: Mux(slot == n - 1, 0, slot + 1)
+
+        # Filling. `polluted` remembers that some of this packet was written while we had no
+        # free slot, in which case a slot that frees up halfway through would get half a packet.
+        polluted = Signal()
+        committed = Signal()
+        m.d.sync += self.writer.done.eq(self.writer.start)
+        with m.If(self.writer.start):
+            m.d.sync += polluted.eq(0)
+            with m.If(self.full | polluted):
+                m.d.comb += self.drop.eq(1)
+                m.d.sync += self.dropped.eq(self.dropped + 1)
+            with m.Else():
+                m.d.comb += committed.eq(1)
+                m.d.sync += [
+                    lengths[self.write_slot].eq(self.writer.length),
+                    self.write_slot.eq(advance(self.write_slot)),
+                ]
+        with m.Elif(self.packet_done):
+            m.d.sync += polluted.eq(0)
+        with m.Elif(self.writer.port.en & self.full):
+            m.d.sync += polluted.eq(1)
+
+        # Draining
+        busy = Signal()
+        finished = Signal()
+        with m.If(~busy & (self.count != 0)):
+            m.d.comb += self.start.eq(1)
+            m.d.sync += busy.eq(1)
+
+        for i, printer in enumerate(self.printers):
+            selected = self.read_slot == i
+            m.d.comb += printer.start.eq(self.start & selected)
+            if hasattr(printer, 'length'):
+                m.d.comb += printer.length.eq(lengths[i])
+            with m.If(selected):
+                m.d.comb += [
+                    self.tx_data.eq(printer.tx_data),
+                    self.tx_rdy.eq(printer.tx_rdy),
+                    printer.tx_ack.eq(self.tx_ack),
+                ]
+                with m.If(busy & printer.done):
+                    m.d.comb += finished.eq(1)
+
+        with m.If(finished):
+            m.d.comb += self.done.eq(1)
+            m.d.sync += [
+                busy.eq(0),
+                self.read_slot.eq(advance(self.read_slot)),
+            ]
+
+        m.d.sync += self.count.eq(self.count + committed - finished)
+
+        return m
@@ -0,0 +1,160 @@
+import sys
+import argparse
+
+import numpy as np
+
+from nmigen import Elaboratable, Module, Signal, Array, Const, Mux
+
+from onebitbt import gmsk, model
+from onebitbt.ble import CHANNELS, channel_frequency
+
+# Channel scanning with a single retunable lane (see onebitbt.mixer), rather than a bitstream
+# per channel:
+#
+#   python -m onebitbt.radio te0714 --scan 0-39 --dwell 20 --records --baud 3125000
+#
+# The scan lane hops through its channels, listening on each for `dwell_ms` (not counting the
+# time it takes to retune) and never hopping in the middle of a packet. Over the serial port,
+# 0x80 + channel parks it on a channel and 'c' goes back to scanning:
+#
+#   python -m onebitbt.scan tune /dev/ttyUSB1 3125000 17
+#   python -m onebitbt.scan resume /dev/ttyUSB1 3125000
+#
+# How long a retune takes shows up in the performance counters (retunes and retuning, see
+# onebitbt.stats). `python -m onebitbt.scan latency` measures how long the demodulator takes to
+# forget the old channel, using the numpy model, and checks it against how long the gateware
+# waits.
+
+COMMAND_TUNE = 0x80 # | channel
+COMMAND_RESUME = ord('c')
+
+def parse_channels(text):
+    # `0-10,37,38`
+    channels = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        channels += list(range(int(first), int(last or first) + 1))
+    if not all(0 <= channel < CHANNELS for channel in channels):
+        raise ValueError("Channels go from 0 to {}".format(CHANNELS - 1))
+    return channels
+
+class ChannelScanner(Elaboratable):
+    # Picks the channel for a retunable lane: pulses retune (with the new channel in `channel`)
+    # every dwell_ms of being tuned, as long as the lane isn't busy with a packet. Pulse select to
+    # park on select_channel instead, and resume to go back to scanning.
+    def __init__(self, channels, dwell_ms=10, clock=25e6):
+        self.channels = channels
+        self.dwell = int(dwell_ms*clock/1000)
+
+        self.channel = Signal(range(CHANNELS), reset=channels[0])
+        self.retune = Signal()
+        self.tuned = Signal()
+        self.busy = Signal()
+
+        self.select = Signal()
+        self.select_channel = Signal(range(CHANNELS))
+        self.resume = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        n = len(self.channels)
+
+        channels = Array(Const(channel, range(CHANNELS)) for channel in self.channels)
+        index = Signal(range(n))
+        scanning = Signal(reset=1)
+        started = Signal()
+        listened = Signal(range(self.dwell + 1))
+
+        m.d.sync += [
+            self.retune.eq(0),
+            started.eq(1),
+        ]
+        with m.If(self.tuned & ~self.retune & (listened != self.dwell)):
+            m.d.sync += listened.eq(listened + 1)
+
+        # Tune to the first channel on the way out of reset
+        with m.If(~started):
+            m.d.sync += self.retune.eq(1)
+        with m.Elif(self.select):
+            m.d.sync += [
+                scanning.eq(0),
+                self.channel.eq(self.select_channel),
+                self.retune.eq(1),
+                listened.eq(0),
+            ]
+        with m.Elif(self.resume):
+            m.d.sync += scanning.eq(1)
+        with m.Elif(scanning & (n > 1) & (listened == self.dwell) & ~self.busy):
+            next_index = Signal(range(n))
+            m.d.comb += next_index.eq(Mux(index == n - 1, 0, index + 1))
+            m.d.sync += [
+                index.eq(next_index),
+                self.channel.eq(channels[next_index]),
+                self.retune.eq(1),
+                listened.eq(0),
+            ]
+
+        return m
+
+def retune_latency(demodulator='fsk', from_channel=37, to_channel=0, words=4000, trials=4, seed=0):
+    # Sync cycles from switching the model's oscillator over until what the demodulator compares
+    # (diff, before it's cut down to a bit) stops depending on anything from before the switch:
+    # the last sample that differs between a few runs with different histories
+    rng = np.random.default_rng(seed)
+    bits = gmsk.prbs9()
+    after = model.pack_words(gmsk.modulate(np.resize(bits, words*20//gmsk.samples_per_symbol(5e9) + 1),
+        frequency=channel_frequency(to_channel)))[:words]
+
+    outputs = []
+    for _ in range(trials):
+        demod = model.DEMODULATORS[demodulator](frequency=channel_frequency(from_channel), retunable=True)
+        demod.diff(rng.integers(0, 1 << 20, size=words, dtype=np.uint32))
+        demod.retune(channel_frequency(to_channel))
+        outputs.append(demod.diff(after))
+    different = np.zeros(len(outputs[0]), dtype=bool)
+    for other in outputs[1:]:
+        different |= other != outputs[0]
+    changed = np.flatnonzero(different)
+    # diff comes out once every 4 rx cycles
+    return (changed[-1] + 1 if len(changed) else 0)*4/model.SYNC_RATIO
+
+def gateware_wait(demodulator='fsk'):
+    # Sync cycles the gateware waits after the oscillator switches over before it says it's tuned
+    from onebitbt.demodulator import settle_words
+    return settle_words(demodulator)/model.SYNC_RATIO
+
+def send(port, baud, data):
+    import serial
+    with serial.Serial(port, baud) as f:
+        f.write(bytes(data))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Retunable lane control and retune latency")
+    commands = parser.add_subparsers(dest='command')
+    tune = commands.add_parser('tune', help='park the scan lane on a channel')
+    tune.add_argument('port')
+    tune.add_argument('baud', type=int)
+    tune.add_argument('channel', type=int)
+    resume = commands.add_parser('resume', help='go back to scanning')
+    resume.add_argument('port')
+    resume.add_argument('baud', type=int)
+    latency = commands.add_parser('latency', help='measure how long a retune takes with the numpy model')
+    latency.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk')
+    latency.add_argument('--from', dest='from_channel', type=int, default=37)
+    latency.add_argument('--to', default='0-39', help='channels to retune to, e.g. 0-39')
+    args = parser.parse_args()
+
+    if args.command == 'tune':
+        send(args.port, args.baud, [COMMAND_TUNE | args.channel])
+    elif args.command == 'resume':
+        send(args.port, args.baud, [COMMAND_RESUME])
+    elif args.command == 'latency':
+        cycles = [retune_latency(args.demodulator, args.from_channel, channel) for channel in parse_channels(args.to)]
+        waited = gateware_wait(args.demodulator)
+        print("Retune to first valid sample: {:.1f} to {:.1f} sync cycles ({:.2f}us worst), gateware waits {:.1f}".format(
+            min(cycles), max(cycles), max(cycles)/25, waited))
+        if max(cycles) > waited:
+            print("The gateware doesn't wait long enough!")
+            sys.exit(1)
+    else:
+        parser.print_help()
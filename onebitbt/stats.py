@@ -0,0 +1,218 @@
+import sys
+import time
+import struct
+
+from nmigen import Elaboratable, Module, Signal, Memory, Array, Cat, Const
+
+from onebitbt.framing import FramePrinter, FrameDecoder, FRAME_STATS
+
+# Performance counters, so we can tell *why* packets go missing. Everything is a free running 32
+# bit counter that counts cycles an event signal is high. Send an 's' over the serial port to
+# get a snapshot of all of them back and an 'r' to clear them. The host side is at the bottom:
+#
+#   python -m onebitbt.stats /dev/ttyUSB1 115200
+#
+# A frame only has room for 255 bytes, which is about 8 lanes worth, so a snapshot goes out as one
+# FRAME_STATS frame for the global counters followed by one for each lane. Every frame starts with
+# its part number and how many parts there are, and a lane's then has its channel. After that come
+# the counters (little endian) in the order below. All the parts are taken at the same time.
+
+STATS_GLOBAL = [
+    'uptime', # sync (25MHz) cycles
+    'uart_stalls', # cycles a lane had a packet to send while another printer had the UART
+    'retunes', # times the scan lane changed channel (see onebitbt.scan)
+    'retuning', # cycles the scan lane spent waiting for its demodulator to settle
+]
+
+STATS_LANE = [
+    'syncs', # times the synchronizer found a preamble/access address
+    'headers', # PDU headers parsed
+    'crc_ok',
+    'crc_fail',
+    'dropped', # packets dropped because the ring was full
+    'ring_full', # cycles the ring was full
+    'suppressed', # repeats dropped by the dedup filter (see onebitbt.dedup)
+]
+
+COMMAND_SNAPSHOT = ord('s')
+COMMAND_CLEAR = ord('r')
+
+# Lane id of the scan lane, which isn't on any one channel (real channels only go up to 39)
+SCAN_LANE = 0xFF
+
+def lane_name(channel):
+    return 'scan' if channel == SCAN_LANE else str(channel)
+
+def stat_names(channels):
+    return STATS_GLOBAL + ['{}.{}'.format(lane_name(channel), name) for channel in channels for name in STATS_LANE]
+
+def frame_layout(channels):
+    # The header of every part of a snapshot (see above) and how many counters follow it
+    parts = 1 + len(channels)
+    return [([0, parts], len(STATS_GLOBAL))] + [([i + 1, parts, channel], len(STATS_LANE))
+        for i, channel in enumerate(channels)]
+
+class StatsBlock(Elaboratable):
+    # Drive events[name] high for every cycle something should be counted. Pulse request to send
+    # a snapshot out through printer (which wants to sit behind the PrinterArbiter) and clear to
+    # zero everything.
+    def __init__(self, channels):
+        self.channels = channels
+        self.names = stat_names(channels)
+        self.events = {name: Signal(name=name.replace('.', '_')) for name in self.names}
+        self.request = Signal()
+        self.clear = Signal()
+
+        self.layout = frame_layout(channels)
+        self.lengths = [len(header) + 4*count for header, count in self.layout]
+        self.printer = FramePrinter(Memory(width=8, depth=max(self.lengths)), FRAME_STATS)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.printer = printer = self.printer
+        m.submodules.wport = wport = printer.mem.write_port()
+
+        counters = [Signal(32, name="count_" + name.replace('.', '_')) for name in self.names]
+        for counter, name in zip(counters, self.names):
+            with m.If(self.clear):
+                m.d.sync += counter.eq(0)
+            with m.Elif(self.events[name]):
+                m.d.sync += counter.eq(counter + 1)
+
+        # Take a consistent snapshot of everything, then send it out a part at a time, copying
+        # each into the printer's memory a byte at a time. The bytes of every part back to back:
+        snapshot = Signal(32*len(counters))
+        snapshot_bytes = [snapshot[i:i + 8] for i in range(0, len(snapshot), 8)]
+        stream = []
+        for header, count in self.layout:
+            stream += [Const(byte, 8) for byte in header] + snapshot_bytes[:4*count]
+            snapshot_bytes = snapshot_bytes[4*count:]
+        stream = Array(stream)
+        lengths = Array(Const(length, 8) for length in self.lengths)
+
+        part = Signal(range(len(self.layout)))
+        pos = Signal(range(len(stream) + 1))
+        idx = Signal(8)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.request):
+                    m.d.sync += [
+                        snapshot.eq(Cat(*counters)),
+                        part.eq(0),
+                        pos.eq(0),
+                        idx.eq(0),
+                    ]
+                    m.next = "COPY"
+
+            with m.State("COPY"):
+                m.d.comb += [
+                    wport.addr.eq(idx),
+                    wport.data.eq(stream[pos]),
+                    wport.en.eq(1),
+                ]
+                m.d.sync += [
+                    pos.eq(pos + 1),
+                    idx.eq(idx + 1),
+                ]
+                with m.If(idx == lengths[part] - 1):
+                    m.next = "START_READOUT"
+
+            with m.State("START_READOUT"):
+                m.d.comb += [
+                    printer.start.eq(1),
+                    printer.length.eq(lengths[part]),
+                ]
+                m.next = "WAIT_READOUT"
+
+            with m.State("WAIT_READOUT"):
+                # The printer is done with the memory, so the next part can have it
+                with m.If(printer.done):
+                    m.d.sync += idx.eq(0)
+                    with m.If(part == len(self.layout) - 1):
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.sync += part.eq(part + 1)
+                        m.next = "COPY"
+
+        return m
+
+def decode_stats(payload):
+    # Returns (part, parts, {name: count}) for a FRAME_STATS payload
+    part, parts = payload[0], payload[1]
+    if part == 0:
+        names, offset = STATS_GLOBAL, 2
+    else:
+        names, offset = ['{}.{}'.format(lane_name(payload[2]), name) for name in STATS_LANE], 3
+    counts = struct.unpack_from('<{}I'.format(len(names)), payload, offset)
+    return part, parts, dict(zip(names, counts))
+
+class StatsAssembler:
+    # Puts the parts of a snapshot back together. feed() every FRAME_STATS payload, and it hands
+    # back {name: count} for the whole snapshot once the last part is in. A snapshot missing a
+    # part (a frame got mangled) is thrown away.
+    def __init__(self):
+        self.counts = None
+        self.next = 0
+
+    def feed(self, payload):
+        part, parts, counts = decode_stats(payload)
+        if part == 0:
+            self.counts = {}
+        elif self.counts is None or part != self.next:
+            self.counts = None
+            return None
+        self.counts.update(counts)
+        self.next = part + 1
+        if self.next == parts:
+            counts, self.counts = self.counts, None
+            return counts
+        return None
+
+def format_rates(previous, current, clock=25e6):
+    # Counts per second between two snapshots, using the uptime counter as the clock so it
+    # doesn't matter how late the snapshots arrive
+    elapsed = ((current['uptime'] - previous['uptime']) & 0xFFFFFFFF)/clock
+    if elapsed <= 0:
+        return ''
+    lines = ["{:.2f}s".format(elapsed)]
+    for name, count in current.items():
+        if name == 'uptime':
+            continue
+        delta = (count - previous[name]) & 0xFFFFFFFF
+        lines.append("  {:<16} {:>10} {:>12.1f}/s".format(name, count, delta/elapsed))
+    retunes = (current['retunes'] - previous['retunes']) & 0xFFFFFFFF
+    if retunes:
+        retuning = (current['retuning'] - previous['retuning']) & 0xFFFFFFFF
+        lines.append("  {:<16} {:>10.2f}us".format('retune latency', retuning/retunes/clock*1e6))
+    return '\n'.join(lines)
+
+def poll(port, interval=1.0, clear=False):
+    # Asks for a snapshot every interval seconds and prints the rates since the last one
+    decoder = FrameDecoder()
+    assembler = StatsAssembler()
+    previous = None
+    if clear:
+        port.write(bytes([COMMAND_CLEAR]))
+    while True:
+        port.write(bytes([COMMAND_SNAPSHOT]))
+        deadline = time.time() + interval
+        while time.time() < deadline:
+            for frame_type, payload in decoder.feed(port.read(4096)):
+                if frame_type != FRAME_STATS:
+                    continue
+                current = assembler.feed(payload)
+                if current is None:
+                    continue
+                if previous is not None:
+                    print(format_rates(previous, current))
+                previous = current
+
+if __name__ == '__main__':
+    import serial
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    port = serial.Serial(args[0], int(args[1]) if len(args) > 1 else 115200, timeout=0.05)
+    try:
+        poll(port, interval=float(args[2]) if len(args) > 2 else 1.0, clear='--clear' in sys.argv)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,147 @@
+import sys
+import time
+
+from onebitbt import ble
+from onebitbt.framing import encode_frame
+
+# Host side of the advertiser: compiles advertising packets into the stream of symbol table
+# indices BLEAdvertiser plays out, and loads them into it over the serial port while it runs.
+#
+# The symbol table (see research/Transmission.ipynb) holds 32 pre-modulated symbols: one for
+# every combination of the previous, current and next bit (8) and the quadrant the phase starts
+# in (4). Encoding a packet is then just a matter of tracking the quadrant.
+#
+#   python -m onebitbt.symbols /dev/ttyUSB1 --name "HELLO" --address 90:d7:eb:b1:92:99
+#
+# Pass --name/--address/--ad more than once (in order) to queue several packets, which the
+# advertiser takes turns sending, one per advertising event.
+
+# (previous, current, next) bits to table row
+TRANSITIONS = {
+    (0, 0, 0): 0,
+    (1, 1, 1): 1,
+    (0, 0, 1): 2,
+    (0, 1, 1): 3,
+    (0, 1, 0): 4,
+    (1, 0, 1): 5,
+    (1, 1, 0): 6,
+    (1, 0, 0): 7,
+}
+
+# The quadrant each of the 4 variants of a row starts in
+START_QUADRANT = [
+    [3, 2, 3, 2, 2, 3, 2, 3],
+    [0, 3, 0, 3, 3, 0, 3, 0],
+    [1, 0, 1, 0, 0, 1, 0, 1],
+    [2, 1, 2, 1, 1, 2, 1, 2],
+]
+
+SYMBOLS = 32
+
+# Longest legacy advertising packet: preamble, access address, 2 byte header, 37 byte payload
+# and CRC
+MAX_SYMBOLS = 8*(1 + 4 + 2 + 37 + 3)
+
+# Frames the advertiser accepts over the UART (same framing as the receiver sends, see
+# onebitbt.framing). A region is one packet slot on one channel: slot*len(channels) + channel
+# index.
+FRAME_SYMBOLS = 0x10 # region, offset (2 bytes), symbol indices
+FRAME_LENGTH = 0x11 # region, length (2 bytes), in symbols. 0 disables the region.
+FRAME_QUEUE = 0x12 # number of slots to cycle through
+
+# Keeps FRAME_SYMBOLS frames well inside the 255 byte limit
+SYMBOLS_PER_FRAME = 128
+
+def encode(bits):
+    # Table indices for a stream of on-air bits. Like in the notebook, the table was built
+    # with ones as the lower tone so the bits go in inverted.
+    bits = [1 - bit for bit in bits]
+    quadrant = 0
+    previous = bits[0]
+    padded = list(bits) + [bits[-1]]
+    out = []
+    for i in range(len(bits)):
+        row = TRANSITIONS[(previous, padded[i], padded[i + 1])]
+        variant = [q[row] for q in START_QUADRANT].index(quadrant)
+        out.append(variant*8 + row)
+        quadrant = (quadrant + (1 if padded[i] else 3)) % 4
+        previous = padded[i]
+    return out
+
+def compile_packet(pdu, channel=37):
+    # PDU (see ble.build_pdu) to symbol indices: preamble, access address, whitening and CRC
+    symbols = encode(ble.to_bits(ble.build_packet(pdu, channel)))
+    if len(symbols) > MAX_SYMBOLS:
+        raise ValueError("Packet too long ({} symbols)".format(len(symbols)))
+    return symbols
+
+def advertisement(name=None, address=0, ad=(), pdu_type=0x2, flags=0x05, name_type=0x08):
+    # A non-connectable advertisement (by default) with flags and a (shortened) local name
+    ad = list(ad)
+    if flags is not None:
+        ad.insert(0, (0x01, bytes([flags])))
+    if name is not None:
+        ad.append((name_type, name.encode('utf-8')))
+    pdu = ble.build_pdu(pdu_type, address, ad)
+    if len(pdu) > 2 + 37:
+        raise ValueError("Advertisement too long ({} byte payload)".format(len(pdu) - 2))
+    return pdu
+
+def load_frames(region, symbols):
+    # Frames that replace one region's symbols, finishing with its length (so the advertiser
+    # never plays half a packet)
+    frames = [encode_frame(FRAME_LENGTH, [region, 0, 0])]
+    for offset in range(0, len(symbols), SYMBOLS_PER_FRAME):
+        chunk = symbols[offset:offset + SYMBOLS_PER_FRAME]
+        frames.append(encode_frame(FRAME_SYMBOLS, [region, offset & 0xFF, offset >> 8] + chunk))
+    frames.append(encode_frame(FRAME_LENGTH, [region, len(symbols) & 0xFF, len(symbols) >> 8]))
+    return frames
+
+def program(pdus, channels=(37, 38, 39)):
+    # Frames to load a whole queue of PDUs, compiled for each of the advertiser's channels
+    frames = []
+    for slot, pdu in enumerate(pdus):
+        for i, channel in enumerate(channels):
+            frames += load_frames(slot*len(channels) + i, compile_packet(pdu, channel))
+    frames.append(encode_frame(FRAME_QUEUE, [len(pdus)]))
+    return frames
+
+def parse_ad(text):
+    # 'type:hex', e.g. 'ff:4c000215...'
+    ad_type, value = text.split(':', 1)
+    return int(ad_type, 16), bytes.fromhex(value)
+
+def parse_options(args):
+    # `port [baud] [--channels 37,38,39] (--name NAME [--address ADDRESS] [--ad TYPE:HEX]...)...`
+    # Every --name starts a new packet
+    options = {'port': None, 'baud': 115200, 'channels': [37], 'packets': []}
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--channels':
+            options['channels'] = [int(channel) for channel in args.pop(0).split(',')]
+        elif arg == '--name':
+            options['packets'].append({'name': args.pop(0), 'address': 0, 'ad': []})
+        elif arg == '--address':
+            options['packets'][-1]['address'] = args.pop(0)
+        elif arg == '--ad':
+            options['packets'][-1]['ad'].append(parse_ad(args.pop(0)))
+        else:
+            positional.append(arg)
+    options['port'] = positional[0]
+    if len(positional) > 1:
+        options['baud'] = int(positional[1])
+    return options
+
+if __name__ == '__main__':
+    import serial
+    options = parse_options(sys.argv[1:])
+    pdus = [advertisement(p['name'], p['address'], p['ad']) for p in options['packets']]
+    port = serial.Serial(options['port'], options['baud'])
+    for frame in program(pdus, options['channels']):
+        port.write(frame)
+        # The advertiser only handles one frame at a time
+        port.flush()
+        time.sleep(0.005)
+    print("Loaded {} packet(s) on channels {}".format(len(pdus), ','.join(map(str, options['channels']))))
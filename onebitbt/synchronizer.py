@@ -0,0 +1,81 @@
+from fractions import Fraction
+
+from nmigen import Elaboratable, Module, Signal, Const, Cat, signed
+
+# A drop-in for alldigitalradio's CorrelativeSynchronizer (same input, reset and sample_strobe)
+# for when there isn't a whole number of sync cycles per symbol, like the LE 2M PHY's 12.5 at
+# 25MHz.
+#
+# The baseband goes through a shift register, and each pattern bit gets compared against the
+# sample however many symbols (rounded to the nearest sample) it is before the last pattern bit.
+# Every pattern bit has to match. That holds for a run of consecutive cycles as the pattern slides
+# past, and the middle of the run is the middle of the last pattern symbol, so when the run ends
+# we know how far into the next symbol we are. From there on it strobes in the middle of every
+# symbol, keeping count in fractions of a sample so it alternates between 12 and 13 samples
+# rather than drifting, until reset. score is how long the run was, the longer the cleaner the
+# signal (see onebitbt.bank). onebitbt.model.SynchronizerModel does the same in numpy.
+
+class FractionalSynchronizer(Elaboratable):
+    def __init__(self, pattern, samples_per_symbol=12.5):
+        self.pattern = pattern
+        spp = Fraction(samples_per_symbol).limit_denominator(16)
+        # Everything below counts in steps of 1/(2*denominator) of a sample, so that half way
+        # through a run is a whole number of steps as well
+        self.step = 2*spp.denominator
+        self.period = 2*spp.numerator
+        self.samples_per_symbol = spp
+        n = len(pattern)
+        self.taps = [int((n - 1 - k)*spp + Fraction(1, 2)) for k in range(n)]
+        # A clean run is about a symbol long, anything longer is junk
+        self.longest = int(spp) + 1
+
+        self.input = Signal()
+        self.reset = Signal()
+        self.sample_strobe = Signal()
+        self.locked = Signal()
+        self.score = Signal(range(self.longest + 1))
+
+    def elaborate(self, platform):
+        m = Module()
+        step, period = self.step, self.period
+
+        # The newest sample is the input itself, so a match is about the current cycle
+        history = Signal(max(self.taps))
+        m.d.sync += history.eq(Cat(self.input, history[:-1]))
+        samples = Cat(self.input, history)
+        match = Signal()
+        pattern = Const(sum(bit << k for k, bit in enumerate(self.pattern)), len(self.pattern))
+        m.d.comb += match.eq(Cat(samples[tap] for tap in self.taps) == pattern)
+
+        longest = self.longest
+        run = Signal(range(longest + 1))
+        locked = self.locked
+        # How far off the middle of the current symbol we are, as a signed number of steps
+        remaining = Signal(signed(period.bit_length() + 2))
+
+        with m.If(self.reset):
+            m.d.sync += [
+                run.eq(0),
+                locked.eq(0),
+            ]
+        with m.Elif(locked):
+            # Strobe on whichever cycle is within half a sample of the middle of the symbol
+            with m.If(remaining < step//2):
+                m.d.comb += self.sample_strobe.eq(1)
+                m.d.sync += remaining.eq(remaining + period - step)
+            with m.Else():
+                m.d.sync += remaining.eq(remaining - step)
+        with m.Elif(match):
+            with m.If(run != longest):
+                m.d.sync += run.eq(run + 1)
+        with m.Elif(run != 0):
+            # The run covered the last `run` cycles, so the middle of it was (run + 1)/2 cycles
+            # ago and the middle of the next symbol is a symbol after that
+            m.d.sync += [
+                locked.eq(1),
+                run.eq(0),
+                self.score.eq(run),
+                remaining.eq(period - (run + 1)*(step//2) - step),
+            ]
+
+        return m
@@ -0,0 +1,395 @@
+import os
+import sys
+import json
+import time
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from onebitbt import ble, gmsk, model, symbols
+from onebitbt.bank import decode_basebands, parse_offsets, offset_args
+from onebitbt.capture import CaptureWriter, iter_words, count_words
+from onebitbt.tables import CACHE_DIR
+
+# Synthetic captures of a busy room, and a load test that pushes them through the receiver.
+#
+# `generate` makes up a bunch of advertisers, each with its own name, address, advertising
+# interval, channels, power, carrier offset and advDelay jitter, schedules their advertising
+# events over the length of the capture and writes the lot as one 1-bit 5GSPS capture: every packet
+# is GMSK modulated at its device's power and offset on top of unit (full band) noise, summed and
+# quantized like the SERDES would. Some events are deliberately moved on top of another packet on
+# the same channel, and there are bursts of GMSK that aren't BLE at all. Every packet that went out
+# is listed in a JSON ground truth next to the capture (capture + '.truth').
+#
+# `bench` runs a capture through the receiver and scores what came out against the ground truth:
+# the detection rate (clean and collided packets separately), packets received with a bad CRC,
+# packets that were never received at all (drops), false CRC passes (a good CRC on something that
+# wasn't sent) and the wall clock throughput. By default that's the numpy model (onebitbt.model
+# and onebitbt.bank) with a process per channel, with --gateware it's BLERadio itself, replayed
+# through the virtual radio (onebitbt.replay), which is slower but also loses packets to a full
+# ring like the real thing.
+#
+#   python -m onebitbt.synth generate room.1bit --devices 30 --seconds 0.2 --seed 1
+#   python -m onebitbt.synth bench room.1bit [--offsets -150,-75,0,75,150] [--phase] [--gateware]
+#
+# `standard` is the load test every change to BLERadio and PacketParser should pass: a fixed
+# capture (generated once and cached) and fixed bars for the detection rate and false passes,
+# exiting with 1 if either is missed.
+#
+#   python -m onebitbt.synth standard [--gateware]
+
+SAMPLE_RATE = 5e9
+
+# Samples per 1M symbol, per sync cycle and per SERDES word
+SAMPLES_PER_SYMBOL = 5000
+SAMPLES_PER_CYCLE = 200
+WORD_WIDTH = 20
+
+# Bump when generate() changes in a way that changes its output
+SYNTH_VERSION = 1
+
+# Samples rendered at a time, 1ms (a whole number of words and bytes)
+CHUNK = 5000000
+
+# Between the end of a packet and the start of the next one in the same advertising event
+HOP_US = 150
+
+# A reception this close (in sync cycles) to where a packet's first bit after the access address
+# went out is that packet. The demodulator and synchronizer only add a symbol or two.
+TOLERANCE = 250
+
+Device = namedtuple('Device', ['name', 'address', 'interval_ms', 'channels', 'power_db', 'offset', 'jitter_ms'])
+
+# start is in samples, timestamp in sync cycles (like the records)
+Transmission = namedtuple('Transmission', ['start', 'timestamp', 'channel', 'device', 'pdu', 'collided'])
+
+# The standard load: a room with a few dozen advertisers, a fair amount of them weak or far off
+# frequency, and the bars it has to clear. A fifth of the devices are too weak for any of the
+# demodulators, so the rate is a little under what the model got (68% fsk, 73% phase) rather
+# than anywhere near 100%, and a change that loses packets shows up.
+STANDARD = {'devices': 30, 'seconds': 0.2, 'seed': 1, 'collisions': 0.05, 'bursts': 20}
+STANDARD_MIN_RATE = 0.65
+STANDARD_MAX_FALSE = 0
+
+def random_devices(count, rng):
+    devices = []
+    for i in range(count):
+        # Static random addresses have the top two bits set
+        address = int(rng.integers(0, 1 << 46)) | (3 << 46)
+        # Most advertise on all three channels
+        channels = [37, 38, 39] if rng.random() < 0.7 else sorted(int(c) for c in rng.choice([37, 38, 39],
+            int(rng.integers(1, 3)), replace=False))
+        devices.append(Device(
+            name='synth{:02d}'.format(i),
+            address=address,
+            interval_ms=float(rng.uniform(20, 200)),
+            channels=channels,
+            # dB over the (unit) noise in the whole 2.5GHz band, the model loses packets below ~-12dB
+            power_db=float(rng.uniform(-16, 6)),
+            offset=float(np.clip(rng.normal(0, 50e3), -150e3, 150e3)),
+            jitter_ms=float(rng.uniform(0, 10)),
+        ))
+    return devices
+
+def packet_samples(pdu):
+    return (8*(1 + 4 + len(pdu) + 3))*SAMPLES_PER_SYMBOL
+
+def timestamp(start):
+    # The sync cycle the first bit after the access address starts on
+    return (start + 8*(1 + 4)*SAMPLES_PER_SYMBOL)//SAMPLES_PER_CYCLE
+
+def schedule(devices, samples, rng, collisions=0.05):
+    # Every packet every device sends over `samples`, in order. `collisions` of the advertising
+    # events are moved to start somewhere inside another packet on the same channel.
+    events = []
+    for device in devices:
+        pdu = symbols.advertisement(device.name, device.address)
+        t = rng.uniform(0, device.interval_ms)
+        while True:
+            start = int(t*1e-3*SAMPLE_RATE)
+            if start >= samples:
+                break
+            events.append((start, device, pdu))
+            # advDelay
+            t += device.interval_ms + rng.uniform(0, device.jitter_ms)
+
+    moved = []
+    for start, device, pdu in events:
+        if moved and rng.random() < collisions:
+            victim_start, victim, victim_pdu = moved[int(rng.integers(0, len(moved)))]
+            if device.channels[0] in victim.channels:
+                # Land on the victim's packet on our first channel
+                hop = packet_samples(victim_pdu) + HOP_US*SAMPLES_PER_SYMBOL
+                start = victim_start + victim.channels.index(device.channels[0])*hop + \
+                    int(rng.integers(0, packet_samples(victim_pdu)))
+        moved.append((start, device, pdu))
+
+    transmissions = []
+    for start, device, pdu in moved:
+        for channel in device.channels:
+            if start + packet_samples(pdu) <= samples:
+                transmissions.append(Transmission(start, timestamp(start), channel, device, pdu, False))
+            start += packet_samples(pdu) + HOP_US*SAMPLES_PER_SYMBOL
+    transmissions.sort(key=lambda t: t.start)
+
+    # Anything overlapping anything else on the same channel collided
+    collided = set()
+    for i, a in enumerate(transmissions):
+        for j in range(i + 1, len(transmissions)):
+            b = transmissions[j]
+            if b.start >= a.start + packet_samples(a.pdu):
+                break
+            if a.channel == b.channel:
+                collided.update((i, j))
+    return [t._replace(collided=i in collided) for i, t in enumerate(transmissions)]
+
+def random_bursts(count, samples, rng):
+    # (start, bits, channel, amplitude) of bursts of random GMSK on the advertising channels,
+    # something for the synchronizer to not sync to
+    bursts = []
+    for _ in range(count):
+        bits = rng.integers(0, 2, int(rng.integers(100, 2000)))
+        start = int(rng.integers(0, max(1, samples - len(bits)*SAMPLES_PER_SYMBOL)))
+        bursts.append((start, bits, int(rng.choice([37, 38, 39])), np.sqrt(2*10**(rng.uniform(-10, 6)/10))))
+    return bursts
+
+def waveform(bits, channel, offset, amplitude, rng):
+    return gmsk.modulate(bits, frequency=ble.channel_frequency(channel) + offset, amplitude=amplitude,
+        phase=rng.uniform(0, 2*np.pi))
+
+def render(filename, transmissions, bursts, samples, rng, chunk=CHUNK):
+    # Sums everything onto the noise a chunk at a time. Chunks with nothing in them are just
+    # random bits, which is what noise quantizes to.
+    sources = [(t.start, ble.to_bits(ble.build_packet(t.pdu, t.channel)), t.channel, t.device.offset,
+        np.sqrt(2*10**(t.device.power_db/10))) for t in transmissions]
+    sources += [(start, bits, channel, 0, amplitude) for start, bits, channel, amplitude in bursts]
+    sources.sort(key=lambda s: s[0])
+
+    active = []
+    upcoming = 0
+    with CaptureWriter(filename, sample_rate=SAMPLE_RATE, frequency=0, channel=-1) as out:
+        for first in range(0, samples, chunk):
+            last = min(samples, first + chunk)
+            while upcoming < len(sources) and sources[upcoming][0] < last:
+                start, bits, channel, offset, amplitude = sources[upcoming]
+                active.append((start, waveform(bits, channel, offset, amplitude, rng)))
+                upcoming += 1
+            active = [(start, wave) for start, wave in active if start + len(wave) > first]
+            if not active:
+                out.write_samples(rng.integers(0, 2, last - first, dtype=np.uint8))
+                continue
+            sig = rng.standard_normal(last - first)
+            for start, wave in active:
+                a, b = max(start, first), min(start + len(wave), last)
+                sig[a - first:b - first] += wave[a - start:b - start]
+            out.write_samples(sig)
+
+def truth_path(capture):
+    return capture + '.truth'
+
+def write_truth(capture, devices, transmissions, samples, options):
+    truth = {
+        'version': SYNTH_VERSION,
+        'samples': samples,
+        'options': options,
+        'devices': [dict(device._asdict(), address=ble.format_address(device.address)) for device in devices],
+        'packets': [{
+            'start': t.start,
+            'timestamp': t.timestamp,
+            'channel': t.channel,
+            'name': t.device.name,
+            'address': ble.format_address(t.device.address),
+            'pdu': t.pdu.hex(),
+            'power_db': t.device.power_db,
+            'offset': t.device.offset,
+            'collided': t.collided,
+        } for t in transmissions],
+    }
+    with open(truth_path(capture), 'w') as f:
+        json.dump(truth, f, indent=1)
+    return truth
+
+def read_truth(capture):
+    with open(truth_path(capture)) as f:
+        return json.load(f)
+
+def generate(capture, devices=30, seconds=0.2, seed=0, collisions=0.05, bursts=20):
+    options = {'devices': devices, 'seconds': seconds, 'seed': seed, 'collisions': collisions, 'bursts': bursts}
+    rng = np.random.default_rng(seed)
+    samples = int(seconds*SAMPLE_RATE)
+    samples -= samples % (8*WORD_WIDTH)
+    population = random_devices(devices, rng)
+    transmissions = schedule(population, samples, rng, collisions)
+    render(capture, transmissions, random_bursts(bursts, samples, rng), samples, rng)
+    return write_truth(capture, population, transmissions, samples, options)
+
+# Running the receiver
+
+def pdu_bytes(packet):
+    return bytes([packet.pdu_type | (packet.tx_add << 6) | (packet.rx_add << 7), packet.length]) + bytes(packet.payload)
+
+def model_channel(job):
+    capture, channel, offsets, demodulator = job
+    options = ble.demodulator_options('1m', demodulator)
+    basebands = [model.demodulate(iter_words(capture), demodulator=demodulator,
+        frequency=ble.channel_frequency(channel) + offset, **options) for offset in offsets]
+    return [(packet, ts) for packet, offset, ts in decode_basebands(basebands, channel, offsets) if packet is not None]
+
+def receive_model(capture, channels, offsets=(0,), demodulator='fsk', jobs=None):
+    # (packet, timestamp) for everything the numpy model of a lane on each channel parses
+    work = [(capture, channel, offsets, demodulator) for channel in channels]
+    with ProcessPoolExecutor(jobs or min(len(channels), os.cpu_count())) as pool:
+        return [r for found in pool.map(model_channel, work) for r in found]
+
+def receive_gateware(capture, channels, offsets=None, demodulator='fsk', jobs=None, build_dir=None):
+    # Same, from BLERadio replayed through the virtual radio
+    import alldigitalradio.hardware as hardware
+    from onebitbt import virtual
+    from onebitbt.radio import BLERadio
+    from onebitbt.replay import replay
+    with hardware.use('virtual'):
+        radio = BLERadio(channels, mode='records', baud=3125000, demodulator=demodulator,
+            offsets=None if offsets == [0] else offsets)
+        binary = virtual.build(radio, build_dir)
+    receptions, _ = replay(binary, capture, radio.uart.divisor, jobs)
+    return [(r.packet, r.timestamp) for r in receptions]
+
+# Scoring
+
+Score = namedtuple('Score', ['packets', 'detected', 'clean', 'clean_detected', 'collided', 'collided_detected',
+    'corrupted', 'dropped', 'false_passes', 'noise'])
+
+def score(truth, receptions):
+    packets = truth['packets']
+    by_channel = {}
+    for i, p in enumerate(packets):
+        by_channel.setdefault(p['channel'], []).append(i)
+    times = {channel: np.array([packets[i]['timestamp'] for i in indices]) for channel, indices in by_channel.items()}
+
+    good = set()
+    heard = set()
+    false_passes = noise = 0
+    for packet, ts in receptions:
+        indices = by_channel.get(packet.channel, [])
+        near = [indices[k] for k in np.flatnonzero(np.abs(times[packet.channel] - ts) <= TOLERANCE)] if indices else []
+        heard.update(near)
+        pdu = pdu_bytes(packet).hex()
+        if packet.crc_ok:
+            match = [i for i in near if packets[i]['pdu'] == pdu]
+            if match:
+                good.update(match)
+            else:
+                false_passes += 1
+        elif not near:
+            noise += 1
+
+    clean = [i for i, p in enumerate(packets) if not p['collided']]
+    collided = [i for i, p in enumerate(packets) if p['collided']]
+    return Score(
+        packets=len(packets),
+        detected=len(good),
+        clean=len(clean),
+        clean_detected=len(good.intersection(clean)),
+        collided=len(collided),
+        collided_detected=len(good.intersection(collided)),
+        corrupted=len(heard - good),
+        dropped=len(packets) - len(heard | good),
+        false_passes=false_passes,
+        noise=noise,
+    )
+
+def rate(found, total):
+    return found/total if total else 1.0
+
+def report(s, words, elapsed, out=sys.stdout):
+    seconds = words*WORD_WIDTH/SAMPLE_RATE
+    print("{} packets ({} clean, {} collided)".format(s.packets, s.clean, s.collided), file=out)
+    print("  detected      {:>6} {:>7.1%}".format(s.detected, rate(s.detected, s.packets)), file=out)
+    print("    clean       {:>6} {:>7.1%}".format(s.clean_detected, rate(s.clean_detected, s.clean)), file=out)
+    print("    collided    {:>6} {:>7.1%}".format(s.collided_detected, rate(s.collided_detected, s.collided)), file=out)
+    print("  bad crc       {:>6}".format(s.corrupted), file=out)
+    print("  dropped       {:>6}".format(s.dropped), file=out)
+    print("  false passes  {:>6}".format(s.false_passes), file=out)
+    print("  noise syncs   {:>6}".format(s.noise), file=out)
+    print("{:.3f}s of capture in {:.1f}s: {:.3f}x real time, {:.2f}M words/s, {:.0f} packets/s".format(
+        seconds, elapsed, seconds/elapsed, words/elapsed/1e6, s.detected/elapsed), file=out)
+
+def bench(capture, channels=None, offsets=None, demodulator='fsk', gateware=False, jobs=None, build_dir=None):
+    truth = read_truth(capture)
+    if channels is None:
+        channels = sorted(set(p['channel'] for p in truth['packets'])) or [37]
+    offsets = offsets or [0]
+    start = time.time()
+    if gateware:
+        receptions = receive_gateware(capture, channels, offsets, demodulator, jobs, build_dir)
+    else:
+        receptions = receive_model(capture, channels, offsets, demodulator, jobs)
+    elapsed = time.time() - start
+    return score(truth, receptions), count_words(capture), elapsed
+
+def standard_capture():
+    # Generated on first use
+    name = 'standard-v{}-{devices}-{seconds}-{seed}-{collisions}-{bursts}.1bit'.format(SYNTH_VERSION, **STANDARD)
+    path = os.path.join(CACHE_DIR, 'synth', name)
+    if not os.path.exists(truth_path(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        print("Generating {}".format(path), file=sys.stderr)
+        generate(path, **STANDARD)
+    return path
+
+def gate(s, min_rate, max_false):
+    # Whether a score passes, printing why not
+    passed = True
+    if rate(s.detected, s.packets) < min_rate:
+        print("FAIL: detected {:.1%}, needs {:.1%}".format(rate(s.detected, s.packets), min_rate))
+        passed = False
+    if max_false is not None and s.false_passes > max_false:
+        print("FAIL: {} false CRC passes, at most {}".format(s.false_passes, max_false))
+        passed = False
+    return passed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synthetic multi-device captures and a receiver load test")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('generate', help='write a capture and its ground truth')
+    command.add_argument('capture')
+    command.add_argument('--devices', type=int, default=30)
+    command.add_argument('--seconds', type=float, default=0.2)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--collisions', type=float, default=0.05, help='fraction of advertising events moved onto another packet')
+    command.add_argument('--bursts', type=int, default=20, help='bursts of non-BLE GMSK')
+
+    for name in ['bench', 'standard']:
+        command = commands.add_parser(name, help='score the receiver on ' + ('a capture' if name == 'bench' else 'the standard load'))
+        if name == 'bench':
+            command.add_argument('capture')
+            command.add_argument('--channels', default=None, help='comma separated (default: every channel in the ground truth)')
+            command.add_argument('--min-rate', type=float, default=0, help='fail below this detection rate')
+            command.add_argument('--max-false', type=int, default=None, help='fail above this many false CRC passes')
+        command.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk')
+        command.add_argument('--offsets', default=None, help='kHz offsets to demodulate at, e.g. -150,-75,0,75,150')
+        command.add_argument('--gateware', action='store_true', help='replay through BLERadio rather than the model')
+        command.add_argument('--jobs', type=int, default=None)
+        command.add_argument('--build-dir', default=None, help='where to cache simulator builds (--gateware)')
+    args = parser.parse_args(offset_args(sys.argv[1:]))
+
+    if args.command == 'generate':
+        start = time.time()
+        truth = generate(args.capture, args.devices, args.seconds, args.seed, args.collisions, args.bursts)
+        collided = sum(p['collided'] for p in truth['packets'])
+        print("{} packets from {} devices ({} collided) in {:.1f}s".format(
+            len(truth['packets']), len(truth['devices']), collided, time.time() - start))
+    else:
+        if args.command == 'standard':
+            capture, channels, min_rate, max_false = standard_capture(), None, STANDARD_MIN_RATE, STANDARD_MAX_FALSE
+        else:
+            capture, min_rate, max_false = args.capture, args.min_rate, args.max_false
+            channels = [int(channel) for channel in args.channels.split(',')] if args.channels else None
+        offsets = parse_offsets(args.offsets) if args.offsets else None
+        s, words, elapsed = bench(capture, channels, offsets, args.demodulator, args.gateware, args.jobs, args.build_dir)
+        report(s, words, elapsed)
+        if not gate(s, min_rate, max_false):
+            sys.exit(1)
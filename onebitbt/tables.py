@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+
+from nmigen import Elaboratable, Module, Memory, Signal, Mux, Cat, Repl
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.utils import bits_for
+
+from onebitbt import gmsk, deltasigma
+from onebitbt.ble import channel_frequency
+from onebitbt.model import pack_words
+from onebitbt.symbols import SYMBOLS
+
+# Transmit symbol tables (see onebitbt.symbols and research/Transmission.ipynb) for any channel
+# and line rate, generated on demand and cached on disk.
+#
+# Two things make the tables smaller than the 32 x samples_per_symbol the notebook saves:
+#
+# - Entries 16-31 start half a turn further round the unit circle than entries 0-15, which is
+#   exactly the same waveform negated. So only the first 16 are stored (a "compact" table) and
+#   the player inverts the bits for the rest. That halves the BRAM per channel, which is what
+#   lets the tables for all three advertising channels fit at once.
+# - Tables are kept as one bit per sample (they are +-1 anyway), on disk and in BRAM.
+#
+#   python -m onebitbt.tables 37,38,39 --rate 5e9
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+CACHE_DIR = os.environ.get('ONEBITBT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'onebitbt'))
+
+# Bump when generate() changes in a way that changes its output
+TABLE_VERSION = 1
+
+COMPACT_SYMBOLS = SYMBOLS//2
+
+# The train of bits from the notebook that goes through every transition, and the symbols in it
+# that become each row of the table (in onebitbt.symbols.TRANSITIONS order). Like the symbol
+# indices, these are in the notebook's inverted convention.
+SEQUENCE = [0, 0, 0, 1, 1, 1, 0, 0, 1, 0, 1, 1, 0, 0, 1, 0, 1, 0, 1, 0, 0, 1, 1, 0, 1, 0, 0, 0]
+ROWS = [1, 4, 7, 10, 14, 17, 22, 25]
+
+# Samples before each entry that the quantizer gets to settle on (the noise shaping NTFs only
+# remember a few dozen samples)
+WARMUP = 256
+
+def quantize_sign(sig, frequency, sample_rate):
+    # Plain 1-bit quantization, i.e. what the SERDES does to anything we give it
+    return np.where(sig > 0, 1.0, -1.0)
+
+# Each takes the entries (with warm up) as rows, see onebitbt.deltasigma for the noise shaped ones
+QUANTIZERS = {
+    'sign': quantize_sign,
+    'pwm2': deltasigma.quantize_resonator,
+    'dsm': deltasigma.quantize, # needs ntf=[...]
+}
+
+def generate(frequency, sample_rate=5e9, quantizer='sign', bt=gmsk.BT, **options):
+    # The full (32, samples_per_symbol) table of +-1s for a carrier at `frequency`
+    sps = gmsk.samples_per_symbol(sample_rate)
+    cycles = frequency/gmsk.SYMBOL_RATE
+    if abs(cycles - round(cycles)) > 1e-6:
+        # Otherwise the carrier phase at the start of an entry depends on where it is played
+        raise ValueError("{} isn't a whole number of cycles per symbol".format(frequency))
+
+    # Only the first two quadrants, the other two are those negated
+    entries = []
+    for quadrant in range(2):
+        # The notebook modulates with the bits inverted and the phase going the other way round
+        sig = gmsk.modulate(1 - np.array(SEQUENCE), frequency=frequency, sample_rate=sample_rate,
+            phase=-quadrant*np.pi/2, bt=bt)
+        entries += [sig[i*sps - WARMUP:(i + 1)*sps] for i in ROWS]
+    quantized = QUANTIZERS[quantizer](np.array(entries), frequency, sample_rate, **options)
+
+    table = np.zeros((SYMBOLS, sps))
+    table[:COMPACT_SYMBOLS] = quantized[:, WARMUP:]
+    table[COMPACT_SYMBOLS:] = -table[:COMPACT_SYMBOLS]
+    return table
+
+def compact(table):
+    table = np.asarray(table)
+    if not np.array_equal(table[COMPACT_SYMBOLS:], -table[:COMPACT_SYMBOLS]):
+        raise ValueError("Table entries {}-{} aren't the negation of the first {}".format(
+            COMPACT_SYMBOLS, SYMBOLS - 1, COMPACT_SYMBOLS))
+    return table[:COMPACT_SYMBOLS]
+
+def expand(table):
+    return np.concatenate((table, -table))
+
+def table_key(frequency, sample_rate, quantizer, bt=gmsk.BT, **options):
+    # Hash of everything that goes into a generated table
+    params = {
+        'version': TABLE_VERSION,
+        'frequency': float(frequency),
+        'sample_rate': float(sample_rate),
+        'quantizer': quantizer,
+        'bt': float(bt),
+        'sequence': SEQUENCE,
+        'rows': ROWS,
+        'warmup': WARMUP,
+        'options': options,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:20]
+
+def shipped_path(frequency, sample_rate):
+    # Where the notebook's (delta-sigma shaped) tables live
+    return os.path.join(DATA_DIR, 'gmsk_{}e6_{:g}e9.npy'.format(int(round(frequency/1e6)), sample_rate/1e9))
+
+def load(channel, sample_rate=5e9, quantizer=None, cache_dir=None, **options):
+    # The compact table for a channel. Without a quantizer this is the table checked into data/
+    # if there is one (and a 'sign' table if not).
+    frequency = channel_frequency(channel)
+    if quantizer is None:
+        path = shipped_path(frequency, sample_rate)
+        if os.path.exists(path):
+            return compact(np.load(path))
+        quantizer = 'sign'
+
+    sps = gmsk.samples_per_symbol(sample_rate)
+    cache_dir = cache_dir or os.path.join(CACHE_DIR, 'tables')
+    path = os.path.join(cache_dir, table_key(frequency, sample_rate, quantizer, **options) + '.npy')
+    try:
+        bits = np.unpackbits(np.load(path), axis=1, count=sps)
+        return bits*2.0 - 1.0
+    except (OSError, ValueError):
+        pass
+
+    table = compact(generate(frequency, sample_rate, quantizer, **options))
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write then rename so concurrent builds never see half a file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, np.packbits(table > 0, axis=1))
+    os.replace(tmp, path)
+    return table
+
+class CompactSymbolTable(Elaboratable):
+    # Plays packet (a list of entries, see entry()) out of compact tables in tx_domain, one word
+    # per cycle. Same interface as alldigitalradio's SymbolTable: set packet_length, pulse
+    # tx_reset (in sync) and wait for tx_done. `tables` is one compact table per channel.
+    def __init__(self, tables, depth, width=20, tx_domain="tx"):
+        self.width = width
+        self.tx_domain = tx_domain
+        self.words = tables[0].shape[1]//width # words per entry
+
+        words = np.concatenate([pack_words(np.asarray(table).flatten(), width) for table in tables])
+        self.table = Memory(width=width, depth=len(words), init=[int(word) for word in words])
+        self.address_bits = bits_for(len(words) - 1)
+
+        # Each entry is the word address of a table entry plus an invert bit on top
+        self.packet = Memory(width=self.address_bits + 1, depth=depth)
+        self.packet_length = Signal(range(depth + 1))
+
+        self.tx_reset = Signal()
+        self.tx_done = Signal()
+        self.tx_data = Signal(width)
+
+    def entry(self, table, symbol):
+        # The packet entry for symbol (a symbol table index, 0-31) in the `table`th table
+        base = (table*COMPACT_SYMBOLS + symbol[:4])*self.words
+        return Cat(base[:self.address_bits], symbol[4])
+
+    def elaborate(self, platform):
+        m = Module()
+        tx = m.d[self.tx_domain]
+
+        m.submodules.table = table = self.table.read_port(domain=self.tx_domain)
+        m.submodules.packet = packet = self.packet.read_port(domain="comb")
+
+        # Start on the rising edge of tx_reset
+        reset = Signal()
+        last_reset = Signal()
+        m.submodules.reset_sync = FFSynchronizer(self.tx_reset, reset, o_domain=self.tx_domain)
+        tx += last_reset.eq(reset)
+
+        # finished toggles every time a packet is done. tx_done stays low from tx_reset until
+        # the toggle makes it back over to sync.
+        finished = Signal()
+        finished_sync = Signal()
+        seen = Signal()
+        pending = Signal()
+        m.submodules.done_sync = FFSynchronizer(finished, finished_sync, o_domain="sync")
+        m.d.sync += seen.eq(finished_sync)
+        with m.If(self.tx_reset):
+            m.d.sync += pending.eq(1)
+        with m.Elif(finished_sync != seen):
+            m.d.sync += pending.eq(0)
+        m.d.comb += self.tx_done.eq(~pending & ~self.tx_reset)
+
+        playing = Signal()
+        length = Signal.like(self.packet_length)
+        symbol = Signal(range(self.packet.depth))
+        word = Signal(range(self.words))
+        invert = Signal()
+        valid = Signal()
+
+        m.d.comb += [
+            packet.addr.eq(symbol),
+            table.addr.eq(packet.data[:self.address_bits] + word),
+            self.tx_data.eq(Mux(valid, table.data ^ Repl(invert, self.width), 0)),
+        ]
+        # Line up with the table read
+        tx += [
+            invert.eq(packet.data[-1]),
+            valid.eq(playing),
+        ]
+
+        with m.If(reset & ~last_reset):
+            # packet_length is held steady while a packet plays, so it's safe to sample here
+            tx += [
+                length.eq(self.packet_length),
+                symbol.eq(0),
+                word.eq(0),
+                playing.eq(self.packet_length != 0),
+            ]
+            with m.If(self.packet_length == 0):
+                tx += finished.eq(~finished)
+        with m.Elif(playing):
+            tx += word.eq(word + 1)
+            with m.If(word == self.words - 1):
+                tx += [
+                    word.eq(0),
+                    symbol.eq(symbol + 1),
+                ]
+                with m.If(symbol == length - 1):
+                    tx += [
+                        playing.eq(0),
+                        finished.eq(~finished),
+                    ]
+        return m
+
+def memory_bits(channels, sample_rate=5e9, width=20, compact=True):
+    words = gmsk.samples_per_symbol(sample_rate)//width
+    return len(channels)*(COMPACT_SYMBOLS if compact else SYMBOLS)*words*width
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate (and cache) transmit symbol tables")
+    parser.add_argument('channels', nargs='?', default='37', help="comma separated, e.g. 37,38,39")
+    parser.add_argument('--rate', type=float, default=5e9, help="SERDES line rate")
+    parser.add_argument('--quantizer', choices=['sign', 'pwm2'], default=None,
+        help="generate with this rather than use the table in data/ (if there is one)")
+    args = parser.parse_args()
+
+    channels = [int(channel) for channel in args.channels.split(',')]
+    for channel in channels:
+        start = time.time()
+        table = load(channel, args.rate, args.quantizer)
+        print("Channel {} ({:.0f}MHz): {} x {} in {:.2f}s".format(
+            channel, channel_frequency(channel)/1e6, table.shape[0], table.shape[1], time.time() - start))
+    full = memory_bits(channels, args.rate, compact=False)
+    small = memory_bits(channels, args.rate)
+    print("Table memory: {:.0f}kbit ({:.0f}kbit without the compact layout)".format(small/1024, full/1024))
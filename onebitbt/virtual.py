@@ -0,0 +1,422 @@
+import os
+import sys
+import shutil
+import hashlib
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+
+from nmigen import Elaboratable, Module, Signal
+from nmigen.back import rtlil
+
+import alldigitalradio.hardware as hardware
+
+from onebitbt.capture import iter_words
+from onebitbt.buildcache import BUILD_CACHE, tool_version
+from onebitbt.scan import parse_channels
+from onebitbt.bank import parse_offsets, offset_args
+
+# Runs BLERadio on "virtual hardware". Rather than stepping the design through the (slow) python
+# simulator, we compile it to C++ with yosys' CXXRTL backend and link it against a small driver
+# (below) that reads SERDES words from stdin, clocks the design and decodes whatever comes out of
+# the UART onto stdout. Tracing is opt in, and only for the signals you ask for:
+#
+#   python -m onebitbt.radio virtual data/bt1bit.txt --trace baseband,parser.state --vcd build/trace.vcd
+#
+# Even that can get big for long captures, so --ring keeps only the last N cycles in memory and
+# dumps them (plus --post cycles after) whenever the --trigger signal (parser.debug by default)
+# goes high.
+#
+# BLERadio has one receive lane per channel, so `parser.state` is shorthand for the parser in the
+# first channel's lane (lane37.parser.state by default). Spell out the lane to get at the others.
+
+# A couple of handy names for signals that live inside submodules
+ALIASES = {
+    'baseband': 'demodulator.baseband',
+}
+
+# Submodules that live inside each receive lane
+LANE_MODULES = ('demodulator', 'synchronizer', 'bank', 'parser', 'ring')
+
+# The SERDES word clock (rx) runs at 250MHz and the sync domain at 25MHz
+SYNC_RATIO = 10
+
+DRIVER = r'''
+#include <cstdio>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+#include <string>
+#include <vector>
+
+#include "top.cc"
+
+struct traced {
+    std::string name;
+    std::string id;
+    cxxrtl::debug_item *item;
+};
+
+static uint64_t read_item(const cxxrtl::debug_item *item) {
+    uint64_t value = item->curr[0];
+    if (item->width > 32)
+        value |= (uint64_t)item->curr[1] << 32;
+    return value;
+}
+
+struct vcd_writer {
+    FILE *f = nullptr;
+    std::vector<traced> *signals;
+    std::vector<uint64_t> last;
+    bool dumped = false;
+
+    void open(const char *filename, std::vector<traced> *s) {
+        signals = s;
+        f = fopen(filename, "w");
+        if (!f) {
+            perror(filename);
+            exit(1);
+        }
+        fprintf(f, "$timescale 1ns $end\n$scope module top $end\n");
+        for (auto &t : *signals)
+            fprintf(f, "$var wire %zu %s %s $end\n", t.item->width, t.id.c_str(), t.name.c_str());
+        fprintf(f, "$upscope $end\n$enddefinitions $end\n");
+        last.resize(signals->size());
+    }
+
+    void value(size_t i, uint64_t v) {
+        traced &t = (*signals)[i];
+        if (t.item->width == 1) {
+            fprintf(f, "%d%s\n", (int)(v & 1), t.id.c_str());
+        } else {
+            fputc('b', f);
+            for (size_t b = t.item->width; b > 0; b--)
+                fputc((v >> (b - 1)) & 1 ? '1' : '0', f);
+            fprintf(f, " %s\n", t.id.c_str());
+        }
+    }
+
+    // Writes out the values at time t, only emitting what changed unless this is the start
+    // of a new window
+    void sample(uint64_t t, const uint64_t *values, bool restart) {
+        bool stamped = false;
+        for (size_t i = 0; i < last.size(); i++) {
+            if (restart || !dumped || values[i] != last[i]) {
+                if (!stamped) {
+                    fprintf(f, "#%llu\n", (unsigned long long)t);
+                    stamped = true;
+                }
+                value(i, values[i]);
+                last[i] = values[i];
+            }
+        }
+        dumped = true;
+    }
+
+    void close() {
+        if (f)
+            fclose(f);
+    }
+};
+
+int main(int argc, char **argv) {
+    unsigned ratio = 10;
+    unsigned divisor = 217;
+    const char *vcd_file = nullptr;
+    std::vector<std::string> names;
+    std::string trigger;
+    size_t ring = 0;
+    size_t post = 0;
+    size_t max_triggers = 0;
+
+    for (int i = 1; i < argc; i++) {
+        std::string arg(argv[i]);
+        std::string key = arg.substr(0, arg.find('='));
+        std::string value = arg.substr(arg.find('=') + 1);
+        if (key == "ratio") ratio = atoi(value.c_str());
+        else if (key == "divisor") divisor = atoi(value.c_str());
+        else if (key == "vcd") vcd_file = argv[i] + 4;
+        else if (key == "trace") names.push_back(value);
+        else if (key == "trigger") trigger = value;
+        else if (key == "ring") ring = atol(value.c_str());
+        else if (key == "post") post = atol(value.c_str());
+        else if (key == "max_triggers") max_triggers = atol(value.c_str());
+    }
+
+    cxxrtl_design::p_top top;
+    cxxrtl::debug_items items;
+    static_cast<cxxrtl::module &>(top).debug_info(items, "");
+
+    // Flattened names are separated by spaces, but it's more natural to write them with dots
+    auto find = [&](const std::string &name) -> cxxrtl::debug_item * {
+        std::string spaced = name;
+        for (auto &c : spaced)
+            if (c == '.') c = ' ';
+        for (auto &candidate : {spaced, name}) {
+            auto it = items.table.find(candidate);
+            if (it != items.table.end())
+                return &it->second[0];
+        }
+        fprintf(stderr, "Unknown signal: %s\n", name.c_str());
+        exit(1);
+    };
+
+    std::vector<traced> signals;
+    for (auto &name : names) {
+        char id[8];
+        snprintf(id, sizeof(id), "s%zu", signals.size());
+        signals.push_back({name, id, find(name)});
+    }
+    cxxrtl::debug_item *trigger_item = trigger.empty() ? nullptr : find(trigger);
+
+    vcd_writer vcd;
+    if (vcd_file && !signals.empty())
+        vcd.open(vcd_file, &signals);
+    bool tracing = vcd.f != nullptr;
+
+    // The ring buffer holds `ring` sync cycles worth of traced values before the trigger, plus
+    // the trigger cycle and the `post` after it, which all get dumped together
+    size_t window = ring ? ring + 1 + post : 0;
+    std::vector<uint64_t> history(window*signals.size());
+    std::vector<uint64_t> current(signals.size());
+    size_t head = 0, filled = 0, remaining = 0, triggers = 0;
+    bool triggered = false, last_trigger = false;
+
+    // UART receiver state
+    bool last_tx = true;
+    unsigned uart_bit = 0, uart_timer = 0, uart_byte = 0;
+    bool uart_busy = false;
+
+    static uint32_t words[1 << 16];
+    uint64_t word = 0, cycle = 0;
+    size_t n;
+
+    top.step();
+    while ((n = fread(words, sizeof(uint32_t), sizeof(words)/sizeof(uint32_t), stdin)) > 0) {
+        for (size_t i = 0; i < n; i++, word++) {
+            unsigned phase = word % ratio;
+            top.p_rx__data.set<uint32_t>(words[i]);
+            if (phase == 0) top.p_clk.set<bool>(true);
+            if (phase == ratio/2) top.p_clk.set<bool>(false);
+            top.p_rx__clk.set<bool>(true);
+            top.step();
+            top.p_rx__clk.set<bool>(false);
+            top.step();
+
+            if (phase != 0)
+                continue;
+            cycle++;
+
+            // Decode the UART (8N1, LSB first)
+            bool tx = top.p_tx__o.get<bool>();
+            if (!uart_busy) {
+                if (last_tx && !tx) {
+                    uart_busy = true;
+                    uart_bit = 0;
+                    uart_byte = 0;
+                    uart_timer = divisor + divisor/2;
+                }
+            } else if (--uart_timer == 0) {
+                if (uart_bit < 8) {
+                    uart_byte |= (tx ? 1 : 0) << uart_bit++;
+                    uart_timer = divisor;
+                } else {
+                    if (tx) {
+                        fputc(uart_byte, stdout);
+                        fflush(stdout);
+                    }
+                    uart_busy = false;
+                }
+            }
+            last_tx = tx;
+
+            if (!tracing)
+                continue;
+
+            for (size_t s = 0; s < signals.size(); s++)
+                current[s] = read_item(signals[s].item);
+            uint64_t t = cycle*ratio*4;
+
+            if (!ring) {
+                vcd.sample(t, current.data(), false);
+                continue;
+            }
+
+            memcpy(&history[head*signals.size()], current.data(), signals.size()*sizeof(uint64_t));
+            head = (head + 1) % window;
+            filled = filled < window ? filled + 1 : window;
+
+            bool trigger_value = trigger_item && (read_item(trigger_item) & 1);
+            if (trigger_value && !last_trigger && !triggered) {
+                triggered = true;
+                remaining = post;
+            }
+            last_trigger = trigger_value;
+
+            if (triggered && remaining-- == 0) {
+                // Dump out everything in the ring, oldest first
+                for (size_t j = 0; j < filled; j++) {
+                    size_t idx = (head + window - filled + j) % window;
+                    vcd.sample(t - (filled - 1 - j)*ratio*4, &history[idx*signals.size()], j == 0);
+                }
+                filled = 0;
+                triggered = false;
+                if (max_triggers && ++triggers >= max_triggers)
+                    tracing = false;
+            }
+        }
+    }
+
+    vcd.close();
+    fprintf(stderr, "Simulated %llu cycles\n", (unsigned long long)cycle);
+    return 0;
+}
+'''
+
+class VirtualBLERadio(Elaboratable):
+    # Wraps the radio so the things the driver needs to poke at are top level ports
+    def __init__(self, radio):
+        self.radio = radio
+        self.rx_data = Signal(20)
+        self.tx_o = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.radio = radio = self.radio
+        m.d.comb += [
+            radio.serdes.rx_data.eq(self.rx_data),
+            self.tx_o.eq(radio.uart.tx_o),
+            radio.uart.rx_i.eq(1),
+        ]
+        return m
+
+def build(radio, build_dir=None):
+    # Compile the design, reusing a previous binary if one was built from the exact same design,
+    # driver and tools (see onebitbt.buildcache)
+    top = VirtualBLERadio(radio)
+    text = rtlil.convert(top, ports=[top.rx_data, top.tx_o])
+
+    yosys = os.environ.get('YOSYS', 'yosys')
+    cxx = os.environ.get('CXX', 'c++')
+    key = hashlib.sha256('\0'.join([text, DRIVER, str(tool_version(yosys)), str(tool_version(cxx))]).encode('utf-8')).hexdigest()[:24]
+    build_dir = os.path.join(build_dir or os.path.join(BUILD_CACHE, 'virtual'), key)
+    binary = os.path.join(build_dir, 'sim')
+    if os.path.exists(binary):
+        return binary
+
+    partial = build_dir + '.partial'
+    os.makedirs(partial, exist_ok=True)
+    with open(os.path.join(partial, 'top.il'), 'w') as f:
+        f.write(text)
+    with open(os.path.join(partial, 'main.cc'), 'w') as f:
+        f.write(DRIVER)
+
+    subprocess.run([yosys, '-q', '-p', 'read_rtlil top.il; proc; flatten; write_cxxrtl -O4 top.cc'],
+        cwd=partial, check=True)
+
+    datdir = subprocess.run([yosys + '-config', '--datdir'], stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+    subprocess.run([cxx, '-std=c++14', '-O2',
+        '-I', os.path.join(datdir, 'include'),
+        '-I', os.path.join(datdir, 'include', 'backends', 'cxxrtl', 'runtime'),
+        'main.cc', '-o', 'sim'], cwd=partial, check=True)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.replace(partial, build_dir)
+    return binary
+
+def qualify(name, lane=None):
+    # Everything lives under the VirtualBLERadio wrapper
+    name = ALIASES.get(name, name)
+    if lane is not None and name.split('.')[0] in LANE_MODULES:
+        name = 'lane{}.{}'.format(lane, name)
+    return 'radio.' + name
+
+def run(binary, capture, output=sys.stdout.buffer, trace=(), vcd=None, ring=0, post=0, trigger='parser.debug',
+        max_triggers=0, divisor=int(25e6/115200), chunk_words=1 << 20, lane=None, start=0, count=None, pad=0):
+    # Runs `count` words of the capture from `start` (all of it by default) through the simulator,
+    # followed by `pad` words of silence
+
+    args = [binary, 'ratio={}'.format(SYNC_RATIO), 'divisor={}'.format(divisor)]
+    if trace and vcd:
+        # The simulator won't make the directory for us
+        os.makedirs(os.path.dirname(vcd) or '.', exist_ok=True)
+        args += ['vcd={}'.format(vcd)] + ['trace={}'.format(qualify(t, lane)) for t in trace]
+        if ring:
+            args += ['ring={}'.format(ring), 'post={}'.format(post), 'trigger={}'.format(qualify(trigger, lane))]
+            args += ['max_triggers={}'.format(max_triggers)]
+
+    sim = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # Feed the capture in from another thread so we can print the UART as it comes out
+    def feed():
+        try:
+            for words in iter_words(capture, chunk_words=chunk_words, start=start, count=count):
+                sim.stdin.write(np.asarray(words, dtype='<u4').tobytes())
+            for i in range(0, pad, chunk_words):
+                sim.stdin.write(np.zeros(min(chunk_words, pad - i), dtype='<u4').tobytes())
+        finally:
+            sim.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    received = bytearray()
+    while True:
+        data = sim.stdout.read1(4096)
+        if not data:
+            break
+        received += data
+        if output:
+            output.write(data)
+            output.flush()
+
+    feeder.join()
+    if sim.wait() != 0:
+        raise RuntimeError("Simulator exited with {}".format(sim.returncode))
+    return bytes(received)
+
+def main(args, make_radio):
+    parser = argparse.ArgumentParser(prog='python -m onebitbt.radio virtual')
+    parser.add_argument('capture', help='text or packed capture of SERDES samples')
+    parser.add_argument('--build-dir', default=None, help='where to cache simulator builds')
+    parser.add_argument('--trace', default='', help='comma separated signals to trace, e.g. baseband,parser.state')
+    parser.add_argument('--vcd', default='build/trace.vcd')
+    parser.add_argument('--ring', type=int, default=0, help='only keep this many cycles before each trigger')
+    parser.add_argument('--post', type=int, default=1000, help='cycles to keep after each trigger')
+    parser.add_argument('--trigger', default='parser.debug')
+    parser.add_argument('--max-triggers', type=int, default=0)
+    parser.add_argument('--channels', default='37', help='comma separated channels to receive on, e.g. 37,38,39')
+    parser.add_argument('--raw', dest='mode', action='store_const', const='raw', default='text',
+        help='ship raw packets out and parse them on the host')
+    parser.add_argument('--records', dest='mode', action='store_const', const='records',
+        help='ship binary packet records out and decode them on the host')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--phase', dest='demodulator', action='store_const', const='phase', default='fsk',
+        help='use the CORDIC phase demodulator instead of the FSK one')
+    parser.add_argument('--2m', dest='phy', action='store_const', const='2m', default='1m',
+        help='receive the LE 2M PHY (secondary advertising channels) instead of 1M')
+    parser.add_argument('--offsets', default=None,
+        help='kHz offsets to demodulate at (e.g. -150,-75,0,75,150), picking the best for every packet')
+    parser.add_argument('--dedup', type=int, default=0, help='entries in the table of recent packets to suppress repeats of')
+    parser.add_argument('--ttl', type=int, default=1000, help='ms before a suppressed packet gets through again')
+    parser.add_argument('--scan', default=None, help='add a lane that scans these channels, e.g. 0-39 (use --channels "" for just that)')
+    parser.add_argument('--dwell', type=float, default=10, help='ms the scan lane listens on each channel')
+    args = parser.parse_args(offset_args(args))
+
+    channels = [int(channel) for channel in args.channels.split(',') if channel]
+    scan = parse_channels(args.scan) if args.scan else None
+    with hardware.use('virtual'):
+        radio = make_radio(channels, mode=args.mode, baud=args.baud, demodulator=args.demodulator, dedup=args.dedup,
+            dedup_ttl_ms=args.ttl, scan=scan, dwell_ms=args.dwell, phy=args.phy,
+            offsets=parse_offsets(args.offsets) if args.offsets else None)
+        binary = build(radio, args.build_dir)
+
+    print("Reading {}".format(args.capture))
+    trace = [t for t in args.trace.split(',') if t]
+    output = sys.stdout.buffer
+    if args.mode != 'text':
+        from onebitbt.host import PacketWriter
+        output = PacketWriter()
+    run(binary, args.capture, output=output, trace=trace, vcd=args.vcd, ring=args.ring, post=args.post,
+        trigger=args.trigger, max_triggers=args.max_triggers, divisor=radio.uart.divisor, lane=channels[0] if channels else 'scan')
+    print("Simulation Complete!")